@@ -105,6 +105,12 @@ DATABASES = {
 
 USE_CACHING = get_env_variable("USE_CACHING") == "True"
 
+# Cache alias storing rendered graphics as PNG bytes. Point it at a separate,
+# size limited cache in the local settings to give graphics their own budget.
+GRAPHIC_CACHE_ALIAS = "default"
+# Largest rendered graphic stored in the cache
+GRAPHIC_CACHE_MAX_BYTES = 2 * 1024 * 1024
+
 # Q Cluster Settings
 
 Q_CLUSTER = {
@@ -201,10 +207,34 @@ Compute Settings - for reading rasters with multiprocessing.
 # Set number of processes to 1 by default
 N_PROCESSES = 1
 
+# Threads reading rasters concurrently within a request (multi-year histograms)
+N_THREADS = 4
+
+# Processes per API worker rendering matplotlib graphics (0 renders in-process)
+GRAPHIC_PROCESSES = 2
+
 BLOCK_SCALE_FACTOR = 4
 
 DEFAULT_BLOCK_SIZE = 256
 
+# Longest side in pixels of reduced resolution "preview" zonal reads
+PREVIEW_MAX_SIZE = 1024
+
+# Tolerances (degrees) of the simplified geometries stored per boundary
+# feature: a quarter of common product pixel sizes (MODIS 250m, CHIRPS
+# 0.05 degrees) and the graphic simplification scales (0.01, 0.1).
+FEATURE_SIMPLIFY_TOLERANCES = [0.0005, 0.01, 0.0125, 0.1]
+
+# Boundary layers (layer_id) whose features get a histogram sketch of every
+# ingested product dataset, and the number of bins of each sketch
+HISTOGRAM_SKETCH_LAYERS = []
+HISTOGRAM_SKETCH_BINS = 1024
+
+# Default time budget (seconds) for query, histogram and graphic requests
+# and the raster read throughput used to estimate whether a read fits it.
+QUERY_TIME_BUDGET = 10
+ZONAL_READ_BYTES_PER_SECOND = 100 * 1024 * 1024
+
 
 """
 Tile Server Settings
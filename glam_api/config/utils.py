@@ -3,6 +3,7 @@ glam_api project-wide utilities
 
 """
 
+import bisect
 import os
 
 from django.db import connection
@@ -24,27 +25,105 @@ def get_env_variable(var_name):
 
 
 def generate_unique_slug(instance, slug_field):
+    """
+    Unique slug of an instance's name: the slugified name, suffixed with the
+    first free number if taken. The slugs it could collide with (those
+    starting with the slugified name) are fetched in one query.
+    """
     name = instance.name.replace(".", "-")
     base_slug = slugify(name)
+    taken = set(
+        type(instance)
+        .objects.filter(**{f"{slug_field}__startswith": base_slug})
+        .values_list(slug_field, flat=True)
+    )
+    return next_free_slug(base_slug, taken)
+
+
+def next_free_slug(base_slug, taken):
+    """First of `base_slug`, `base_slug`-1, `base_slug`-2... not in `taken`"""
     slug = base_slug
     num = 1
-
-    while type(instance).objects.filter(**{f"{slug_field}": f"{slug}"}).exists():
+    while slug in taken:
         slug = f"{base_slug}-{num}"
         num += 1
+    return slug
+
+
+def generate_unique_slugs(model, names, slug_field):
+    """
+    Bulk version of generate_unique_slug: unique slugs for new `model`
+    records named `names`, in order, from one query of the existing slugs.
+    """
+    taken = set(model.objects.values_list(slug_field, flat=True))
+    slugs = []
+    for name in names:
+        slug = next_free_slug(slugify(name.replace(".", "-")), taken)
+        taken.add(slug)
+        slugs.append(slug)
+    return slugs
+
 
-    unique_slug = slug
-    return unique_slug
+def date_index(qs):
+    """
+    Sorted (date, pk) pairs of the records in a queryset, one per date.
+    Where the model has a `prelim` flag, final records are preferred over
+    preliminary records of the same date.
+    """
+    ordering = ["date"]
+    if any(field.name == "prelim" for field in qs.model._meta.get_fields()):
+        ordering.append("prelim")
+
+    index = []
+    for record_date, pk in qs.order_by(*ordering).values_list("date", "pk"):
+        if not index or index[-1][0] != record_date:
+            index.append((record_date, pk))
+    return index
+
+
+def closest_in_index(index, dates, exact=False):
+    """
+    pk of the record of a date_index closest to each of `dates` (the earlier
+    record on equal distance), or of the record on that exact date if
+    `exact`. None where there is no match.
+    """
+    index_dates = [record_date for record_date, pk in index]
+
+    pks = []
+    for date in dates:
+        i = bisect.bisect_left(index_dates, date)
+        greater = index[i] if i < len(index) else None
+        if greater and greater[0] == date:
+            pks.append(greater[1])
+            continue
+        if exact:
+            pks.append(None)
+            continue
+        less = index[i - 1] if i > 0 else None
+
+        if greater and less:
+            closest = (
+                greater if abs(greater[0] - date) < abs(less[0] - date) else less
+            )
+        else:
+            closest = greater or less
+        pks.append(closest[1] if closest else None)
+    return pks
 
 
 def get_closest_to_date(qs, date):
-    greater = qs.filter(date__gte=date).order_by("date").first()
-    less = qs.filter(date__lte=date).order_by("-date").first()
+    return get_closest_to_dates(qs, [date])[0]
+
 
-    if greater and less:
-        return greater if abs(greater.date - date) < abs(less.date - date) else less
-    else:
-        return greater or less
+def get_closest_to_dates(qs, dates):
+    """
+    Bulk version of get_closest_to_date: return the closest record to each
+    of `dates`, in order, from one query of the dates in the queryset and one
+    query of the matching records.
+    """
+    pks = closest_in_index(date_index(qs), dates)
+    objects = qs.in_bulk([pk for pk in pks if pk is not None])
+    return [objects.get(pk) for pk in pks]
 
 
 def extract_datetime_from_filename(filename):
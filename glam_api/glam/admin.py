@@ -13,6 +13,7 @@ from .models import (
     BoundaryLayer,
     Announcement,
     ImageExport,
+    AtlasExport,
 )
 
 
@@ -50,3 +51,4 @@ admin.site.register(Product, ProductAdmin)
 admin.site.register(CropMask, CropMaskAdmin)
 admin.site.register(BoundaryLayer, BoundaryLayerAdmin)
 admin.site.register(ImageExport)
+admin.site.register(AtlasExport)
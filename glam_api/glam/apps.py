@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class GlamConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'glam'
+
+    def ready(self):
+        from . import signals
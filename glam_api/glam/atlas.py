@@ -0,0 +1,396 @@
+"""
+atlas.py
+
+Atlas exports: the graphics of every feature of a boundary layer (or of the
+layers with a tag) for one product date, written to storage as a ZIP of PNGs.
+
+Features are grouped by the country (ADM0 feature) they lie in. Each
+country's extent is read once per dataset, at the finest resolution any of
+its graphics would be read at, and its features are rendered from that
+shared array by a fork pool of N_PROCESSES processes that inherit it.
+"""
+
+import math
+import logging
+import multiprocessing
+import tempfile
+import zipfile
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely
+
+import rasterio
+from rasterio import windows
+from rasterio.features import geometry_mask
+from rasterio.transform import from_bounds
+from rio_tiler.constants import WGS84_CRS
+from rio_tiler.io import COGReader
+
+from PIL import Image
+
+from django.conf import settings
+from django.core.files import File
+from django.db import connections
+from django.utils import timezone
+
+from glam.models import AtlasExport, BoundaryFeature, Product
+from glam.utils import get_raster_path
+from glam.utils.assets import admin_layer_ids, graphic_assets, layer_admin_level
+from glam.utils.compositor import canvas_size, render_graphic
+from glam.utils.geometries import (
+    extent_envelope,
+    raster_resolution,
+    simplified_geometries,
+    simplified_geometry,
+)
+from glam.utils.resolvers import (
+    get_baseline_dataset,
+    get_mask_dataset,
+    get_product_dataset,
+)
+from glam.views.graphics import (
+    GRAPHIC_MAX_SIZE,
+    get_fig_size,
+    graphic_colormap,
+    graphic_label,
+    graphic_scale_factor,
+    graphic_stretch,
+)
+
+# Longest side in pixels of the array read for one country
+ATLAS_MAX_SIZE = 8192
+
+# Country being rendered, inherited by the forked render processes
+_atlas_group = None
+
+
+def atlas_features(layer_id=None, tag=None):
+    """BoundaryFeatures of an atlas: those of a layer or of the layers with a tag"""
+    features = BoundaryFeature.objects.filter(geom__isnull=False)
+    if layer_id:
+        features = features.filter(boundary_layer__layer_id=layer_id)
+    if tag:
+        features = features.filter(boundary_layer__tags__name=tag)
+    return features.select_related("boundary_layer").order_by(
+        "boundary_layer_id", "feature_id"
+    )
+
+
+def country_groups(features):
+    """
+    Features grouped by the ADM0 feature containing a point on their
+    surface. Features outside every ADM0 feature are grouped alone.
+    """
+    features = list(features)
+    if not features:
+        return []
+
+    points = [
+        shapely.point_on_surface(shapely.from_wkb(bytes(feature.geom.wkb)))
+        for feature in features
+    ]
+    extent = shapely.total_bounds(points)
+    countries = list(
+        BoundaryFeature.objects.filter(
+            boundary_layer__in=admin_layer_ids("ADM0"),
+            geom__intersects=extent_envelope(extent),
+        ).values_list("pk", "geom")
+    )
+    tree = shapely.STRtree(
+        [shapely.from_wkb(bytes(geom.wkb)) for pk, geom in countries]
+    )
+
+    groups = {}
+    for index, (feature, point) in enumerate(zip(features, points)):
+        within = tree.query(point, predicate="within")
+        key = countries[within[0]][0] if len(within) else ("feature", index)
+        groups.setdefault(key, []).append(feature)
+    return list(groups.values())
+
+
+def group_pixel_size(src, features):
+    """
+    Pixel size in degrees to read a country at: the finest that any of its
+    graphics would be read at (GRAPHIC_MAX_SIZE pixels across, at most the
+    raster resolution).
+    """
+    resolution = raster_resolution(src)
+    pixel_size = min(
+        max(
+            (feature.geom.extent[2] - feature.geom.extent[0]),
+            (feature.geom.extent[3] - feature.geom.extent[1]),
+        )
+        / GRAPHIC_MAX_SIZE
+        for feature in features
+    )
+    return max(pixel_size, resolution)
+
+
+def read_group(product_ds, anomaly_ds, mask_ds, bounds, pixel_size):
+    """
+    Masked array of a product dataset (minus the anomaly baseline, times
+    the crop mask) over `bounds` on a grid of `pixel_size` degrees.
+    Returns (array, transform).
+    """
+    width = max(1, math.ceil((bounds[2] - bounds[0]) / pixel_size))
+    height = max(1, math.ceil((bounds[3] - bounds[1]) / pixel_size))
+    longest = max(width, height)
+    if longest > ATLAS_MAX_SIZE:
+        width = max(1, round(width * ATLAS_MAX_SIZE / longest))
+        height = max(1, round(height * ATLAS_MAX_SIZE / longest))
+
+    def read(dataset):
+        with COGReader(get_raster_path(dataset.file_object)) as cog:
+            part = cog.part(bounds, dst_crs=WGS84_CRS, width=width, height=height)
+        return part.as_masked()[0]
+
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS):
+        data = read(product_ds)
+        if anomaly_ds:
+            data = data - read(anomaly_ds)
+        if mask_ds:
+            data = data * read(mask_ds)
+
+    return data, from_bounds(*bounds, width, height)
+
+
+def feature_data(data, transform, geom):
+    """
+    Part of a country array covering a feature, masked outside it.
+    Returns (array, bounds).
+    """
+    window = (
+        windows.from_bounds(*geom.bounds, transform=transform)
+        .round_offsets()
+        .round_lengths()
+        .intersection(windows.Window(0, 0, data.shape[1], data.shape[0]))
+    )
+    part = data[window.toslices()]
+    window_transform = windows.transform(window, transform)
+    outside = geometry_mask(
+        [geom.__geo_interface__], out_shape=part.shape, transform=window_transform
+    )
+    part = np.ma.masked_where(outside | np.ma.getmaskarray(part), part)
+    return part, windows.bounds(window, transform)
+
+
+def _render_atlas_graphic(index):
+    """Process pool worker: (file name, PNG) of one graphic of the country"""
+    group = _atlas_group
+    graphic = group["graphics"][index]
+    data, data_bounds = feature_data(
+        group["data"], group["transform"], graphic["feature"]
+    )
+    png = render_graphic(
+        canvas_size(group["figsize"], graphic["bounds"]),
+        graphic["bounds"],
+        backdrop=graphic["backdrop"],
+        feature=graphic["feature"],
+        data=data,
+        data_bounds=data_bounds,
+        colormap=group["colormap"],
+        stretch=group["stretch"],
+        label=graphic["label"],
+        legend=group["legend"],
+        scale=group["scale"],
+        logo=group["logo"],
+    )
+    return graphic["filename"], png
+
+
+def render_group(count):
+    """
+    (file name, PNG) of each of the `count` graphics of the country in
+    _atlas_group, rendered by a fork pool of N_PROCESSES processes.
+    """
+    if settings.N_PROCESSES <= 1 or count <= 1:
+        yield from map(_render_atlas_graphic, range(count))
+        return
+
+    # forked workers must not share the parent's database connections
+    connections.close_all()
+    with ProcessPoolExecutor(
+        max_workers=settings.N_PROCESSES,
+        mp_context=multiprocessing.get_context("fork"),
+    ) as executor:
+        yield from executor.map(_render_atlas_graphic, range(count))
+
+
+def group_graphics(features, label_options):
+    """
+    Render inputs of the graphics of a country's features: simplified
+    feature geometry, graphic bounds, backdrop geometries and label. The
+    backdrop features of the country are queried once per admin level and
+    simplification tolerance.
+    """
+    backdrops = {}
+
+    def backdrop_tree(layer_ids, scale_factor, envelope):
+        key = (tuple(sorted(layer_ids)), scale_factor)
+        if key not in backdrops:
+            geometries = [
+                shapely.from_wkb(bytes(geometry.wkb))
+                for geometry in simplified_geometries(
+                    BoundaryFeature.objects.filter(
+                        boundary_layer__in=layer_ids, geom__intersects=envelope
+                    ),
+                    scale_factor,
+                )
+            ]
+            backdrops[key] = (geometries, shapely.STRtree(geometries))
+        return backdrops[key]
+
+    extents = np.array([feature.geom.extent for feature in features])
+    group_extent = (*extents[:, :2].min(axis=0), *extents[:, 2:].max(axis=0))
+    group_envelope = extent_envelope(group_extent, 2)
+
+    graphics = []
+    for feature in features:
+        xmin, ymin, xmax, ymax = feature.geom.extent
+        scale_factor = graphic_scale_factor([xmin, xmax, ymin, ymax])
+        admin_level = layer_admin_level(feature.boundary_layer)
+        buff = 2 if admin_level == "ADM0" else 1
+        bounds = extent_envelope(feature.geom.extent, buff).extent
+
+        if admin_level:
+            backdrop_layers = [admin_layer_ids(admin_level)]
+        else:
+            backdrop_layers = [admin_layer_ids("ADM0"), [feature.boundary_layer_id]]
+        backdrop = []
+        for layer_ids in backdrop_layers:
+            geometries, tree = backdrop_tree(layer_ids, scale_factor, group_envelope)
+            backdrop += [geometries[i] for i in tree.query(shapely.box(*bounds))]
+
+        geom = shapely.from_wkb(bytes(simplified_geometry(feature, scale_factor).wkb))
+        if not geom.is_valid:
+            geom = geom.buffer(0)
+
+        label = None
+        if label_options is not None:
+            label = graphic_label(feature.feature_name, **label_options)
+
+        layer_id = feature.boundary_layer.layer_id
+        graphics.append(
+            {
+                "filename": f"{layer_id}/{feature.feature_id}.png",
+                "feature": geom,
+                "bounds": bounds,
+                "backdrop": backdrop,
+                "label": label,
+            }
+        )
+    return graphics
+
+
+def atlas_export(atlas_id, data):
+    """
+    Render the graphics of every feature of an atlas and store them as a ZIP.
+    Failures are recorded in the atlas' status and error.
+    :param atlas_id: id of the AtlasExport instance
+    :param data: validated AtlasBodySerializer data
+    :return: None
+    """
+    global _atlas_group
+
+    atlas = AtlasExport.objects.get(id=atlas_id)
+    atlas.status = AtlasExport.RUNNING
+    atlas.save(update_fields=["status"])
+    try:
+        write_atlas(atlas, data)
+    except Exception as e:
+        _atlas_group = None
+        logging.error(f"Atlas {atlas_id} failed: {str(e)}")
+        atlas.status = AtlasExport.FAILED
+        atlas.error = str(e)
+        atlas.save(update_fields=["status", "error"])
+        raise
+
+
+def write_atlas(atlas, data):
+    """Render the graphics of an AtlasExport and store them as a ZIP"""
+    global _atlas_group
+
+    atlas_id = atlas.id
+    product_id = data.get("product_id")
+    date = data.get("date")
+    anomaly = data.get("anomaly")
+    anomaly_type = data.get("anomaly_type")
+    diff_year = data.get("diff_year")
+
+    product = Product.objects.get(product_id=product_id)
+    product_ds = get_product_dataset(product_id, date)
+    anomaly_ds = None
+    if anomaly_type:
+        anomaly_ds = get_baseline_dataset(product_ds, anomaly, anomaly_type, diff_year)
+        if anomaly_ds is None:
+            raise ValueError(f"No {product_id} dataset of {diff_year} to compare to")
+    mask_ds = get_mask_dataset(product_id, data.get("cropmask_id"))
+
+    label_options = None
+    if data.get("label", True):
+        label_options = {
+            "date": date,
+            "product": product,
+            "mask_ds": mask_ds,
+            "anomaly": anomaly,
+            "anomaly_type": anomaly_type,
+            "diff_year": diff_year,
+        }
+    legend = None
+    if data.get("legend", True):
+        legend = product.variable.display_name
+        if anomaly_type:
+            legend += " Anomaly"
+
+    logo = graphic_assets()["logo"]
+    options = {
+        "figsize": get_fig_size(data.get("size") or "regular"),
+        "colormap": graphic_colormap(product, anomaly),
+        "stretch": graphic_stretch(product, anomaly, anomaly_type),
+        "legend": legend,
+        "scale": product.variable.scale,
+        "logo": Image.fromarray(logo) if logo is not None else None,
+    }
+
+    features = atlas_features(data.get("layer_id"), data.get("tag"))
+    groups = country_groups(features)
+    atlas.feature_count = sum(len(group) for group in groups)
+    atlas.save(update_fields=["feature_count"])
+
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS):
+        with rasterio.open(get_raster_path(product_ds.file_object)) as src:
+            pixel_sizes = [group_pixel_size(src, group) for group in groups]
+
+    with tempfile.TemporaryFile() as output:
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as archive:
+            for group, pixel_size in zip(groups, pixel_sizes):
+                graphics = group_graphics(group, label_options)
+                bounds = tuple(
+                    shapely.total_bounds([graphic["feature"] for graphic in graphics])
+                )
+                group_data, transform = read_group(
+                    product_ds, anomaly_ds, mask_ds, bounds, pixel_size
+                )
+                _atlas_group = dict(
+                    options, graphics=graphics, data=group_data, transform=transform
+                )
+
+                for filename, png in render_group(len(graphics)):
+                    archive.writestr(filename, png)
+                _atlas_group = None
+
+                atlas.features_rendered += len(graphics)
+                atlas.save(update_fields=["features_rendered"])
+                logging.info(
+                    f"Atlas {atlas_id}: {atlas.features_rendered}"
+                    f"/{atlas.feature_count} graphics"
+                )
+
+        output.seek(0)
+        atlas.file_object.save(f"{atlas_id}.zip", File(output), save=False)
+
+    atlas.status = AtlasExport.COMPLETED
+    atlas.completed = timezone.now()
+    atlas.save()
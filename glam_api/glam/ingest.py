@@ -7,6 +7,7 @@ Utilities for ingesting datasets
 import os
 import json
 import datetime
+from contextlib import ExitStack
 from dateutil.relativedelta import relativedelta
 
 import logging
@@ -20,11 +21,12 @@ from rasterio.io import MemoryFile
 from rio_cogeo.cogeo import cog_translate
 from rio_cogeo.profiles import cog_profiles
 
-from django_q.tasks import async_task
+from django_q.tasks import async_chain, async_task
 
 from django.core.files import File
 from django.core.files.storage import FileSystemStorage
 from django.conf import settings
+from django.db import transaction
 from django.utils.text import slugify
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
 
@@ -38,11 +40,18 @@ from glam.models import (
     CropMask,
     CropmaskRaster,
     AnomalyBaselineRaster,
+    FeatureCropCoverage,
+    FeatureHistogramSketch,
 )
 
-from glam.utils import get_product_id_from_filename
+from glam.utils import get_product_id_from_filename, get_raster_path
+from glam.utils.cache import bump_dataset_version, invalidate_product_dates
+from glam.utils.geometries import save_simplified_geometries
+from glam.utils.masks import get_feature_mask
+from glam.utils.sketches import sketch_range
+from glam.utils.zonal import feature_coverage, feature_histogram, open_datasets
 
-from config.utils import extract_datetime_from_filename
+from config.utils import extract_datetime_from_filename, generate_unique_slugs
 from config.storage import RasterStorage
 
 import boto3
@@ -181,6 +190,11 @@ def add_product_rasters_from_storage():
     # get fresh list of files after deleting bad files
     raster_files = raster_storage.listdir("product-rasters")[1]
 
+    # diff the listing against the registered datasets in memory
+    products = {product.product_id: product for product in Product.objects.all()}
+    registered = set(ProductRaster.objects.values_list("product__product_id", "date"))
+
+    new_datasets = []
     for filename in tqdm(raster_files):
         if filename.endswith(".tif"):
             if "prelim" in filename:
@@ -189,28 +203,49 @@ def add_product_rasters_from_storage():
                 prelim = False
             ds_date = extract_datetime_from_filename(filename)
             product_id = get_product_id_from_filename(filename)
-            dataset_directory = os.path.join(
-                settings.PRODUCT_DATASET_LOCAL_PATH, product_id
-            )
             if product_id and ds_date:
                 logging.debug(ds_date)
                 logging.debug(product_id)
-                valid_product = Product.objects.get(product_id=slugify(product_id))
-                try:
-                    ds = ProductRaster.objects.get(product=valid_product, date=ds_date)
+                valid_product = products.get(slugify(product_id))
+                if valid_product is None:
+                    logging.warning(f"{filename}: no product {product_id}")
+                    continue
+                ds_date = datetime.date.fromisoformat(ds_date)
+                if (valid_product.product_id, ds_date) in registered:
                     logging.debug(f"{filename} exists")
-                except ProductRaster.DoesNotExist:
-                    # if it doesn't exist, make it
-                    new_dataset = ProductRaster(
+                    continue
+                registered.add((valid_product.product_id, ds_date))
+                new_datasets.append(
+                    ProductRaster(
                         product=valid_product,
                         prelim=prelim,
                         date=ds_date,
+                        name=os.path.splitext(os.path.basename(filename))[0],
                         local_path=filename,
                         file_object=f"product-rasters/{filename}",
                     )
-                    logging.info(f"saving {filename}")
-                    new_dataset.save()
-                    logging.info(f"saved {new_dataset}")
+                )
+
+    if not new_datasets:
+        return
+
+    slugs = generate_unique_slugs(
+        ProductRaster, [dataset.name for dataset in new_datasets], "slug"
+    )
+    for dataset, slug in zip(new_datasets, slugs):
+        dataset.slug = slug
+
+    logging.info(f"saving {len(new_datasets)} datasets")
+    new_datasets = ProductRaster.objects.bulk_create(new_datasets, batch_size=1000)
+
+    # bulk_create skips ProductRaster.save and the post_save signals
+    for dataset in new_datasets:
+        bump_dataset_version(dataset)
+        if settings.HISTOGRAM_SKETCH_LAYERS:
+            async_task("glam.ingest.add_product_sketches", dataset.pk)
+    for product_id in {dataset.product.product_id for dataset in new_datasets}:
+        invalidate_product_dates(product_id)
+    logging.info(f"saved {len(new_datasets)} datasets")
 
 
 def add_baseline_rasters_from_storage():
@@ -362,12 +397,227 @@ def create_boundary_features_from_layer(layer_id, id_field=None, name_field="nam
             )
             new_boundary_feature.save()
             logging.info(f"Saved feature {feature['properties'][name_field]}")
+
+        # chained so the coverage masks are rasterized from the simplified
+        # geometries
+        queue_layer_tasks(valid_layer.layer_id)
     except BoundaryLayer.DoesNotExist as e:
         logging.info(
             f"{slugify(layer_id)} is not a valid boundary layer within the system."
         )
 
 
+def save_feature_coverage(cropmask_raster, boundary_features):
+    """
+    Compute and store the cropland coverage of each boundary feature
+    within a CropmaskRaster.
+    :param cropmask_raster: CropmaskRaster instance
+    :param boundary_features: iterable of BoundaryFeature instances
+    :return: number of coverage records saved
+    """
+    coverage = []
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS):
+        with rasterio.open(get_raster_path(cropmask_raster.file_object)) as src:
+            for feature in boundary_features:
+                arable_pixels, total_pixels, crop_weight = feature_coverage(
+                    get_feature_mask(src, feature), src
+                )
+                coverage.append(
+                    FeatureCropCoverage(
+                        boundary_feature=feature,
+                        cropmask_raster=cropmask_raster,
+                        arable_pixels=arable_pixels,
+                        total_pixels=total_pixels,
+                        crop_weight=crop_weight,
+                    )
+                )
+
+    FeatureCropCoverage.objects.bulk_create(
+        coverage,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=["boundary_feature", "cropmask_raster"],
+        update_fields=["arable_pixels", "total_pixels", "crop_weight", "date_updated"],
+    )
+    return len(coverage)
+
+
+def add_cropmask_coverage(cropmask_raster_id):
+    """
+    Compute feature coverage of a CropmaskRaster for every boundary feature.
+    Queued when a CropmaskRaster is created.
+    :param cropmask_raster_id: primary key of the CropmaskRaster instance
+    :return: None
+    """
+    cropmask_raster = CropmaskRaster.objects.get(pk=cropmask_raster_id)
+    for layer in BoundaryLayer.objects.all():
+        features = BoundaryFeature.objects.filter(boundary_layer=layer).iterator()
+        count = save_feature_coverage(cropmask_raster, features)
+        logging.info(f"Saved {count} {layer.layer_id} coverage for {cropmask_raster}")
+
+
+def add_layer_coverage(layer_id):
+    """
+    Compute feature coverage of a BoundaryLayer for every CropmaskRaster.
+    Queued when boundary features are ingested.
+    :param layer_id: a unique identifier for the BoundaryLayer instance.
+    :return: None
+    """
+    layer = BoundaryLayer.objects.get(layer_id=layer_id)
+    features = list(BoundaryFeature.objects.filter(boundary_layer=layer))
+    for cropmask_raster in CropmaskRaster.objects.all():
+        count = save_feature_coverage(cropmask_raster, features)
+        logging.info(f"Saved {count} {layer_id} coverage for {cropmask_raster}")
+
+
+def queue_layer_tasks(layer_id):
+    """
+    Queue the simplified geometries and then the crop coverage of a newly
+    ingested BoundaryLayer, in that order.
+    """
+    async_chain(
+        [
+            ("glam.ingest.add_layer_geometries", (layer_id,)),
+            ("glam.ingest.add_layer_coverage", (layer_id,)),
+        ]
+    )
+
+
+def add_layer_geometries(layer_id):
+    """
+    Compute the simplified geometries of every feature of a BoundaryLayer.
+    Queued when boundary features are ingested.
+    :param layer_id: a unique identifier for the BoundaryLayer instance.
+    :return: None
+    """
+    features = BoundaryFeature.objects.filter(boundary_layer__layer_id=layer_id)
+    count = save_simplified_geometries(features.iterator())
+    logging.info(f"Saved {count} simplified geometries for {layer_id}")
+
+
+def add_feature_geometries(boundary_feature_id):
+    """
+    Recompute the simplified geometries of a BoundaryFeature, then its crop
+    coverage and histogram sketches, which are computed from them.
+    Queued when an existing boundary feature is saved.
+    :param boundary_feature_id: primary key of the BoundaryFeature instance
+    :return: None
+    """
+    feature = BoundaryFeature.objects.select_related("boundary_layer").get(
+        pk=boundary_feature_id
+    )
+    save_simplified_geometries([feature])
+    # masks cached since the feature was saved used the old simplified shape
+    bump_dataset_version(feature)
+
+    for cropmask_raster in CropmaskRaster.objects.all():
+        save_feature_coverage(cropmask_raster, [feature])
+
+    if feature.boundary_layer.layer_id in settings.HISTOGRAM_SKETCH_LAYERS:
+        # histograms are read from the rasters until the sketches are rebuilt
+        FeatureHistogramSketch.objects.filter(boundary_feature=feature).delete()
+        async_task("glam.ingest.add_feature_sketches", feature.pk)
+
+
+def add_feature_sketches(boundary_feature_id):
+    """
+    Compute the histogram sketches of a BoundaryFeature for every
+    ProductRaster. Queued when a feature of a HISTOGRAM_SKETCH_LAYERS layer
+    is edited.
+    :param boundary_feature_id: primary key of the BoundaryFeature instance
+    :return: None
+    """
+    feature = BoundaryFeature.objects.get(pk=boundary_feature_id)
+    cropmask_rasters = {}
+    count = 0
+    for product_raster in ProductRaster.objects.select_related("product"):
+        if product_raster.product_id not in cropmask_rasters:
+            cropmask_rasters[product_raster.product_id] = list(
+                CropmaskRaster.objects.filter(product=product_raster.product)
+            )
+        count += save_histogram_sketches(
+            product_raster, [feature], cropmask_rasters[product_raster.product_id]
+        )
+    logging.info(f"Saved {count} sketches for {feature}")
+
+
+def save_histogram_sketches(product_raster, boundary_features, cropmask_rasters):
+    """
+    Compute and store the histogram sketch of a ProductRaster over each
+    boundary feature, unmasked and weighted by each CropmaskRaster.
+    Existing sketches of the dataset and features are replaced.
+    :param product_raster: ProductRaster instance
+    :param boundary_features: list of BoundaryFeature instances
+    :param cropmask_rasters: list of CropmaskRaster instances of the product
+    :return: number of sketches saved
+    """
+    sketches = []
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS), ExitStack() as stack:
+        sources = open_datasets(stack, product_raster, *cropmask_rasters)
+        product_src = sources[0]
+
+        value_range = sketch_range(product_raster.product)
+        if value_range is None:
+            logging.info(
+                f"{product_raster.product} has no valid_range, skipping sketches"
+            )
+            return 0
+
+        for feature in boundary_features:
+            feature_mask = get_feature_mask(product_src, feature)
+            for cropmask_raster, mask_src in zip(
+                [None, *cropmask_rasters], [None, *sources[1:]]
+            ):
+                hist, bin_edges = feature_histogram(
+                    feature_mask,
+                    product_src,
+                    mask_src,
+                    bins=settings.HISTOGRAM_SKETCH_BINS,
+                    range=value_range,
+                )
+                sketches.append(
+                    FeatureHistogramSketch(
+                        product_raster=product_raster,
+                        boundary_feature=feature,
+                        cropmask_raster=cropmask_raster,
+                        range_min=value_range[0],
+                        range_max=value_range[1],
+                        counts=np.asarray(hist, dtype="float64").tobytes(),
+                    )
+                )
+
+    # unmasked sketches are not covered by the unique constraint used for
+    # upserts (null cropmask), so replace rather than update
+    with transaction.atomic():
+        FeatureHistogramSketch.objects.filter(
+            product_raster=product_raster, boundary_feature__in=boundary_features
+        ).delete()
+        FeatureHistogramSketch.objects.bulk_create(sketches, batch_size=1000)
+    return len(sketches)
+
+
+def add_product_sketches(product_raster_id):
+    """
+    Compute histogram sketches of a ProductRaster for every feature of the
+    HISTOGRAM_SKETCH_LAYERS boundary layers. Queued whenever a dataset file is stored.
+    :param product_raster_id: primary key of the ProductRaster instance
+    :return: None
+    """
+    product_raster = ProductRaster.objects.select_related("product").get(
+        pk=product_raster_id
+    )
+    cropmask_rasters = list(
+        CropmaskRaster.objects.filter(product=product_raster.product)
+    )
+    layers = BoundaryLayer.objects.filter(
+        layer_id__in=settings.HISTOGRAM_SKETCH_LAYERS
+    )
+    for layer in layers:
+        features = list(BoundaryFeature.objects.filter(boundary_layer=layer))
+        count = save_histogram_sketches(product_raster, features, cropmask_rasters)
+        logging.info(f"Saved {count} {layer.layer_id} sketches for {product_raster}")
+
+
 def create_matching_mask_raster(product_id, cropmask_id):
     """
     function to create a resampled cropmask raster dataset that mathches size and resolution of product raster for zonal statistics calculation
@@ -671,6 +921,11 @@ def ingest_geoboundaries_features(adm_level=None, dry_run=False):
                         f"Unable to save features from {layer.source_data} : {e}"
                     )
 
+            if not dry_run:
+                # chained so the coverage masks are rasterized from the simplified
+                # geometries
+                queue_layer_tasks(layer.layer_id)
+
     if not dry_run:
         logging.info(f"Added {new_features_count} new features.")
     else:
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.17 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('glam', '0004_alter_boundarylayer_source_data_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureCropCoverage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('arable_pixels', models.BigIntegerField(help_text='Number of feature pixels with a crop mask value above zero.')),
+                ('total_pixels', models.BigIntegerField(help_text='Number of pixels within the feature.')),
+                ('crop_weight', models.FloatField(help_text='Sum of crop mask values within the feature (equal to arable_pixels for binary masks).')),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+                ('boundary_feature', models.ForeignKey(help_text='Boundary feature the coverage was computed for.', on_delete=django.db.models.deletion.CASCADE, related_name='crop_coverage', to='glam.boundaryfeature')),
+                ('cropmask_raster', models.ForeignKey(help_text='Crop mask dataset the coverage was computed from.', on_delete=django.db.models.deletion.CASCADE, related_name='feature_coverage', to='glam.cropmaskraster')),
+            ],
+            options={
+                'verbose_name': 'feature crop coverage',
+                'verbose_name_plural': 'feature crop coverage',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='featurecropcoverage',
+            constraint=models.UniqueConstraint(fields=('boundary_feature', 'cropmask_raster'), name='unique_feature_cropmask_coverage'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.17 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('glam', '0005_featurecropcoverage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureHistogramSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('range_min', models.FloatField(help_text='Lower edge of the first bin (unscaled product units).')),
+                ('range_max', models.FloatField(help_text='Upper edge of the last bin (unscaled product units).')),
+                ('counts', models.BinaryField(help_text='Weighted pixel count of each bin as float64 values.')),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+                ('boundary_feature', models.ForeignKey(help_text='Boundary feature the sketch was computed for.', on_delete=django.db.models.deletion.CASCADE, related_name='histogram_sketches', to='glam.boundaryfeature')),
+                ('cropmask_raster', models.ForeignKey(blank=True, help_text='Crop mask dataset weighting the sketch. Empty for no mask.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='histogram_sketches', to='glam.cropmaskraster')),
+                ('product_raster', models.ForeignKey(help_text='Product dataset the sketch was computed from.', on_delete=django.db.models.deletion.CASCADE, related_name='histogram_sketches', to='glam.productraster')),
+            ],
+            options={
+                'verbose_name': 'feature histogram sketch',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='featurehistogramsketch',
+            constraint=models.UniqueConstraint(fields=('product_raster', 'boundary_feature', 'cropmask_raster'), name='unique_feature_histogram_sketch'),
+        ),
+        migrations.AddConstraint(
+            model_name='featurehistogramsketch',
+            constraint=models.UniqueConstraint(condition=models.Q(('cropmask_raster__isnull', True)), fields=('product_raster', 'boundary_feature'), name='unique_feature_histogram_sketch_no_mask'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.17 on 2026-10-19 12:00
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('glam', '0006_featurehistogramsketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimplifiedFeatureGeometry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tolerance', models.FloatField(help_text='Simplification tolerance in degrees (EPSG:4326).')),
+                ('geom', django.contrib.gis.db.models.fields.MultiPolygonField(srid=4326)),
+                ('num_points', models.IntegerField(help_text='Number of vertices.')),
+                ('xmin', models.FloatField()),
+                ('ymin', models.FloatField()),
+                ('xmax', models.FloatField()),
+                ('ymax', models.FloatField()),
+                ('area', models.FloatField(help_text='Planar area in square degrees.')),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+                ('boundary_feature', models.ForeignKey(help_text='Boundary feature the geometry was simplified from.', on_delete=django.db.models.deletion.CASCADE, related_name='simplified_geometries', to='glam.boundaryfeature')),
+            ],
+            options={
+                'verbose_name': 'simplified feature geometry',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='simplifiedfeaturegeometry',
+            constraint=models.UniqueConstraint(fields=('boundary_feature', 'tolerance'), name='unique_simplified_feature_geometry'),
+        ),
+    ]
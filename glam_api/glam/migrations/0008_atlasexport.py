@@ -0,0 +1,29 @@
+# Generated by Django 4.2.17 on 2026-10-19 12:00
+
+import config.storage
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('glam', '0007_simplifiedfeaturegeometry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AtlasExport',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, help_text='Unique id for atlas', primary_key=True, serialize=False)),
+                ('started', models.DateTimeField(auto_now_add=True, help_text='Date/Time atlas started.')),
+                ('completed', models.DateTimeField(blank=True, help_text='Date/Time atlas completed.', null=True)),
+                ('feature_count', models.IntegerField(default=0, help_text='Number of boundary features in the atlas.')),
+                ('features_rendered', models.IntegerField(default=0, help_text='Number of feature graphics rendered so far.')),
+                ('file_object', models.FileField(blank=True, help_text='ZIP of the feature graphics (PNG).', storage=config.storage.RasterStorage(), upload_to='atlases')),
+            ],
+            options={
+                'verbose_name': 'atlas export',
+            },
+        ),
+    ]
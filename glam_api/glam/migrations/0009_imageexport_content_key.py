@@ -0,0 +1,18 @@
+# Generated by Django 4.2.17 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('glam', '0008_atlasexport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageexport',
+            name='content_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Hash of the export parameters and dataset versions.', max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.17 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+def set_export_status(apps, schema_editor):
+    ImageExport = apps.get_model('glam', 'ImageExport')
+    ImageExport.objects.filter(completed__isnull=False).update(
+        status='completed', progress=1
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('glam', '0009_imageexport_content_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageexport',
+            name='bytes_written',
+            field=models.BigIntegerField(default=0, help_text='Size in bytes of the export file written so far.'),
+        ),
+        migrations.AddField(
+            model_name='imageexport',
+            name='cancel_requested',
+            field=models.BooleanField(default=False, help_text='Set to stop the export job at its next block.'),
+        ),
+        migrations.AddField(
+            model_name='imageexport',
+            name='error',
+            field=models.TextField(blank=True, help_text='Error of a failed export.', null=True),
+        ),
+        migrations.AddField(
+            model_name='imageexport',
+            name='progress',
+            field=models.FloatField(default=0, help_text='Fraction of the export blocks processed.'),
+        ),
+        migrations.AddField(
+            model_name='imageexport',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('uploading', 'Uploading'), ('completed', 'Completed'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', help_text='Export job status.', max_length=16),
+        ),
+        migrations.RunPython(set_export_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.17 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+def set_atlas_status(apps, schema_editor):
+    AtlasExport = apps.get_model('glam', 'AtlasExport')
+    AtlasExport.objects.filter(completed__isnull=False).update(status='completed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('glam', '0010_imageexport_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='atlasexport',
+            name='error',
+            field=models.TextField(blank=True, help_text='Error of a failed atlas.', null=True),
+        ),
+        migrations.AddField(
+            model_name='atlasexport',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='queued', help_text='Atlas job status.', max_length=16),
+        ),
+        migrations.RunPython(set_atlas_status, migrations.RunPython.noop),
+    ]
@@ -2,6 +2,8 @@ import os
 import datetime
 import uuid
 
+import numpy as np
+
 from django.conf import settings
 from django.db import models
 from django.contrib.gis.db import models as geomodels
@@ -527,6 +529,7 @@ class ProductRaster(models.Model):
             self.save()
 
     def save(self, *args, **kwargs):
+        created = self.pk is None
 
         if not self.name:
             # generate name
@@ -548,8 +551,16 @@ class ProductRaster(models.Model):
             # trigger baseline refresh/recalculation
             # queue_baseline_update(self.product, self.date)
 
+        # a newly assigned file (new dataset or re-upload) is not yet stored
+        file_changed = bool(self.file_object) and not self.file_object._committed
+
         super().save(*args, **kwargs)
 
+        if file_changed and settings.HISTOGRAM_SKETCH_LAYERS:
+            # sketches of the previous file must not be served meanwhile
+            FeatureHistogramSketch.objects.filter(product_raster=self).delete()
+            async_task("glam.ingest.add_product_sketches", self.pk)
+
     class Meta:
         verbose_name = "product dataset"
 
@@ -654,10 +665,169 @@ class CropmaskRaster(models.Model):
 
         self.upload_file(created)
 
+        if created:
+            async_task("glam.ingest.add_cropmask_coverage", self.pk)
+
     class Meta:
         verbose_name = "crop mask dataset"
 
 
+class FeatureCropCoverage(models.Model):
+    """
+    Cropland coverage of a Boundary Feature within a Crop Mask dataset.
+    Precomputed when crop mask datasets or boundary features are ingested.
+
+    """
+
+    boundary_feature = models.ForeignKey(
+        BoundaryFeature,
+        related_name="crop_coverage",
+        on_delete=models.CASCADE,
+        help_text="Boundary feature the coverage was computed for.",
+    )
+    cropmask_raster = models.ForeignKey(
+        CropmaskRaster,
+        related_name="feature_coverage",
+        on_delete=models.CASCADE,
+        help_text="Crop mask dataset the coverage was computed from.",
+    )
+    arable_pixels = models.BigIntegerField(
+        help_text="Number of feature pixels with a crop mask value above zero."
+    )
+    total_pixels = models.BigIntegerField(
+        help_text="Number of pixels within the feature."
+    )
+    crop_weight = models.FloatField(
+        help_text="Sum of crop mask values within the feature "
+        "(equal to arable_pixels for binary masks)."
+    )
+    date_updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def percent_arable(self):
+        if not self.total_pixels:
+            return 0.0
+        return self.arable_pixels / self.total_pixels * 100
+
+    class Meta:
+        verbose_name = "feature crop coverage"
+        verbose_name_plural = "feature crop coverage"
+
+        constraints = [
+            models.UniqueConstraint(
+                fields=["boundary_feature", "cropmask_raster"],
+                name="unique_feature_cropmask_coverage",
+            )
+        ]
+
+
+class FeatureHistogramSketch(models.Model):
+    """
+    Fine fixed-bin histogram of a Product Dataset over a Boundary Feature,
+    weighted by a Crop Mask dataset (if any). Computed when the dataset is
+    ingested; coarser histograms, counts and quantiles are derived from it
+    without reading rasters. Sketches of a product share their bins so they
+    can be merged across dates and features.
+
+    """
+
+    product_raster = models.ForeignKey(
+        ProductRaster,
+        related_name="histogram_sketches",
+        on_delete=models.CASCADE,
+        help_text="Product dataset the sketch was computed from.",
+    )
+    boundary_feature = models.ForeignKey(
+        BoundaryFeature,
+        related_name="histogram_sketches",
+        on_delete=models.CASCADE,
+        help_text="Boundary feature the sketch was computed for.",
+    )
+    cropmask_raster = models.ForeignKey(
+        CropmaskRaster,
+        related_name="histogram_sketches",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        help_text="Crop mask dataset weighting the sketch. Empty for no mask.",
+    )
+    range_min = models.FloatField(
+        help_text="Lower edge of the first bin (unscaled product units)."
+    )
+    range_max = models.FloatField(
+        help_text="Upper edge of the last bin (unscaled product units)."
+    )
+    counts = models.BinaryField(
+        help_text="Weighted pixel count of each bin as float64 values."
+    )
+    date_updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def histogram(self):
+        return np.frombuffer(bytes(self.counts), dtype="float64")
+
+    @property
+    def value_range(self):
+        return (self.range_min, self.range_max)
+
+    class Meta:
+        verbose_name = "feature histogram sketch"
+
+        constraints = [
+            models.UniqueConstraint(
+                fields=["product_raster", "boundary_feature", "cropmask_raster"],
+                name="unique_feature_histogram_sketch",
+            ),
+            models.UniqueConstraint(
+                fields=["product_raster", "boundary_feature"],
+                condition=models.Q(cropmask_raster__isnull=True),
+                name="unique_feature_histogram_sketch_no_mask",
+            ),
+        ]
+
+
+class SimplifiedFeatureGeometry(models.Model):
+    """
+    Boundary Feature geometry simplified at one of the
+    FEATURE_SIMPLIFY_TOLERANCES, with its bounding box and area.
+    Computed when boundary features are ingested; endpoints use the
+    coarsest geometry that is still exact at their pixel size.
+
+    """
+
+    boundary_feature = models.ForeignKey(
+        BoundaryFeature,
+        related_name="simplified_geometries",
+        on_delete=models.CASCADE,
+        help_text="Boundary feature the geometry was simplified from.",
+    )
+    tolerance = models.FloatField(
+        help_text="Simplification tolerance in degrees (EPSG:4326)."
+    )
+    geom = geomodels.MultiPolygonField()
+    num_points = models.IntegerField(help_text="Number of vertices.")
+    xmin = models.FloatField()
+    ymin = models.FloatField()
+    xmax = models.FloatField()
+    ymax = models.FloatField()
+    area = models.FloatField(help_text="Planar area in square degrees.")
+    date_updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def extent(self):
+        return (self.xmin, self.ymin, self.xmax, self.ymax)
+
+    class Meta:
+        verbose_name = "simplified feature geometry"
+
+        constraints = [
+            models.UniqueConstraint(
+                fields=["boundary_feature", "tolerance"],
+                name="unique_simplified_feature_geometry",
+            ),
+        ]
+
+
 class AnomalyBaselineRaster(models.Model):
     """
     Model to store Baseline Datasets for anomaly calculation
@@ -804,6 +974,22 @@ class ImageExport(models.Model):
 
     """
 
+    QUEUED = "queued"
+    RUNNING = "running"
+    UPLOADING = "uploading"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (UPLOADING, "Uploading"),
+        (COMPLETED, "Completed"),
+        (FAILED, "Failed"),
+        (CANCELLED, "Cancelled"),
+    ]
+    ACTIVE_STATUSES = [QUEUED, RUNNING, UPLOADING]
+
     id = models.UUIDField(
         primary_key=True,
         default=uuid.uuid4,
@@ -816,6 +1002,33 @@ class ImageExport(models.Model):
     completed = models.DateTimeField(
         null=True, blank=True, help_text="Date/Time export completed."
     )
+    content_key = models.CharField(
+        max_length=40,
+        null=True,
+        blank=True,
+        db_index=True,
+        editable=False,
+        help_text="Hash of the export parameters and dataset versions.",
+    )
+    status = models.CharField(
+        max_length=16,
+        choices=STATUS_CHOICES,
+        default=QUEUED,
+        help_text="Export job status.",
+    )
+    progress = models.FloatField(
+        default=0, help_text="Fraction of the export blocks processed."
+    )
+    bytes_written = models.BigIntegerField(
+        default=0, help_text="Size in bytes of the export file written so far."
+    )
+    error = models.TextField(
+        null=True, blank=True, help_text="Error of a failed export."
+    )
+    cancel_requested = models.BooleanField(
+        default=False,
+        help_text="Set to stop the export job at its next block.",
+    )
     file_object = models.FileField(
         upload_to="exports",
         storage=raster_storage,
@@ -826,3 +1039,59 @@ class ImageExport(models.Model):
 
     class Meta:
         verbose_name = "image export"
+
+
+class AtlasExport(models.Model):
+    """
+    Model to store atlas exports: a ZIP of the graphics of every feature of
+    a boundary layer (or tag) for one product date
+
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (COMPLETED, "Completed"),
+        (FAILED, "Failed"),
+    ]
+
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False,
+        help_text="Unique id for atlas",
+    )
+    started = models.DateTimeField(
+        auto_now_add=True, help_text="Date/Time atlas started."
+    )
+    completed = models.DateTimeField(
+        null=True, blank=True, help_text="Date/Time atlas completed."
+    )
+    feature_count = models.IntegerField(
+        default=0, help_text="Number of boundary features in the atlas."
+    )
+    features_rendered = models.IntegerField(
+        default=0, help_text="Number of feature graphics rendered so far."
+    )
+    status = models.CharField(
+        max_length=16,
+        choices=STATUS_CHOICES,
+        default=QUEUED,
+        help_text="Atlas job status.",
+    )
+    error = models.TextField(
+        null=True, blank=True, help_text="Error of a failed atlas."
+    )
+    file_object = models.FileField(
+        upload_to="atlases",
+        storage=raster_storage,
+        blank=True,
+        help_text="ZIP of the feature graphics (PNG).",
+    )
+
+    class Meta:
+        verbose_name = "atlas export"
@@ -26,6 +26,13 @@ RESPONSE_ERROR = (
 )
 
 
+def cropmask_display_name(cropmask_id):
+    """Display name of a crop mask, 'No Mask' for unmasked results"""
+    if not cropmask_id or cropmask_id == 'no-mask':
+        return 'No Mask'
+    return CropMask.objects.get(cropmask_id=cropmask_id).display_name
+
+
 class OldGLAMBaseZStatsRenderer(BaseRenderer):
     """
     Renders DataFrames using their built in pandas implementation.
@@ -56,21 +63,20 @@ class OldGLAMBaseZStatsRenderer(BaseRenderer):
         today = datetime.date.today()
 
         product = Product.objects.get(product_id=product_id)
-        product_name = product.pt_display_name
+        product_name = product.display_name
         composite = product.composite_period - 1
 
         boundary_layer = BoundaryLayer.objects.get(layer_id=layer_id)
-        boundary_layer_name = boundary_layer.pt_display_name
+        boundary_layer_name = boundary_layer.display_name
 
         boundary_feature = BoundaryFeature.objects.get(
             feature_id=feature_id, boundary_layer=boundary_layer)
         boundary_feature_name = boundary_feature.feature_name
 
-        cropmask = CropMask.objects.get(cropmask_id=cropmask_id)
-        cropmask_name = cropmask.pt_display_name
+        cropmask_name = cropmask_display_name(cropmask_id)
 
         data.index.name = None
-        new_df = data.drop('percent_arable', 1).drop('arable_pixels', 1)
+        new_df = data.drop(['percent_arable', 'arable_pixels'], axis=1)
         new_df['doy'] = pd.to_datetime(
             new_df['date'], format='%Y-%m-%d').dt.dayofyear
         new_df['new_date'] = pd.to_datetime(new_df['date'])
@@ -96,7 +102,7 @@ class OldGLAMBaseZStatsRenderer(BaseRenderer):
             '2021'+'-'+x['enddoy'].astype(str), format='%Y-%j')
         x['End Day'] = end_day.dt.day.astype(str)+'-'+end_day.dt.strftime("%b")
 
-        z = x.drop('doy', 1).drop('enddoy', 1)
+        z = x.drop(['doy', 'enddoy'], axis=1)
         c = ['Start Day', 'End Day']
         c += [year for year in years]
         z = z[c]
@@ -184,21 +190,20 @@ class OldGLAMBaseHistRenderer(BaseRenderer):
             layer_id = params['layer_id']
             feature_id = params['feature_id']
             boundary_layer = BoundaryLayer.objects.get(layer_id=layer_id)
-            boundary_layer_name = boundary_layer.pt_display_name
+            boundary_layer_name = boundary_layer.display_name
             boundary_feature = BoundaryFeature.objects.get(
                 feature_id=feature_id, boundary_layer=boundary_layer)
             boundary_feature_name = boundary_feature.feature_name
 
         product_id = params['product_id']
-        cropmask_id = params['cropmask_id']
+        cropmask_id = params.get('cropmask_id')
         date = params['date']
         today = datetime.date.today()
 
         product = Product.objects.get(product_id=product_id)
-        product_name = product.pt_display_name
+        product_name = product.display_name
 
-        cropmask = CropMask.objects.get(cropmask_id=cropmask_id)
-        cropmask_name = cropmask.pt_display_name
+        cropmask_name = cropmask_display_name(cropmask_id)
 
         bins = data.iloc[0]
         bin_edges = bins['bin_edges']
@@ -5,6 +5,7 @@ from rest_pandas.serializers import PandasSerializer
 from rio_tiler.colormap import cmap
 
 from .models import (
+    AtlasExport,
     DataSource,
     ImageExport,
     Product,
@@ -20,6 +21,8 @@ from .models import (
 
 AVAILABLE_CMAPS = cmap.list() + ["ndvi"]
 
+RESOLUTION_CHOICES = ["auto", "full", "preview"]
+
 
 class TagSerializer(serializers.ModelSerializer):
     class Meta:
@@ -146,6 +149,7 @@ class FeatureResponseSerializer(serializers.Serializer):
     min = serializers.FloatField()
     max = serializers.FloatField()
     std = serializers.FloatField()
+    resolution = serializers.CharField()
 
 
 class HistogramResponseSerializer(serializers.Serializer):
@@ -248,6 +252,12 @@ class FeatureBodySerializer(serializers.Serializer):
         choices=AVAILABLE_CROPMASKS, required=False, allow_null=True
     )
     format = serializers.CharField(required=False, allow_null=True)
+    resolution = serializers.ChoiceField(
+        choices=RESOLUTION_CHOICES, required=False, default="auto"
+    )
+    time_budget = serializers.FloatField(
+        required=False, allow_null=True, min_value=0.1
+    )
 
     # class Meta:
     #     list_serializer_class = PandasSerializer
@@ -339,9 +349,15 @@ class GraphicBodySerializer(serializers.Serializer):
     legend = serializers.ChoiceField(
         choices=BOOL_CHOICES, required=False, allow_null=True
     )
+    time_budget = serializers.FloatField(
+        required=False, allow_null=True, min_value=0.1
+    )
     size = serializers.ChoiceField(
         choices=SIZE_CHOICES, required=False, allow_null=True
     )
+    renderer = serializers.ChoiceField(
+        choices=["fast", "matplotlib"], required=False, default="fast"
+    )
     format = serializers.CharField(required=False, allow_null=True)
 
     # class Meta:
@@ -434,6 +450,13 @@ class HistogramBodySerializer(serializers.Serializer):
     add_years = serializers.ListField(
         required=False, child=serializers.IntegerField(), allow_null=True
     )
+    resolution = serializers.ChoiceField(
+        choices=RESOLUTION_CHOICES, required=False, default="auto"
+    )
+    time_budget = serializers.FloatField(
+        required=False, allow_null=True, min_value=0.1
+    )
+    stream = serializers.BooleanField(required=False, default=False)
 
 
 class HistogramGETSerializer(serializers.Serializer):
@@ -470,6 +493,7 @@ class HistogramGETSerializer(serializers.Serializer):
     anomaly_type = serializers.ChoiceField(
         choices=ANOMALY_TYPE_CHOICES, required=False, allow_null=True
     )
+    diff_year = serializers.IntegerField(required=False, allow_null=True)
     cropmask_id = serializers.ChoiceField(
         choices=AVAILABLE_CROPMASKS, required=False, allow_null=True
     )
@@ -479,6 +503,13 @@ class HistogramGETSerializer(serializers.Serializer):
     density = serializers.BooleanField(required=False, default=False, allow_null=True)
     format = serializers.CharField(required=False, allow_null=True)
     add_years = serializers.CharField(required=False, allow_null=True)
+    resolution = serializers.ChoiceField(
+        choices=RESOLUTION_CHOICES, required=False, default="auto"
+    )
+    time_budget = serializers.FloatField(
+        required=False, allow_null=True, min_value=0.1
+    )
+    stream = serializers.BooleanField(required=False, default=False)
 
     # class Meta:
     #     list_serializer_class = PandasSerializer
@@ -531,6 +562,20 @@ class ExportBodySerializer(serializers.Serializer):
                 }\
             } ',
     )
+    end_date = serializers.DateField(
+        required=False,
+        allow_null=True,
+        help_text="Export every dataset from date to end_date as one NetCDF4 file.",
+    )
+
+    def validate(self, data):
+        """
+        Check that end_date is not before date
+        """
+        if data.get("end_date") and data["end_date"] < data["date"]:
+            raise serializers.ValidationError("end_date must not be before date")
+
+        return data
 
 
 class ExportSerializer(serializers.ModelSerializer):
@@ -539,6 +584,154 @@ class ExportSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
+class LayerExportBodySerializer(serializers.Serializer):
+    AVAILABLE_CROPMASKS = list()
+    AVAILABLE_PRODUCTS = list()
+    ANOMALY_LENGTH_CHOICES = list()
+    ANOMALY_TYPE_CHOICES = list()
+
+    try:
+        products = Product.objects.all()
+        for c in products:
+            AVAILABLE_PRODUCTS.append(c.product_id)
+    except:
+        pass
+
+    try:
+        for length in AnomalyBaselineRaster.BASELINE_LENGTH_CHOICES:
+            ANOMALY_LENGTH_CHOICES.append(length[0])
+        for type in AnomalyBaselineRaster.BASELINE_TYPE_CHOICES:
+            ANOMALY_TYPE_CHOICES.append(type[0])
+        ANOMALY_TYPE_CHOICES.append("diff")
+    except:
+        pass
+
+    try:
+        cropmasks = CropMask.objects.all()
+        for c in cropmasks:
+            AVAILABLE_CROPMASKS.append(c.cropmask_id)
+    except:
+        pass
+
+    product_id = serializers.ChoiceField(choices=AVAILABLE_PRODUCTS, required=True)
+    date = serializers.DateField()
+    cropmask_id = serializers.ChoiceField(
+        choices=AVAILABLE_CROPMASKS + ["no-mask"], required=False, default="no-mask"
+    )
+    layer_id = serializers.SlugField(
+        required=False, allow_null=True, help_text="Boundary layer to export."
+    )
+    tag = serializers.CharField(
+        required=False,
+        allow_null=True,
+        help_text="Export the features of every boundary layer with this tag.",
+    )
+    parent_layer_id = serializers.SlugField(
+        required=False,
+        allow_null=True,
+        help_text="Boundary layer of the parent feature.",
+    )
+    parent_feature_id = serializers.IntegerField(
+        required=False,
+        allow_null=True,
+        help_text="Only export the features within this feature.",
+    )
+    anomaly = serializers.ChoiceField(
+        choices=ANOMALY_LENGTH_CHOICES, required=False, allow_null=True
+    )
+    anomaly_type = serializers.ChoiceField(
+        choices=ANOMALY_TYPE_CHOICES, required=False, allow_null=True
+    )
+    diff_year = serializers.IntegerField(required=False, allow_null=True)
+
+    def validate(self, data):
+        """
+        Check that a boundary layer or tag is given, and a whole parent feature
+        """
+        if not data.get("layer_id") and not data.get("tag"):
+            raise serializers.ValidationError("Provide a layer_id or a tag")
+        if bool(data.get("parent_layer_id")) != (
+            data.get("parent_feature_id") is not None
+        ):
+            raise serializers.ValidationError(
+                "Provide both parent_layer_id and parent_feature_id"
+            )
+
+        return data
+
+
+class AtlasBodySerializer(serializers.Serializer):
+    AVAILABLE_CROPMASKS = list()
+    AVAILABLE_PRODUCTS = list()
+    ANOMALY_LENGTH_CHOICES = list()
+    ANOMALY_TYPE_CHOICES = list()
+    SIZE_CHOICES = ["tiny", "small", "regular", "large", "xlarge"]
+
+    try:
+        products = Product.objects.all()
+        for c in products:
+            AVAILABLE_PRODUCTS.append(c.product_id)
+    except:
+        pass
+
+    try:
+        for length in AnomalyBaselineRaster.BASELINE_LENGTH_CHOICES:
+            ANOMALY_LENGTH_CHOICES.append(length[0])
+        for type in AnomalyBaselineRaster.BASELINE_TYPE_CHOICES:
+            ANOMALY_TYPE_CHOICES.append(type[0])
+        ANOMALY_TYPE_CHOICES.append("diff")
+    except:
+        pass
+
+    try:
+        cropmasks = CropMask.objects.all()
+        for c in cropmasks:
+            AVAILABLE_CROPMASKS.append(c.cropmask_id)
+    except:
+        pass
+
+    product_id = serializers.ChoiceField(choices=AVAILABLE_PRODUCTS, required=True)
+    date = serializers.DateField()
+    cropmask_id = serializers.ChoiceField(
+        choices=AVAILABLE_CROPMASKS + ["no-mask"], required=False, default="no-mask"
+    )
+    layer_id = serializers.SlugField(
+        required=False, allow_null=True, help_text="Boundary layer to render."
+    )
+    tag = serializers.CharField(
+        required=False,
+        allow_null=True,
+        help_text="Render the features of every boundary layer with this tag.",
+    )
+    anomaly = serializers.ChoiceField(
+        choices=ANOMALY_LENGTH_CHOICES, required=False, allow_null=True
+    )
+    anomaly_type = serializers.ChoiceField(
+        choices=ANOMALY_TYPE_CHOICES, required=False, allow_null=True
+    )
+    diff_year = serializers.IntegerField(required=False, allow_null=True)
+    label = serializers.BooleanField(required=False, default=True)
+    legend = serializers.BooleanField(required=False, default=True)
+    size = serializers.ChoiceField(
+        choices=SIZE_CHOICES, required=False, default="regular"
+    )
+
+    def validate(self, data):
+        """
+        Check that a boundary layer or tag is given
+        """
+        if not data.get("layer_id") and not data.get("tag"):
+            raise serializers.ValidationError("Provide a layer_id or a tag")
+
+        return data
+
+
+class AtlasExportSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AtlasExport
+        fields = "__all__"
+
+
 class ProductSerializer(serializers.HyperlinkedModelSerializer):
     # datasets = serializers.HyperlinkedRelatedField(
     #     many=True,
@@ -609,9 +802,15 @@ class GraphicSerializer(serializers.Serializer):
     diff_year = serializers.IntegerField(required=False)
     label = serializers.BooleanField(required=False, default=True, allow_null=True)
     legend = serializers.BooleanField(required=False, default=True, allow_null=True)
+    time_budget = serializers.FloatField(
+        required=False, allow_null=True, min_value=0.1
+    )
     size = serializers.ChoiceField(
         choices=SIZE_CHOICES, required=False, default="regular", allow_null=True
     )
+    renderer = serializers.ChoiceField(
+        choices=["fast", "matplotlib"], required=False, default="fast"
+    )
 
 
 class QueryBoundaryFeatureSerializer(serializers.Serializer):
@@ -639,6 +838,28 @@ class QueryBoundaryFeatureSerializer(serializers.Serializer):
     anomaly = serializers.ChoiceField(choices=ANOMALY_LENGTH_CHOICES, required=False)
     anomaly_type = serializers.ChoiceField(choices=ANOMALY_TYPE_CHOICES, required=False)
     diff_year = serializers.IntegerField(required=False)
+    resolution = serializers.ChoiceField(
+        choices=RESOLUTION_CHOICES, required=False, default="auto"
+    )
+    time_budget = serializers.FloatField(
+        required=False, allow_null=True, min_value=0.1
+    )
+
+
+class ZStatsSerializer(serializers.Serializer):
+    start_year = serializers.IntegerField(required=False, allow_null=True)
+    end_year = serializers.IntegerField(required=False, allow_null=True)
+    resolution = serializers.ChoiceField(
+        choices=["full", "preview"], required=False, default="full"
+    )
+    format = serializers.CharField(required=False, allow_null=True)
+
+
+class ZStatsResponseSerializer(serializers.Serializer):
+    date = serializers.DateField()
+    mean_value = serializers.FloatField()
+    percent_arable = serializers.FloatField()
+    arable_pixels = serializers.IntegerField()
 
 
 class ExportBoundaryFeatureSerializer(serializers.Serializer):
@@ -658,6 +879,11 @@ class ExportBoundaryFeatureSerializer(serializers.Serializer):
     anomaly = serializers.ChoiceField(choices=ANOMALY_LENGTH_CHOICES, required=False)
     anomaly_type = serializers.ChoiceField(choices=ANOMALY_TYPE_CHOICES, required=False)
     diff_year = serializers.IntegerField(required=False)
+    end_date = serializers.DateField(
+        required=False,
+        allow_null=True,
+        help_text="Export every dataset from date to end_date as one NetCDF4 file.",
+    )
 
 
 class TilesSerializer(serializers.Serializer):
@@ -0,0 +1,92 @@
+"""
+Signal handlers
+
+"""
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from django_q.tasks import async_task
+
+from .models import (
+    AnomalyBaselineRaster,
+    BoundaryFeature,
+    BoundaryLayer,
+    CropmaskRaster,
+    DataSource,
+    Product,
+    ProductRaster,
+    Tag,
+)
+from .utils.cache import (
+    bump_assets_version,
+    bump_backdrop_version,
+    bump_dataset_version,
+    invalidate_product_dates,
+)
+
+
+@receiver(post_save, sender=ProductRaster)
+@receiver(post_save, sender=CropmaskRaster)
+@receiver(post_save, sender=AnomalyBaselineRaster)
+@receiver(post_delete, sender=ProductRaster)
+@receiver(post_delete, sender=CropmaskRaster)
+@receiver(post_delete, sender=AnomalyBaselineRaster)
+def invalidate_dataset_results(sender, instance, **kwargs):
+    """Cached results computed from a changed dataset are no longer valid"""
+    bump_dataset_version(instance)
+
+
+@receiver(post_save, sender=ProductRaster)
+@receiver(post_delete, sender=ProductRaster)
+def invalidate_product_dates_index(sender, instance, **kwargs):
+    """A product's dataset dates changed"""
+    try:
+        invalidate_product_dates(instance.product.product_id)
+    except Product.DoesNotExist:
+        # deleted along with its product
+        pass
+
+
+@receiver(post_save, sender=BoundaryFeature)
+@receiver(post_save, sender=BoundaryLayer)
+@receiver(post_delete, sender=BoundaryFeature)
+@receiver(post_delete, sender=BoundaryLayer)
+def invalidate_graphic_backdrops(sender, instance, **kwargs):
+    """Cached graphic backdrops may show a changed boundary"""
+    bump_backdrop_version()
+
+
+@receiver(post_save, sender=DataSource)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=BoundaryLayer)
+@receiver(post_delete, sender=DataSource)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=BoundaryLayer)
+def invalidate_graphic_assets(sender, instance, **kwargs):
+    """The logo or the admin levels of boundary layers may have changed"""
+    bump_assets_version()
+
+
+@receiver(m2m_changed, sender=BoundaryLayer.tags.through)
+def invalidate_layer_admin_levels(sender, instance, action, **kwargs):
+    """A boundary layer's tags changed"""
+    if action.startswith("post_"):
+        bump_assets_version()
+
+
+@receiver(post_save, sender=BoundaryFeature)
+@receiver(post_delete, sender=BoundaryFeature)
+def invalidate_feature_masks(sender, instance, **kwargs):
+    """Cached masks of an edited feature have its old shape"""
+    bump_dataset_version(instance)
+
+
+@receiver(post_save, sender=BoundaryFeature)
+def refresh_simplified_geometries(sender, instance, created, **kwargs):
+    """
+    An edited feature's simplified geometries, and the coverage and
+    sketches computed from them, are stale
+    """
+    if not created:
+        async_task("glam.ingest.add_feature_geometries", instance.pk)
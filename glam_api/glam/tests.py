@@ -1,3 +1,268 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
 
-# Create your tests here.
+import numpy as np
+
+import rasterio
+from rasterio import features, windows
+from rasterio.transform import from_origin
+
+from django.test import SimpleTestCase
+
+from .utils.export import (
+    ANOMALY_NODATA,
+    EXPORT_BLOCK_SIZE,
+    write_export,
+    write_layer_exports,
+)
+from .utils.masks import feature_window, rasterize_feature
+from .utils.zonal import zonal_stats
+
+# grid of the test rasters: larger than an export block in both directions
+HEIGHT, WIDTH = 700, 800
+TRANSFORM = from_origin(10, 20, 0.01, 0.01)
+
+PRODUCT_NODATA = -1
+MASK_NODATA = 255
+
+
+def polygon(*points):
+    """GeoJSON polygon of (x, y) points"""
+    return {"type": "Polygon", "coordinates": [[*points, points[0]]]}
+
+
+# a triangle crossing block boundaries and a rectangle within one block row
+TRIANGLE = polygon((10.337, 19.913), (17.561, 18.752), (12.104, 13.346))
+RECTANGLE = polygon(
+    (14.253, 19.871), (16.118, 19.871), (16.118, 18.994), (14.253, 18.994)
+)
+
+
+def write_raster(path, data, nodata):
+    """Write `data` as a tiled single band GeoTIFF on the test grid"""
+    profile = {
+        "driver": "GTiff",
+        "width": WIDTH,
+        "height": HEIGHT,
+        "count": 1,
+        "dtype": data.dtype,
+        "nodata": nodata,
+        "crs": "EPSG:4326",
+        "transform": TRANSFORM,
+        "tiled": True,
+        "blockxsize": 128,
+        "blockysize": 128,
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def inside(geom, shape=(HEIGHT, WIDTH), transform=TRANSFORM):
+    """Pixels whose centers are within `geom`"""
+    return features.geometry_mask(
+        [geom], out_shape=shape, transform=transform, invert=True
+    )
+
+
+class RasterTestCase(SimpleTestCase):
+    """
+    Product, baseline and weighted crop mask rasters with scattered nodata,
+    and the numpy arrays they were written from.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+
+        cls.product = rng.integers(0, 1000, (HEIGHT, WIDTH)).astype("int16")
+        cls.product[rng.random((HEIGHT, WIDTH)) < 0.05] = PRODUCT_NODATA
+        cls.baseline = rng.integers(0, 1000, (HEIGHT, WIDTH)).astype("int16")
+        cls.baseline[rng.random((HEIGHT, WIDTH)) < 0.05] = PRODUCT_NODATA
+        cls.cropmask = rng.integers(0, 4, (HEIGHT, WIDTH)).astype("uint8")
+        cls.cropmask[rng.random((HEIGHT, WIDTH)) < 0.05] = MASK_NODATA
+
+        cls.product_path = write_raster(
+            os.path.join(cls.tmp_dir, "product.tif"), cls.product, PRODUCT_NODATA
+        )
+        cls.baseline_path = write_raster(
+            os.path.join(cls.tmp_dir, "baseline.tif"), cls.baseline, PRODUCT_NODATA
+        )
+        cls.cropmask_path = write_raster(
+            os.path.join(cls.tmp_dir, "cropmask.tif"), cls.cropmask, MASK_NODATA
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def open(self, path):
+        src = rasterio.open(path)
+        self.addCleanup(src.close)
+        return src
+
+    @property
+    def product_valid(self):
+        return self.product != PRODUCT_NODATA
+
+    @property
+    def baseline_valid(self):
+        return self.baseline != PRODUCT_NODATA
+
+    @property
+    def crop(self):
+        """Pixels weighted by the crop mask, nodata excluded"""
+        return (self.cropmask != MASK_NODATA) & (self.cropmask > 0)
+
+    def expected(self, geom, window, nodata, anomaly=False, cropmask=False):
+        """Numpy export of `geom` over `window` of the test grid"""
+        slices = window.toslices()
+        data = self.product[slices]
+        valid = self.product_valid[slices]
+        if anomaly:
+            data = data.astype("float32") - self.baseline[slices]
+            valid &= self.baseline_valid[slices]
+        if cropmask:
+            valid &= self.crop[slices]
+        valid &= inside(
+            geom,
+            shape=(window.height, window.width),
+            transform=windows.transform(window, TRANSFORM),
+        )
+        return np.where(valid, data, nodata).astype(data.dtype)
+
+
+class ZonalStatsTests(RasterTestCase):
+    def assertStats(self, stats, values, weights=None):
+        """Compare RunningStats with the numpy statistics of `values`"""
+        values = values.astype("float64")
+        mean = np.average(values, weights=weights)
+        std = np.sqrt(np.average((values - mean) ** 2, weights=weights))
+        self.assertEqual(stats.count, values.size)
+        self.assertEqual(stats.min, values.min())
+        self.assertEqual(stats.max, values.max())
+        self.assertAlmostEqual(stats.mean, mean, places=6)
+        self.assertAlmostEqual(stats.std, std, places=6)
+
+    def test_unmasked(self):
+        product_src = self.open(self.product_path)
+        feature_mask = rasterize_feature(product_src, TRIANGLE)
+
+        product_stats, baseline_stats = zonal_stats(feature_mask, product_src)
+
+        valid = inside(TRIANGLE) & self.product_valid
+        self.assertStats(product_stats, self.product[valid])
+        self.assertEqual(baseline_stats.count, 0)
+
+    def test_cropmask_weights(self):
+        product_src = self.open(self.product_path)
+        mask_src = self.open(self.cropmask_path)
+        feature_mask = rasterize_feature(product_src, TRIANGLE)
+
+        product_stats, _ = zonal_stats(feature_mask, product_src, mask_src)
+
+        valid = inside(TRIANGLE) & self.product_valid & self.crop
+        self.assertStats(
+            product_stats, self.product[valid], weights=self.cropmask[valid]
+        )
+
+    def test_baseline(self):
+        product_src = self.open(self.product_path)
+        mask_src = self.open(self.cropmask_path)
+        baseline_src = self.open(self.baseline_path)
+        feature_mask = rasterize_feature(product_src, TRIANGLE)
+
+        product_stats, baseline_stats = zonal_stats(
+            feature_mask, product_src, mask_src, baseline_src
+        )
+
+        # only pixels valid in both are compared
+        valid = (
+            inside(TRIANGLE) & self.product_valid & self.baseline_valid & self.crop
+        )
+        weights = self.cropmask[valid]
+        self.assertStats(product_stats, self.product[valid], weights=weights)
+        self.assertStats(baseline_stats, self.baseline[valid], weights=weights)
+
+    def test_preview_is_close(self):
+        product_src = self.open(self.product_path)
+        feature_mask = rasterize_feature(product_src, TRIANGLE)
+
+        exact, _ = zonal_stats(feature_mask, product_src)
+        preview, _ = zonal_stats(feature_mask, product_src, max_size=128)
+
+        self.assertLess(preview.count, exact.count)
+        self.assertAlmostEqual(preview.mean, exact.mean, delta=exact.std / 10)
+
+
+class WriteExportTests(RasterTestCase):
+    def test_product(self):
+        product_src = self.open(self.product_path)
+        path = os.path.join(self.tmp_dir, "product-export.tif")
+
+        write_export(path, TRIANGLE, product_src)
+
+        window = feature_window(product_src, features.bounds(TRIANGLE))
+        self.assertGreater(window.height, EXPORT_BLOCK_SIZE)
+        with rasterio.open(path) as export:
+            self.assertEqual(export.nodata, PRODUCT_NODATA)
+            self.assertEqual(export.dtypes[0], "int16")
+            self.assertEqual(
+                export.transform, windows.transform(window, TRANSFORM)
+            )
+            np.testing.assert_array_equal(
+                export.read(1), self.expected(TRIANGLE, window, PRODUCT_NODATA)
+            )
+
+    def test_anomaly_cropmask(self):
+        product_src = self.open(self.product_path)
+        baseline_src = self.open(self.baseline_path)
+        mask_src = self.open(self.cropmask_path)
+        path = os.path.join(self.tmp_dir, "anomaly-export.tif")
+
+        write_export(path, TRIANGLE, product_src, baseline_src, mask_src)
+
+        window = feature_window(product_src, features.bounds(TRIANGLE))
+        with rasterio.open(path) as export:
+            self.assertEqual(export.nodata, ANOMALY_NODATA)
+            self.assertEqual(export.dtypes[0], "float32")
+            np.testing.assert_array_equal(
+                export.read(1),
+                self.expected(
+                    TRIANGLE, window, ANOMALY_NODATA, anomaly=True, cropmask=True
+                ),
+            )
+
+
+class WriteLayerExportsTests(RasterTestCase):
+    def test_layer(self):
+        product_src = self.open(self.product_path)
+        mask_src = self.open(self.cropmask_path)
+        export_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        geoms = {"triangle.tif": TRIANGLE, "rectangle.tif": RECTANGLE}
+        feature_masks = {
+            name: rasterize_feature(product_src, geom).to_cache()
+            for name, geom in geoms.items()
+        }
+
+        exports = dict(
+            write_layer_exports(
+                export_dir, feature_masks, product_src, mask_src=mask_src
+            )
+        )
+
+        self.assertEqual(set(exports), set(geoms))
+        for name, geom in geoms.items():
+            window = feature_window(product_src, features.bounds(geom))
+            with rasterio.open(exports[name]) as export:
+                self.assertEqual(
+                    export.transform, windows.transform(window, TRANSFORM)
+                )
+                np.testing.assert_array_equal(
+                    export.read(1),
+                    self.expected(geom, window, PRODUCT_NODATA, cropmask=True),
+                )
@@ -18,10 +18,16 @@ from .views.tags import TagViewSet
 from .views.point import PointValue
 from .views.query import QueryRasterValue
 from .views.histogram import Histogram
+from .views.zstats import ZonalStats
 from .views.graphics import GraphicsViewSet
 from .views.boundaryfeatures import BoundaryFeatureViewSet
 from .views.announcements import AnnouncementViewSet
-from .views.exports import ImageExportViewSet, GetExportViewSet
+from .views.exports import (
+    AtlasExportViewSet,
+    GetAtlasViewSet,
+    ImageExportViewSet,
+    GetExportViewSet,
+)
 
 
 class APIHomeView(APIRootView):
@@ -69,19 +75,24 @@ get_colormap_list = ColormapView.as_view()
 get_point = PointValue.as_view({"get": "retrieve"})
 get_custom_feature_value = QueryRasterValue.as_view({"post": "query_custom_feature"})
 get_boundary_feature_value = QueryRasterValue.as_view({"get": "query_boundary_feature"})
+get_query_result = QueryRasterValue.as_view({"get": "query_result"})
 get_custom_feature_histogram = Histogram.as_view({"post": "custom_feature_histogram"})
 get_boundary_feature_histogram = Histogram.as_view(
     {"get": "boundary_feature_histogram"}
 )
+get_boundary_feature_zstats = ZonalStats.as_view({"get": "boundary_feature_zstats"})
 get_custom_feature_graphic = GraphicsViewSet.as_view({"post": "custom_feature_graphic"})
 get_boundary_feature_graphic = GraphicsViewSet.as_view(
     {"get": "boundary_feature_graphic"}
 )
 generate_feature_export = ImageExportViewSet.as_view({"get": "boundary_feature_export"})
 generate_custom_export = ImageExportViewSet.as_view({"post": "custom_feature_export"})
+generate_layer_export = ImageExportViewSet.as_view({"post": "layer_export"})
+generate_atlas = AtlasExportViewSet.as_view({"post": "atlas_export"})
 
 router = CustomRouter()
 router.register(r"announcements", AnnouncementViewSet)
+router.register(r"atlases", GetAtlasViewSet)
 router.register(r"boundary-layers", BoundaryLayerViewSet)
 router.register(r"cropmasks", CropMaskViewSet)
 router.register(r"datasets", DatasetViewSet)
@@ -94,6 +105,7 @@ router.register(r"variables", VariableViewSet)
 
 urlpatterns = [
     # path('', include(router.urls)),
+    path("atlas/", generate_atlas, name="export-atlas"),
     path("colormap", get_colormap, name="colormap"),
     path("colormaps/", get_colormap_list, name="colormaps"),
     path(
@@ -121,13 +133,21 @@ urlpatterns = [
         name="point",
     ),
     path("query/", get_custom_feature_value, name="query-custom-feature"),
+    path("query/result/<str:task_id>/", get_query_result, name="query-result"),
     path(
         "query/<slug:product_id>/<isodate:date>/<slug:cropmask_id>/"
         "<slug:layer_id>/<int:feature_id>/",
         get_boundary_feature_value,
         name="query-boundary-feature",
     ),
+    path(
+        "zstats/<slug:product_id>/<slug:cropmask_id>/<slug:layer_id>/"
+        "<int:feature_id>/",
+        get_boundary_feature_zstats,
+        name="boundary-feature-zstats",
+    ),
     path("export/", generate_custom_export, name="export-custom-feature"),
+    path("export/layer/", generate_layer_export, name="export-layer"),
     path(
         "export/<slug:product_id>/<isodate:date>/<slug:cropmask_id>/"
         "<slug:layer_id>/<int:feature_id>/",
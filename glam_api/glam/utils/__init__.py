@@ -10,6 +10,8 @@ from typing import BinaryIO
 
 import numpy as np
 
+from django.conf import settings
+
 logging.basicConfig(
     format="%(asctime)s - %(message)s", datefmt="%d-%b-%y %H:%M:%S", level=logging.INFO
 )
@@ -93,3 +95,10 @@ def get_product_id_from_filename(filename):
         return "mod09a1-ndwi"
     else:
         return None
+
+
+def get_raster_path(file_object) -> str:
+    """Return a path rasterio can open for a stored raster file"""
+    if settings.USE_S3:
+        return f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{file_object.name}"
+    return file_object.path
@@ -0,0 +1,104 @@
+"""
+Graphic assets
+
+The static inputs of every graphic (the decoded GLAM logo and the boundary
+layers tagged with each admin level) are loaded once per worker process.
+Saving or deleting a data source, tag or boundary layer bumps a shared
+version stamp (see glam.signals). A worker checks the stamp at most every
+ASSETS_CHECK_INTERVAL seconds and reloads its assets when the stamp they
+were loaded at is no longer current.
+
+"""
+
+import io
+import logging
+import time
+
+from urllib.request import urlopen
+
+import numpy as np
+
+from PIL import Image
+
+from .cache import assets_version
+from ..models import BoundaryLayer, DataSource
+
+# Admin level tag names, finest first
+ADMIN_LEVELS = ["ADM1", "ADM0"]
+
+# Seconds before a logo that failed to load is fetched again
+LOGO_RETRY_INTERVAL = 5 * 60
+
+# Seconds between checks of the shared assets version stamp
+ASSETS_CHECK_INTERVAL = 30
+
+_assets = None
+_assets_version = None
+_assets_checked = None
+
+
+def load_logo():
+    """GLAM logo as an RGBA array, None if it can not be loaded"""
+    try:
+        glam_logo = DataSource.objects.get(source_id="glam").logo.url
+        with urlopen(glam_logo) as url:
+            logo_data = url.read()
+        return np.array(Image.open(io.BytesIO(logo_data)).convert("RGBA"))
+    except Exception as e:
+        logging.warning(f"Failed to load logo: {str(e)}")
+        return None
+
+
+def load_graphic_assets() -> dict:
+    admin_layers = {level: set() for level in ADMIN_LEVELS}
+    for layer_id, level in BoundaryLayer.objects.filter(
+        tags__name__in=ADMIN_LEVELS
+    ).values_list("pk", "tags__name"):
+        admin_layers[level].add(layer_id)
+
+    return {
+        "logo": load_logo(),
+        "logo_loaded": time.monotonic(),
+        "admin_layers": admin_layers,
+    }
+
+
+def graphic_assets() -> dict:
+    """
+    This process's graphic assets, reloaded if they changed since they were
+    loaded (checked at most every ASSETS_CHECK_INTERVAL seconds):
+        logo: GLAM logo RGBA array or None
+        admin_layers: {admin level tag name: set of boundary layer pks}
+    """
+    global _assets, _assets_version, _assets_checked
+
+    now = time.monotonic()
+    if _assets is None or now - _assets_checked > ASSETS_CHECK_INTERVAL:
+        version = assets_version()
+        _assets_checked = now
+        if _assets is None or version != _assets_version:
+            _assets = load_graphic_assets()
+            _assets_version = version
+            return _assets
+
+    if (
+        _assets["logo"] is None
+        and time.monotonic() - _assets["logo_loaded"] > LOGO_RETRY_INTERVAL
+    ):
+        _assets["logo"] = load_logo()
+        _assets["logo_loaded"] = time.monotonic()
+    return _assets
+
+
+def layer_admin_level(boundary_layer) -> str:
+    """Finest admin level ("ADM1", "ADM0") of a boundary layer, None if untagged"""
+    admin_layers = graphic_assets()["admin_layers"]
+    for level in ADMIN_LEVELS:
+        if boundary_layer.pk in admin_layers[level]:
+            return level
+    return None
+
+
+def admin_layer_ids(level: str) -> list:
+    """Pks of the boundary layers tagged with an admin level"""
+    return list(graphic_assets()["admin_layers"][level])
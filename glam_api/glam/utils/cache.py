@@ -0,0 +1,264 @@
+"""
+Result caching
+
+Cached results are keyed on the version of every dataset they are computed
+from: a stamp per dataset, replaced whenever the dataset is saved or deleted
+(see glam.signals), so results of a re-ingested dataset are never served.
+
+User-drawn geometries are reduced to a canonical form (snapped to a grid
+tied to the product resolution, normalized ring order and orientation)
+before hashing, so the same saved polygon sent with slightly different
+coordinates maps to the same cache entry.
+
+"""
+
+import hashlib
+import logging
+import time
+
+import rasterio
+import shapely
+
+from shapely.geometry import MultiPolygon, Polygon, shape
+from shapely.geometry.polygon import orient
+
+from django.conf import settings
+from django.core.cache import cache, caches
+
+from . import get_raster_path
+
+# Geometries are snapped to a fraction of a product pixel
+GEOMETRY_PRECISION_FACTOR = 4
+
+# Approximate length of a degree at the equator, for projected products
+METERS_PER_DEGREE = 111320
+
+RESOLUTION_CACHE_TIMEOUT = 60 * 60 * 24 * 30  # 30 days
+
+GRAPHIC_CACHE_TIMEOUT = 60 * 60 * 24 * 30  # 30 days
+
+
+def product_resolution(product_dataset) -> float:
+    """
+    Pixel size in degrees of a product's rasters.
+    Read from the raster once and cached per product.
+    """
+    product_id = product_dataset.product.product_id
+    cache_key = f"product-resolution-{product_id}"
+
+    resolution = cache.get(cache_key) if settings.USE_CACHING else None
+    if resolution:
+        return resolution
+
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS):
+        with rasterio.open(get_raster_path(product_dataset.file_object)) as src:
+            resolution = min(abs(r) for r in src.res)
+            if src.crs and not src.crs.is_geographic:
+                resolution = resolution / METERS_PER_DEGREE
+
+    if settings.USE_CACHING:
+        cache.set(cache_key, resolution, timeout=RESOLUTION_CACHE_TIMEOUT)
+
+    return resolution
+
+
+def canonical_geometry(geom, precision: float):
+    """
+    Canonical shapely geometry for a GeoJSON geometry (or Feature):
+    coordinates snapped to a `precision` grid, rings and parts in a
+    normalized order and exterior rings counter-clockwise.
+    """
+    if geom.get("type") == "Feature":
+        geom = geom["geometry"]
+
+    geometry = shapely.set_precision(shape(geom), grid_size=precision)
+    geometry = shapely.normalize(geometry)
+
+    if isinstance(geometry, Polygon):
+        geometry = orient(geometry, sign=1.0)
+    elif isinstance(geometry, MultiPolygon):
+        geometry = MultiPolygon([orient(p, sign=1.0) for p in geometry.geoms])
+
+    return geometry
+
+
+def geometry_hash(geom, precision: float) -> str:
+    """
+    Hash of the canonical WKB of a GeoJSON geometry.
+    Coordinate jitter smaller than `precision` produces the same hash.
+    """
+    geometry = canonical_geometry(geom, precision)
+    return hashlib.sha1(shapely.to_wkb(geometry, output_dimension=2)).hexdigest()
+
+
+def custom_geometry_hash(product_dataset, geom) -> str:
+    """Geometry hash at a precision tied to the product's resolution"""
+    precision = product_resolution(product_dataset) / GEOMETRY_PRECISION_FACTOR
+    return geometry_hash(geom, precision)
+
+
+def export_key(data, product_datasets, *datasets) -> str:
+    """
+    Content key of an export: a hash of its product, dates, boundary feature
+    (or layer export features) or canonical geometry, crop mask, anomaly options and format, tied to
+    the version of the datasets it reads.
+    """
+    if data.get("geom"):
+        feature = custom_geometry_hash(product_datasets[0], data["geom"])
+    elif data.get("feature_id") is not None:
+        feature = f"{data['layer_id']}-{data['feature_id']}"
+    else:
+        # every feature of a layer export
+        feature = "layer-" + "-".join(
+            str(data.get(key))
+            for key in ("layer_id", "tag", "parent_layer_id", "parent_feature_id")
+        )
+
+    parts = [
+        data["product_id"],
+        data["date"],
+        data.get("end_date"),
+        feature,
+        data.get("cropmask_id") or "no-mask",
+        data.get("anomaly"),
+        data.get("anomaly_type"),
+        data.get("diff_year"),
+        "nc" if data.get("end_date") else "tif",
+    ]
+    cache_key = versioned_key(
+        "export-" + "-".join(str(part) for part in parts),
+        *product_datasets,
+        *datasets,
+    )
+    return hashlib.sha1(cache_key.encode()).hexdigest()
+
+
+def get_cached(cache_key):
+    """Return a cached result or None, logging hits and misses"""
+    if not settings.USE_CACHING:
+        return None
+    data = cache.get(cache_key)
+    if data is not None:
+        logging.debug(f"cache hit: {cache_key}")
+    else:
+        logging.debug(f"cache miss: {cache_key}")
+    return data
+
+
+def set_cached(cache_key, data, timeout=(60 * 60 * 24 * 365)):
+    """Store a result if caching is enabled"""
+    if settings.USE_CACHING:
+        cache.set(cache_key, data, timeout=timeout)
+
+
+def dataset_version_key(dataset) -> str:
+    return f"dataset-version-{dataset._meta.model_name}-{dataset.pk}"
+
+
+def bump_dataset_version(dataset):
+    """
+    Invalidate every cached result computed from a dataset (or from a
+    boundary feature's geometry)
+    """
+    if settings.USE_CACHING:
+        cache.set(dataset_version_key(dataset), time.time_ns(), timeout=None)
+
+
+def datasets_version(*datasets) -> str:
+    """
+    Version of the datasets a result is computed from (None datasets are
+    skipped). A missing stamp is created rather than read as a default, so
+    an evicted stamp can never bring back results of an older version.
+    """
+    datasets = [dataset for dataset in datasets if dataset is not None]
+    keys = [dataset_version_key(dataset) for dataset in datasets]
+
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, time.time_ns(), timeout=None)
+        versions.update(cache.get_many(missing))
+
+    stamps = "-".join(str(versions.get(key)) for key in keys)
+    return hashlib.sha1(stamps.encode()).hexdigest()[:12]
+
+
+def versioned_key(cache_key: str, *datasets) -> str:
+    """Cache key tied to the current version of `datasets`"""
+    if not settings.USE_CACHING:
+        return cache_key
+    return f"{cache_key}-v{datasets_version(*datasets)}"
+
+
+def product_dates_key(product_id: str) -> str:
+    return f"product-dates-{product_id}"
+
+
+def invalidate_product_dates(product_id: str):
+    """Drop the cached date index of a product (see resolvers.product_date_index)"""
+    if settings.USE_CACHING:
+        cache.delete(product_dates_key(product_id))
+
+
+def get_cached_graphic(cache_key):
+    """Return a cached (png bytes, resolution) graphic or None"""
+    if not settings.USE_CACHING:
+        return None
+    data = caches[settings.GRAPHIC_CACHE_ALIAS].get(cache_key)
+    logging.debug(f"cache {'hit' if data is not None else 'miss'}: {cache_key}")
+    return data
+
+
+def set_cached_graphic(cache_key, png: bytes, resolution: str):
+    """
+    Store a rendered graphic in the graphics cache, unless it is larger than
+    GRAPHIC_CACHE_MAX_BYTES.
+    """
+    if not settings.USE_CACHING or len(png) > settings.GRAPHIC_CACHE_MAX_BYTES:
+        return
+    caches[settings.GRAPHIC_CACHE_ALIAS].set(
+        cache_key, (png, resolution), timeout=GRAPHIC_CACHE_TIMEOUT
+    )
+
+
+def bump_backdrop_version():
+    """Invalidate every cached graphic backdrop (boundary features changed)"""
+    if settings.USE_CACHING:
+        caches[settings.GRAPHIC_CACHE_ALIAS].set(
+            "backdrop-version", time.time_ns(), timeout=None
+        )
+
+
+def backdrop_key(cache_key: str) -> str:
+    """Cache key of a graphic backdrop tied to the boundary features version"""
+    graphic_cache = caches[settings.GRAPHIC_CACHE_ALIAS]
+    graphic_cache.add("backdrop-version", time.time_ns(), timeout=None)
+    return f"{cache_key}-v{graphic_cache.get('backdrop-version')}"
+
+
+def get_cached_backdrop(cache_key):
+    """Return a cached backdrop layer (PNG bytes) or None"""
+    if not settings.USE_CACHING:
+        return None
+    return caches[settings.GRAPHIC_CACHE_ALIAS].get(backdrop_key(cache_key))
+
+
+def set_cached_backdrop(cache_key, png: bytes):
+    if settings.USE_CACHING:
+        caches[settings.GRAPHIC_CACHE_ALIAS].set(
+            backdrop_key(cache_key), png, timeout=GRAPHIC_CACHE_TIMEOUT
+        )
+
+
+def bump_assets_version():
+    """Reload the graphic assets of every worker (see glam.utils.assets)"""
+    caches[settings.GRAPHIC_CACHE_ALIAS].set(
+        "graphic-assets-version", time.time_ns(), timeout=None
+    )
+
+
+def assets_version():
+    graphic_cache = caches[settings.GRAPHIC_CACHE_ALIAS]
+    graphic_cache.add("graphic-assets-version", time.time_ns(), timeout=None)
+    return graphic_cache.get("graphic-assets-version")
@@ -0,0 +1,400 @@
+"""
+Graphic compositor
+
+Renders boundary feature graphics with numpy and PIL instead of a matplotlib
+figure. Polygons are rasterized directly on a canvas in geographic
+coordinates, the data image is colored through a 256 entry colormap LUT, and
+the label, legend and logo are pasted from pre-rendered assets, cached per
+process since they only depend on their text, colormap and size.
+
+Layers are drawn in the order of the matplotlib figure: backdrop features,
+feature fill, data image, feature outline, then label, legend and logo.
+
+"""
+
+import io
+
+from functools import lru_cache
+
+import numpy as np
+
+from PIL import Image, ImageDraw, ImageFont
+from rio_tiler.colormap import cmap
+
+GRAY = "#999999"
+LAND = "#efefdb"
+
+NDVI_COLORS = [
+    "#fffee1",
+    "#ffe1c8",
+    "#f5c98c",
+    "#ffdd55",
+    "#ebbe37",
+    "#faffb4",
+    "#e6fa9b",
+    "#cdff69",
+    "#aff05a",
+    "#a0f5a5",
+    "#82e187",
+    "#78c878",
+    "#9ec66c",
+    "#8caf46",
+    "#46b928",
+    "#329614",
+    "#147850",
+    "#1e5000",
+    "#003200",
+]
+
+# Font size in pixels of labels and legend (8pt at 100 dpi)
+FONT_SIZE = 11
+
+# Matplotlib's default subplot covers 77.5% of the figure width
+AXES_FRACTION = 0.775
+FIGURE_DPI = 100
+
+
+def hex_to_rgb(color: str):
+    color = color.lstrip("#")
+    return tuple(int(color[i : i + 2], 16) for i in (0, 2, 4))
+
+
+def canvas_size(figsize, bounds):
+    """
+    (width, height) in pixels of the map area of a figure of `figsize`
+    inches over `bounds`, with equal aspect as in the matplotlib figure.
+    """
+    long_side = round(max(figsize) * FIGURE_DPI * AXES_FRACTION)
+    x1, y1, x2, y2 = bounds
+    width, height = abs(x2 - x1), abs(y2 - y1)
+    if not width or not height:
+        return (long_side, long_side)
+    if width >= height:
+        return (long_side, max(1, round(long_side * height / width)))
+    return (max(1, round(long_side * width / height)), long_side)
+
+
+@lru_cache(maxsize=64)
+def colormap_lut(colormap) -> np.ndarray:
+    """
+    (256, 4) uint8 RGBA lookup table of a colormap: a colormap name (as used
+    by matplotlib and rio-tiler) or a tuple of hex colors interpolated
+    linearly. Names unknown to rio-tiler are read from matplotlib if it is
+    installed.
+    """
+    if isinstance(colormap, tuple):
+        colors = np.array([hex_to_rgb(c) for c in colormap], dtype="float64")
+        stops = np.linspace(0, 1, len(colors))
+        x = np.linspace(0, 1, 256)
+        lut = np.empty((256, 4), dtype="uint8")
+        for band in range(3):
+            lut[:, band] = np.round(np.interp(x, stops, colors[:, band]))
+        lut[:, 3] = 255
+        return lut
+
+    name = colormap.lower()
+    if name in cmap.list():
+        colors = cmap.get(name)
+        return np.array([colors[i] for i in range(256)], dtype="uint8")
+
+    try:
+        import matplotlib
+    except ImportError:
+        raise ValueError(f"Unknown colormap: {colormap}")
+    values = matplotlib.colormaps[colormap](np.linspace(0, 1, 256))
+    return np.round(values * 255).astype("uint8")
+
+
+def geo_to_pixel(bounds, size):
+    """Function mapping (x, y) arrays in `bounds` to canvas pixels"""
+    x1, y1, x2, y2 = bounds
+    width, height = size
+    sx = width / (x2 - x1)
+    sy = height / (y2 - y1)
+
+    def transform(coords):
+        coords = np.asarray(coords, dtype="float64")
+        return np.column_stack(
+            [(coords[:, 0] - x1) * sx, (y2 - coords[:, 1]) * sy]
+        ).ravel()
+
+    return transform
+
+
+def iter_polygons(geometry):
+    """Polygons of a shapely Polygon, MultiPolygon or collection"""
+    if geometry is None or geometry.is_empty:
+        return
+    if geometry.geom_type == "Polygon":
+        yield geometry
+    elif hasattr(geometry, "geoms"):
+        for part in geometry.geoms:
+            yield from iter_polygons(part)
+
+
+def dashed_line(draw, points, fill, width=1, dash=(2, 2)):
+    """Draw a polyline (flat x, y sequence) as dashes of `dash` pixels"""
+    points = np.asarray(points).reshape(-1, 2)
+    on, off = dash
+    period = on + off
+    for start, end in zip(points[:-1], points[1:]):
+        length = float(np.hypot(*(end - start)))
+        if not length:
+            continue
+        step = (end - start) / length
+        for offset in np.arange(0, length, period):
+            a = start + step * offset
+            b = start + step * min(offset + on, length)
+            draw.line([tuple(a), tuple(b)], fill=fill, width=width)
+
+
+def polygon_layer(
+    geometries,
+    bounds,
+    size,
+    fill=None,
+    alpha=1.0,
+    outline=None,
+    width=1,
+    dashed=False,
+) -> Image.Image:
+    """
+    RGBA layer of shapely polygons: a `fill` (with holes) at `alpha` and an
+    `outline` of `width` pixels, solid or dashed.
+    """
+    transform = geo_to_pixel(bounds, size)
+    layer = Image.new("RGBA", size, (0, 0, 0, 0))
+
+    polygons = [p for geometry in geometries for p in iter_polygons(geometry)]
+
+    if fill:
+        mask = Image.new("L", size, 0)
+        mask_draw = ImageDraw.Draw(mask)
+        for polygon in polygons:
+            mask_draw.polygon(list(transform(polygon.exterior.coords)), fill=255)
+            for interior in polygon.interiors:
+                mask_draw.polygon(list(transform(interior.coords)), fill=0)
+        if alpha < 1:
+            mask = mask.point(lambda v: round(v * alpha))
+        color = Image.new("RGBA", size, hex_to_rgb(fill) + (255,))
+        layer = Image.composite(color, layer, mask)
+
+    if outline:
+        draw = ImageDraw.Draw(layer)
+        color = hex_to_rgb(outline) + (255,)
+        for polygon in polygons:
+            for ring in [polygon.exterior, *polygon.interiors]:
+                points = transform(ring.coords)
+                if dashed:
+                    dashed_line(draw, points, fill=color, width=width)
+                else:
+                    draw.line(list(points), fill=color, width=width, joint="curve")
+
+    return layer
+
+
+def data_layer(
+    data, data_bounds, bounds, size, colormap, stretch, resample=Image.NEAREST
+) -> Image.Image:
+    """
+    RGBA layer of a 2D (masked) array covering `data_bounds`, colored with a
+    colormap LUT over the `stretch` range. Masked pixels are transparent.
+    """
+    data = np.ma.masked_invalid(np.ma.asarray(data, dtype="float64"))
+    vmin, vmax = stretch
+    scaled = (data.filled(vmin) - vmin) / ((vmax - vmin) or 1)
+    index = np.clip(np.floor(scaled * 256), 0, 255).astype("uint8")
+
+    rgba = colormap_lut(colormap)[index]
+    rgba[..., 3] = np.where(np.ma.getmaskarray(data), 0, rgba[..., 3])
+    image = Image.fromarray(rgba, "RGBA")
+
+    transform = geo_to_pixel(bounds, size)
+    left, top, right, bottom = transform(
+        [[data_bounds[0], data_bounds[3]], [data_bounds[2], data_bounds[1]]]
+    )
+    box = (round(left), round(top))
+    image_size = (max(1, round(right - left)), max(1, round(bottom - top)))
+
+    layer = Image.new("RGBA", size, (0, 0, 0, 0))
+    layer.paste(image.resize(image_size, resample), box)
+    return layer
+
+
+@lru_cache(maxsize=8)
+def get_font(size: int = FONT_SIZE):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow without FreeType only has the fixed size bitmap font
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=256)
+def label_asset(text: str, font_size: int = FONT_SIZE) -> Image.Image:
+    """Multiline text in a white framed box (as a matplotlib AnchoredText)"""
+    font = get_font(font_size)
+    pad = round(font_size * 0.4)
+    measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    left, top, right, bottom = measure.multiline_textbbox((0, 0), text, font=font)
+
+    box = Image.new(
+        "RGBA", (right - left + 2 * pad, bottom - top + 2 * pad), (255, 255, 255, 255)
+    )
+    draw = ImageDraw.Draw(box)
+    draw.multiline_text((pad - left, pad - top), text, fill=(0, 0, 0, 255), font=font)
+    draw.rectangle([0, 0, box.width - 1, box.height - 1], outline=(0, 0, 0, 255))
+    return box
+
+
+@lru_cache(maxsize=128)
+def colorbar_asset(
+    colormap, stretch, scale, label, width, font_size=FONT_SIZE
+) -> Image.Image:
+    """
+    Horizontal colorbar of `width` pixels with ticks in product units
+    (values * `scale`) and a label below, on a transparent background.
+    """
+    font = get_font(font_size)
+    bar_height = max(4, round(width * 0.09))
+    tick_length = 3
+
+    lut = colormap_lut(colormap)
+    bar = lut[np.linspace(0, 255, width).astype("int64")][np.newaxis].repeat(
+        bar_height, axis=0
+    )
+
+    ticks = np.linspace(stretch[0], stretch[1], 5)
+    tick_labels = ["{:g}".format(round(tick * scale, 6)) for tick in ticks]
+    text_height = font_size + 2
+    pad = round(font_size / 2)
+
+    height = bar_height + tick_length + 2 * text_height + 2
+    asset = Image.new("RGBA", (width + 2 * pad, height), (0, 0, 0, 0))
+    asset.paste(Image.fromarray(bar, "RGBA"), (pad, 0))
+
+    draw = ImageDraw.Draw(asset)
+    draw.rectangle([pad, 0, pad + width - 1, bar_height - 1], outline=(0, 0, 0, 255))
+    for i, tick_label in enumerate(tick_labels):
+        x = pad + round(i * (width - 1) / (len(ticks) - 1))
+        draw.line(
+            [(x, bar_height), (x, bar_height + tick_length)], fill=(0, 0, 0, 255)
+        )
+        draw.text(
+            (x, bar_height + tick_length + 1),
+            tick_label,
+            fill=(0, 0, 0, 255),
+            font=font,
+            anchor="ma",
+        )
+    draw.text(
+        (pad + width // 2, bar_height + tick_length + text_height + 1),
+        label,
+        fill=(0, 0, 0, 255),
+        font=font,
+        anchor="ma",
+    )
+    return asset
+
+
+def fit_logo(logo: Image.Image, box_size, alpha=0.75) -> Image.Image:
+    """Logo scaled to fit `box_size` keeping its aspect, at `alpha`"""
+    logo = logo.convert("RGBA")
+    logo.thumbnail(box_size, Image.LANCZOS)
+    if alpha < 1:
+        logo.putalpha(logo.getchannel("A").point(lambda v: round(v * alpha)))
+    return logo
+
+
+def backdrop_layer(backdrop, feature, bounds, size) -> Image.Image:
+    """
+    RGBA backdrop of a graphic: `backdrop` geometries filled as land with
+    dotted outlines under the `feature` gray fill. It does not depend on the
+    product or date, so it is cached per feature and size.
+    """
+    layer = polygon_layer(
+        backdrop, bounds, size, fill=LAND, outline="#000000", dashed=True
+    )
+    if feature is not None:
+        layer.alpha_composite(
+            polygon_layer([feature], bounds, size, fill=GRAY, alpha=0.5)
+        )
+    return layer
+
+
+def encode_layer(layer: Image.Image) -> bytes:
+    output = io.BytesIO()
+    layer.save(output, format="PNG")
+    return output.getvalue()
+
+
+def decode_layer(data: bytes) -> Image.Image:
+    layer = Image.open(io.BytesIO(data))
+    return layer.convert("RGBA")
+
+
+def render_graphic(
+    size,
+    bounds,
+    backdrop=(),
+    feature=None,
+    data=None,
+    data_bounds=None,
+    colormap=None,
+    stretch=None,
+    label=None,
+    legend=None,
+    scale=1,
+    logo=None,
+    backdrop_image=None,
+) -> bytes:
+    """
+    PNG of a boundary feature graphic over `bounds` at `size` (see
+    canvas_size): the backdrop (see backdrop_layer, or a pre-rendered
+    `backdrop_image`), the colored `data` image, the `feature` outline, then
+    the `label` text, the `legend` colorbar label and the `logo`. Geometries
+    are shapely.
+    """
+    width, height = size
+    canvas = Image.new("RGBA", size, (0, 0, 0, 0))
+
+    if backdrop_image is None:
+        backdrop_image = backdrop_layer(backdrop, feature, bounds, size)
+    canvas.alpha_composite(backdrop_image)
+
+    if data is not None:
+        canvas.alpha_composite(
+            data_layer(data, data_bounds, bounds, size, colormap, stretch)
+        )
+    if feature is not None:
+        canvas.alpha_composite(
+            polygon_layer([feature], bounds, size, outline="#000000", width=2)
+        )
+
+    margin = round(FONT_SIZE * 0.5)
+
+    if label:
+        asset = label_asset(label)
+        canvas.alpha_composite(
+            asset,
+            (
+                max(0, width - asset.width - margin),
+                max(0, height - asset.height - margin),
+            ),
+        )
+
+    if legend:
+        asset = colorbar_asset(
+            colormap, tuple(stretch), scale, legend, max(10, round(width * 0.33))
+        )
+        canvas.alpha_composite(
+            asset, (max(0, width - asset.width - margin), margin)
+        )
+
+    if logo is not None:
+        asset = fit_logo(logo, (round(width * 0.15), round(height * 0.1)))
+        canvas.alpha_composite(asset, (margin, height - asset.height - margin))
+
+    output = io.BytesIO()
+    canvas.save(output, format="PNG")
+    return output.getvalue()
@@ -0,0 +1,916 @@
+"""
+Image exports
+
+An export is the product dataset (minus an anomaly baseline, limited to a
+crop mask) over a feature at full resolution, as a Cloud Optimized GeoTIFF.
+It is read and written one EXPORT_BLOCK_SIZE block at a time into a tiled
+GeoTIFF, which is then translated to a COG on disk, so memory use does not
+grow with the size of the feature. The django-q hook uploads the COG to
+ImageExport.file_object.
+
+A date range export is written the same way into one chunked, compressed
+NetCDF4 file (time, y, x) of every product dataset in the range, the dates
+read concurrently by N_THREADS threads.
+
+A layer export writes a COG of every feature of a boundary layer into one
+ZIP. The union of the feature windows is read once, block by block, and
+each block is clipped with the cached masks of the features it intersects.
+
+Jobs save their progress (blocks processed, bytes written) to the
+ImageExport every PROGRESS_INTERVAL seconds, and stop at the next block once
+its cancel_requested is set.
+
+"""
+
+import os
+import json
+import shutil
+import datetime
+import logging
+import tempfile
+import threading
+import time
+import zipfile
+
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+
+import h5py
+import numpy as np
+
+import rasterio
+from rasterio import features, windows
+from rasterio.warp import transform_geom
+from rio_cogeo.cogeo import cog_translate
+from rio_cogeo.profiles import cog_profiles
+
+from django.conf import settings
+from django.contrib.gis.db.models.functions import PointOnSurface
+from django.core.files import File
+from django.utils import timezone
+
+from . import get_raster_path
+
+from .geometries import pixel_geometry, raster_resolution
+from .masks import FEATURE_CRS, FeatureMask, feature_window, get_feature_mask
+from .resolvers import (
+    get_baseline_dataset,
+    get_baseline_datasets,
+    get_mask_dataset,
+    get_product_dataset,
+    get_product_datasets_between,
+)
+from .zonal import align_source, open_datasets
+from ..models import BoundaryFeature, ImageExport
+
+# Side in pixels of the blocks read and written (a multiple of 16)
+EXPORT_BLOCK_SIZE = 512
+
+# GDAL block cache of an export job in MB
+EXPORT_CACHE_MB = 256
+
+# Nodata of float exports of rasters without nodata (e.g. anomalies)
+ANOMALY_NODATA = -9999
+
+# Side in pixels of the (1, y, x) chunks of date range exports
+CUBE_CHUNK_SIZE = 256
+
+CUBE_EPOCH = datetime.date(1970, 1, 1)
+
+# Seconds between progress updates (and cancel checks) of an export job
+PROGRESS_INTERVAL = 2
+
+
+class ExportCancelled(Exception):
+    """Raised at a block boundary of an export whose cancel was requested"""
+
+
+class ExportProgress:
+    """
+    Progress of the export job of an ImageExport writing `path`. Writers call
+    start() with the number of blocks, then advance() after each block
+    (from any thread) and report() (from the job's thread only), which saves
+    the progress and the size of `path` at most every PROGRESS_INTERVAL
+    seconds and raises ExportCancelled once cancel_requested is set.
+    """
+
+    def __init__(self, export_id, path):
+        self.export_id = export_id
+        self.path = path
+        self.total = 0
+        self.done = 0
+        self.reported = time.monotonic()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self, total):
+        self.total += total
+
+    def advance(self, blocks=1):
+        with self.lock:
+            self.done += blocks
+        if self.stopped.is_set():
+            raise ExportCancelled(self.export_id)
+
+    def report(self, force=False):
+        if self.stopped.is_set():
+            raise ExportCancelled(self.export_id)
+        if not force and time.monotonic() - self.reported < PROGRESS_INTERVAL:
+            return
+        self.reported = time.monotonic()
+
+        try:
+            bytes_written = os.path.getsize(self.path)
+        except OSError:
+            bytes_written = 0
+        exports = ImageExport.objects.filter(id=self.export_id)
+        exports.update(
+            progress=min(self.done / max(self.total, 1), 1),
+            bytes_written=bytes_written,
+        )
+        if exports.filter(cancel_requested=True).exists():
+            self.stopped.set()
+            raise ExportCancelled(self.export_id)
+
+
+def start_export_job(export_id) -> bool:
+    """Set an export running, False if it was cancelled while queued"""
+    exports = ImageExport.objects.filter(id=export_id)
+    if exports.filter(cancel_requested=False).update(status=ImageExport.RUNNING):
+        return True
+    cancel_export_job(export_id)
+    return False
+
+
+def cancel_export_job(export_id):
+    logging.info(f"Export {export_id} cancelled")
+    ImageExport.objects.filter(id=export_id).update(
+        status=ImageExport.CANCELLED, content_key=None
+    )
+
+
+def export_feature(data):
+    """Feature of an export: a BoundaryFeature or a GeoJSON geometry"""
+    if data.get("geom"):
+        geom = data["geom"]
+        return geom["geometry"] if geom.get("type") == "Feature" else geom
+
+    return BoundaryFeature.objects.get(
+        boundary_layer__layer_id=data["layer_id"], feature_id=data["feature_id"]
+    )
+
+
+def export_name(data, extension="tif") -> str:
+    """File name of an export"""
+    parts = [data["product_id"], str(data["date"])]
+    if data.get("end_date"):
+        parts.append(str(data["end_date"]))
+    if data.get("cropmask_id") and data["cropmask_id"] != "no-mask":
+        parts.append(data["cropmask_id"])
+    if data.get("anomaly_type"):
+        parts.append(
+            f"{data['anomaly_type']}-{data.get('diff_year') or data.get('anomaly')}"
+        )
+    for key in ("layer_id", "tag", "feature_id"):
+        if data.get(key) is not None:
+            parts.append(str(data[key]))
+    if data.get("parent_layer_id"):
+        parts.append(f"in-{data['parent_layer_id']}-{data['parent_feature_id']}")
+    return "_".join(parts) + f".{extension}"
+
+
+def export_datasets(data):
+    """
+    (product, baseline or None, crop mask or None) datasets of an export.
+    Raises ValueError if an anomaly is requested but has no baseline.
+    """
+    product_id = data.get("product_id")
+    product_ds = get_product_dataset(product_id, data.get("date"))
+    anomaly_ds = None
+    if data.get("anomaly_type"):
+        anomaly_ds = get_baseline_dataset(
+            product_ds,
+            data.get("anomaly"),
+            data.get("anomaly_type"),
+            data.get("diff_year"),
+        )
+        if anomaly_ds is None:
+            raise ValueError(f"No {data['anomaly_type']} baseline for {product_ds}")
+    return product_ds, anomaly_ds, get_mask_dataset(product_id, data.get("cropmask_id"))
+
+
+def layer_features(data):
+    """
+    BoundaryFeatures of a layer export: those of a layer or of the layers
+    with a tag, limited to those with a point on their surface within a
+    parent feature if one is given.
+    """
+    features = BoundaryFeature.objects.filter(geom__isnull=False)
+    if data.get("layer_id"):
+        features = features.filter(boundary_layer__layer_id=data["layer_id"])
+    if data.get("tag"):
+        features = features.filter(boundary_layer__tags__name=data["tag"])
+    if data.get("parent_layer_id"):
+        parent = BoundaryFeature.objects.get(
+            boundary_layer__layer_id=data["parent_layer_id"],
+            feature_id=data["parent_feature_id"],
+        )
+        features = features.annotate(point=PointOnSurface("geom")).filter(
+            point__within=parent.geom
+        )
+    return features.select_related("boundary_layer").order_by(
+        "boundary_layer_id", "feature_id"
+    )
+
+
+def export_nodata(src, dtype):
+    """Nodata value of an export of `src` written as `dtype`"""
+    if dtype == src.dtypes[0] and src.nodata is not None:
+        return src.nodata
+    if np.dtype(dtype).kind == "f":
+        return ANOMALY_NODATA
+    return np.iinfo(dtype).max
+
+
+def feature_geom(feature, src):
+    """GeoJSON geometry of an export feature in the CRS of `src`"""
+    if isinstance(feature, BoundaryFeature):
+        # exact at the product resolution, with fewer vertices
+        geom = json.loads(pixel_geometry(feature, raster_resolution(src)).geojson)
+    else:
+        geom = feature
+    if src.crs and src.crs.to_string() != FEATURE_CRS:
+        geom = transform_geom(FEATURE_CRS, src.crs, geom)
+    return geom
+
+
+def export_window(src, geom):
+    """Pixel window of an export of `geom` on the grid of `src`"""
+    window = feature_window(src, features.bounds(geom))
+    if not window.width or not window.height:
+        raise ValueError("Export feature does not overlap the product dataset")
+    return window
+
+
+def iter_blocks(window, size=EXPORT_BLOCK_SIZE):
+    """Windows of at most `size` pixels square tiling `window`, relative to it"""
+    for row_off in range(0, int(window.height), size):
+        for col_off in range(0, int(window.width), size):
+            yield windows.Window(
+                col_off,
+                row_off,
+                min(size, int(window.width) - col_off),
+                min(size, int(window.height) - row_off),
+            )
+
+
+def export_profile(product_src, window, dtype, nodata, compress="deflate"):
+    """Profile of a tiled GeoTIFF export of `window` of `product_src`"""
+    profile = {
+        "driver": "GTiff",
+        "width": int(window.width),
+        "height": int(window.height),
+        "count": 1,
+        "dtype": dtype,
+        "nodata": nodata,
+        "crs": product_src.crs,
+        "transform": windows.transform(window, product_src.transform),
+        "tiled": True,
+        "blockxsize": EXPORT_BLOCK_SIZE,
+        "blockysize": EXPORT_BLOCK_SIZE,
+        "BIGTIFF": "IF_SAFER",
+    }
+    if compress:
+        profile["compress"] = compress
+    return profile
+
+
+def write_export(
+    path, geom, product_src, anomaly_src=None, mask_src=None, progress=None
+):
+    """
+    Write the export of `geom` (GeoJSON in the CRS of `product_src`) as a
+    tiled GeoTIFF at `path`, block by block, advancing `progress` (an
+    ExportProgress) after each block. Pixels outside the feature, without
+    data, or outside the crop mask are nodata.
+    """
+    window = export_window(product_src, geom)
+    blocks = list(iter_blocks(window))
+    if progress is not None:
+        progress.start(len(blocks))
+
+    dtype = "float32" if anomaly_src is not None else product_src.dtypes[0]
+    nodata = export_nodata(product_src, dtype)
+    transform = windows.transform(window, product_src.transform)
+    profile = export_profile(product_src, window, dtype, nodata)
+
+    with rasterio.open(path, "w", **profile) as dst:
+        for block in blocks:
+            if progress is not None:
+                progress.advance()
+                progress.report()
+
+            src_window = windows.Window(
+                window.col_off + block.col_off,
+                window.row_off + block.row_off,
+                block.width,
+                block.height,
+            )
+            shape = (int(block.height), int(block.width))
+            outside = features.geometry_mask(
+                [geom],
+                out_shape=shape,
+                transform=windows.transform(block, transform),
+            )
+            if outside.all():
+                dst.write(np.full(shape, nodata, dtype=dtype), 1, window=block)
+                continue
+
+            data = product_src.read(1, window=src_window, masked=True)
+            if anomaly_src is not None:
+                data = data.astype(dtype) - anomaly_src.read(
+                    1, window=src_window, masked=True
+                )
+            if mask_src is not None:
+                crop = mask_src.read(1, window=src_window, masked=True)
+                outside |= np.ma.filled(crop <= 0, True)
+
+            data = np.ma.masked_where(outside | np.ma.getmaskarray(data), data)
+            dst.write(data.filled(nodata).astype(dtype), 1, window=block)
+
+
+def image_export(export_id, data):
+    """
+    Export a product dataset over a feature as a COG on local disk.
+    Queued by ImageExportViewSet, uploaded by the upload_export hook.
+    :param export_id: id of the ImageExport instance
+    :param data: validated export parameters (product_id, date, cropmask_id,
+        anomaly, anomaly_type, diff_year and geom or layer_id and feature_id)
+    :return: (export_id, path of the COG), None if the export was cancelled
+    """
+    if not start_export_job(export_id):
+        return None
+
+    product_ds, anomaly_ds, mask_ds = export_datasets(data)
+    feature = export_feature(data)
+
+    export_dir = tempfile.mkdtemp(prefix=f"export-{export_id}-")
+    tiled_path = os.path.join(export_dir, "tiled.tif")
+    cog_path = os.path.join(export_dir, export_name(data))
+    progress = ExportProgress(export_id, tiled_path)
+
+    gdal_options = {**settings.GDAL_CONFIG_OPTIONS, "GDAL_CACHEMAX": EXPORT_CACHE_MB}
+    try:
+        with rasterio.Env(**gdal_options), ExitStack() as stack:
+            product_src, mask_src, anomaly_src = open_datasets(
+                stack, product_ds, mask_ds, anomaly_ds
+            )
+            geom = feature_geom(feature, product_src)
+            write_export(
+                tiled_path, geom, product_src, anomaly_src, mask_src, progress
+            )
+            progress.report(force=True)
+
+            cog_translate(
+                tiled_path,
+                cog_path,
+                cog_profiles.get("deflate"),
+                in_memory=False,
+                quiet=True,
+            )
+    except ExportCancelled:
+        shutil.rmtree(export_dir, ignore_errors=True)
+        cancel_export_job(export_id)
+        return None
+    except Exception:
+        shutil.rmtree(export_dir, ignore_errors=True)
+        raise
+
+    os.remove(tiled_path)
+    logging.info(f"Export {export_id} written to {cog_path}")
+    return export_id, cog_path
+
+
+def write_layer_exports(
+    export_dir,
+    feature_masks,
+    product_src,
+    anomaly_src=None,
+    mask_src=None,
+    progress=None,
+):
+    """
+    Write the export of every feature of `feature_masks` ({file name:
+    FeatureMask.to_cache() of the feature on the grid of `product_src`}) as
+    a COG in `export_dir`. The union of the feature windows is read once,
+    block by block, and each block is written to the features it intersects.
+    A feature's mask is unpacked and its file opened at the first block row
+    it covers, and it is translated to a COG after its last.
+    Yields (file name, COG path) as features are completed.
+    """
+    dtype = "float32" if anomaly_src is not None else product_src.dtypes[0]
+    nodata = export_nodata(product_src, dtype)
+    window = windows.union(
+        *[windows.Window(*packed["window"]) for packed in feature_masks.values()]
+    )
+
+    starts = {}
+    for index, (name, packed) in enumerate(feature_masks.items()):
+        col_off, row_off, width, height = packed["window"]
+        block_row = (row_off - int(window.row_off)) // EXPORT_BLOCK_SIZE
+        starts.setdefault(block_row, []).append((index, name))
+
+    blocks = list(iter_blocks(window))
+    if progress is not None:
+        progress.start(len(blocks))
+
+    # name: (FeatureMask, window relative to `window`, writer, tiled path)
+    active = {}
+    try:
+        for block in blocks:
+            if progress is not None:
+                progress.advance()
+                progress.report()
+
+            if block.col_off == 0:
+                for index, name in starts.pop(block.row_off // EXPORT_BLOCK_SIZE, []):
+                    feature_mask = FeatureMask.from_cache(feature_masks[name])
+                    path = os.path.join(export_dir, f"{index}.tif")
+                    profile = export_profile(
+                        product_src, feature_mask.window, dtype, nodata, compress=None
+                    )
+                    target = windows.Window(
+                        feature_mask.window.col_off - window.col_off,
+                        feature_mask.window.row_off - window.row_off,
+                        feature_mask.window.width,
+                        feature_mask.window.height,
+                    )
+                    active[name] = (
+                        feature_mask,
+                        target,
+                        rasterio.open(path, "w", **profile),
+                        path,
+                    )
+
+            overlaps = [
+                (name, windows.intersection(block, target))
+                for name, (feature_mask, target, dst, path) in active.items()
+                if windows.intersect(block, target)
+            ]
+            if overlaps:
+                src_window = windows.Window(
+                    window.col_off + block.col_off,
+                    window.row_off + block.row_off,
+                    block.width,
+                    block.height,
+                )
+                data = product_src.read(1, window=src_window, masked=True)
+                if anomaly_src is not None:
+                    data = data.astype(dtype) - anomaly_src.read(
+                        1, window=src_window, masked=True
+                    )
+                outside = np.ma.getmaskarray(data)
+                if mask_src is not None:
+                    crop = mask_src.read(1, window=src_window, masked=True)
+                    outside = outside | np.ma.filled(crop <= 0, True)
+
+            for name, overlap in overlaps:
+                feature_mask, target, dst, path = active[name]
+                in_block = windows.Window(
+                    overlap.col_off - block.col_off,
+                    overlap.row_off - block.row_off,
+                    overlap.width,
+                    overlap.height,
+                )
+                in_feature = windows.Window(
+                    overlap.col_off - target.col_off,
+                    overlap.row_off - target.row_off,
+                    overlap.width,
+                    overlap.height,
+                )
+                inside = feature_mask.mask[in_feature.toslices()]
+                if not inside.any():
+                    continue
+                part = np.ma.masked_where(
+                    ~inside | outside[in_block.toslices()],
+                    data[in_block.toslices()],
+                )
+                dst.write(part.filled(nodata).astype(dtype), 1, window=in_feature)
+
+            if block.col_off + block.width < window.width:
+                continue
+            # end of a block row: complete the features it is the last of
+            row_stop = block.row_off + block.height
+            for name in [
+                name
+                for name, (feature_mask, target, dst, path) in active.items()
+                if target.row_off + target.height <= row_stop
+            ]:
+                feature_mask, target, dst, path = active.pop(name)
+                dst.close()
+                cog_path = path.replace(".tif", ".cog.tif")
+                cog_translate(
+                    path,
+                    cog_path,
+                    cog_profiles.get("deflate"),
+                    in_memory=False,
+                    quiet=True,
+                )
+                os.remove(path)
+                yield name, cog_path
+    finally:
+        for feature_mask, target, dst, path in active.values():
+            dst.close()
+
+
+def cube_variable(cube, name, dims, dtype, nodata, attrs=None):
+    """Chunked, compressed NetCDF4 variable of `dims` (dimension scales)"""
+    shape = tuple(dim.shape[0] for dim in dims)
+    chunks = (1,) * (len(shape) - 2) + tuple(
+        min(CUBE_CHUNK_SIZE, size) for size in shape[-2:]
+    )
+    variable = cube.create_dataset(
+        name,
+        shape=shape,
+        dtype=dtype,
+        chunks=chunks,
+        compression="gzip",
+        shuffle=True,
+        fillvalue=nodata,
+    )
+    variable.attrs.create("_FillValue", nodata, dtype=dtype)
+    variable.attrs["grid_mapping"] = "spatial_ref"
+    for key, value in (attrs or {}).items():
+        variable.attrs[key] = value
+    for i, dim in enumerate(dims):
+        variable.dims[i].attach_scale(dim)
+    return variable
+
+
+def write_cube_layer(
+    variable, index, geom, window, reference, dataset, progress=None
+):
+    """
+    Thread pool worker: write a dataset over the export window into
+    `variable[index]` (or `variable` if `index` is None), block by block,
+    advancing `progress` after each block. The dataset is aligned to the
+    grid of `reference`.
+    """
+    transform = windows.transform(window, reference.transform)
+    nodata = variable.fillvalue
+
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS), ExitStack() as stack:
+        src = stack.enter_context(rasterio.open(get_raster_path(dataset.file_object)))
+        aligned = align_source(src, reference)
+        if aligned is not src:
+            src = stack.enter_context(aligned)
+
+        for block in iter_blocks(window):
+            if progress is not None:
+                progress.advance()
+
+            outside = features.geometry_mask(
+                [geom],
+                out_shape=(int(block.height), int(block.width)),
+                transform=windows.transform(block, transform),
+            )
+            if outside.all():
+                continue
+
+            src_window = windows.Window(
+                window.col_off + block.col_off,
+                window.row_off + block.row_off,
+                block.width,
+                block.height,
+            )
+            data = src.read(1, window=src_window, masked=True)
+            data = np.ma.masked_where(outside | np.ma.getmaskarray(data), data)
+            rows, cols = block.toslices()
+            target = (rows, cols) if index is None else (index, rows, cols)
+            variable[target] = data.filled(nodata).astype(variable.dtype)
+
+
+def write_cube(
+    path,
+    geom,
+    product_src,
+    product_datasets,
+    baseline_datasets=None,
+    mask_dataset=None,
+    attrs=None,
+    progress=None,
+):
+    """
+    Write product datasets over `geom` (GeoJSON in the CRS of `product_src`)
+    as a NetCDF4 file at `path`: a `product` (time, y, x) variable, with a
+    `baseline` (time, y, x) variable of the matching baseline datasets and
+    a `cropmask` (y, x) variable if given. Datasets are read and written
+    block by block, N_THREADS dates at a time, while this thread reports
+    `progress` (an ExportProgress).
+    """
+    window = export_window(product_src, geom)
+    transform = windows.transform(window, product_src.transform)
+    height, width = int(window.height), int(window.width)
+
+    with h5py.File(path, "w") as cube, ExitStack() as stack:
+        x = cube.create_dataset(
+            "x", data=transform.c + transform.a * (np.arange(width) + 0.5)
+        )
+        y = cube.create_dataset(
+            "y", data=transform.f + transform.e * (np.arange(height) + 0.5)
+        )
+        dates = cube.create_dataset(
+            "time",
+            data=[(ds.date - CUBE_EPOCH).days for ds in product_datasets],
+            dtype="int32",
+        )
+        dates.attrs["units"] = f"days since {CUBE_EPOCH.isoformat()}"
+        dates.attrs["calendar"] = "standard"
+        geographic = not product_src.crs or product_src.crs.is_geographic
+        for dim, name in ((x, "longitude"), (y, "latitude")):
+            dim.attrs["standard_name"] = name if geographic else f"projection_{name}"
+        for dim, name in ((dates, "time"), (y, "y"), (x, "x")):
+            dim.make_scale(name)
+
+        spatial_ref = cube.create_dataset("spatial_ref", data=0, dtype="int32")
+        if product_src.crs:
+            spatial_ref.attrs["crs_wkt"] = product_src.crs.to_wkt()
+            spatial_ref.attrs["spatial_ref"] = product_src.crs.to_wkt()
+            spatial_ref.attrs["GeoTransform"] = " ".join(
+                str(v) for v in transform.to_gdal()
+            )
+
+        dtype = product_src.dtypes[0]
+        layers = [
+            (
+                cube_variable(
+                    cube,
+                    "product",
+                    (dates, y, x),
+                    dtype,
+                    export_nodata(product_src, dtype),
+                    attrs,
+                ),
+                product_datasets,
+            )
+        ]
+
+        if baseline_datasets and any(baseline_datasets):
+            first = next(ds for ds in baseline_datasets if ds is not None)
+            baseline_src = stack.enter_context(
+                rasterio.open(get_raster_path(first.file_object))
+            )
+            dtype = baseline_src.dtypes[0]
+            layers.append(
+                (
+                    cube_variable(
+                        cube,
+                        "baseline",
+                        (dates, y, x),
+                        dtype,
+                        export_nodata(baseline_src, dtype),
+                    ),
+                    baseline_datasets,
+                )
+            )
+
+        if mask_dataset is not None:
+            mask_src = stack.enter_context(
+                rasterio.open(get_raster_path(mask_dataset.file_object))
+            )
+            dtype = mask_src.dtypes[0]
+            cropmask = cube_variable(
+                cube, "cropmask", (y, x), dtype, export_nodata(mask_src, dtype)
+            )
+
+        jobs = [
+            (variable, index, dataset)
+            for variable, datasets in layers
+            for index, dataset in enumerate(datasets)
+            if dataset is not None
+        ]
+        if progress is not None:
+            blocks = sum(1 for _ in iter_blocks(window))
+            progress.start(blocks * (len(jobs) + (mask_dataset is not None)))
+
+        if mask_dataset is not None:
+            write_cube_layer(
+                cropmask, None, geom, window, product_src, mask_dataset, progress
+            )
+
+        with ThreadPoolExecutor(max_workers=settings.N_THREADS) as executor:
+            pending = {
+                executor.submit(
+                    write_cube_layer,
+                    variable,
+                    index,
+                    geom,
+                    window,
+                    product_src,
+                    dataset,
+                    progress,
+                )
+                for variable, index, dataset in jobs
+            }
+            try:
+                while pending:
+                    done, pending = wait(
+                        pending, timeout=PROGRESS_INTERVAL, return_when=FIRST_EXCEPTION
+                    )
+                    for future in done:
+                        future.result()
+                    if progress is not None:
+                        progress.report()
+            except BaseException:
+                # stop the running layers at their next block
+                for future in pending:
+                    future.cancel()
+                if progress is not None:
+                    progress.stopped.set()
+                raise
+
+
+def cube_export(export_id, data):
+    """
+    Export every product dataset in a date range over a feature as a NetCDF4
+    file on local disk. Queued by ImageExportViewSet when an end_date is
+    given, uploaded by the upload_export hook.
+    :param export_id: id of the ImageExport instance
+    :param data: validated export parameters, see image_export, with an
+        end_date
+    :return: (export_id, path of the NetCDF4 file), None if the export was
+        cancelled
+    """
+    if not start_export_job(export_id):
+        return None
+
+    product_id = data.get("product_id")
+    product_datasets = get_product_datasets_between(
+        product_id, data["date"], data["end_date"]
+    )
+    if not product_datasets:
+        raise ValueError(
+            f"No {product_id} datasets from {data['date']} to {data['end_date']}"
+        )
+    baseline_datasets = None
+    if data.get("anomaly_type"):
+        baseline_datasets = get_baseline_datasets(
+            product_datasets,
+            data.get("anomaly"),
+            data.get("anomaly_type"),
+            data.get("diff_year"),
+        )
+        missing = [
+            str(product_ds.date)
+            for product_ds, baseline_ds in zip(product_datasets, baseline_datasets)
+            if baseline_ds is None
+        ]
+        if missing:
+            raise ValueError(
+                f"No {data['anomaly_type']} baseline for {product_id} on "
+                + ", ".join(missing)
+            )
+    mask_ds = get_mask_dataset(product_id, data.get("cropmask_id"))
+
+    feature = export_feature(data)
+    variable = product_datasets[0].product.variable
+    attrs = {
+        "long_name": variable.display_name,
+        "scale_factor": variable.scale,
+    }
+
+    export_dir = tempfile.mkdtemp(prefix=f"export-{export_id}-")
+    cube_path = os.path.join(export_dir, export_name(data, "nc"))
+    progress = ExportProgress(export_id, cube_path)
+
+    gdal_options = {**settings.GDAL_CONFIG_OPTIONS, "GDAL_CACHEMAX": EXPORT_CACHE_MB}
+    try:
+        with rasterio.Env(**gdal_options), ExitStack() as stack:
+            product_src = stack.enter_context(
+                rasterio.open(get_raster_path(product_datasets[0].file_object))
+            )
+            geom = feature_geom(feature, product_src)
+            write_cube(
+                cube_path,
+                geom,
+                product_src,
+                product_datasets,
+                baseline_datasets,
+                mask_ds,
+                attrs,
+                progress,
+            )
+            progress.report(force=True)
+    except ExportCancelled:
+        shutil.rmtree(export_dir, ignore_errors=True)
+        cancel_export_job(export_id)
+        return None
+    except Exception:
+        shutil.rmtree(export_dir, ignore_errors=True)
+        raise
+
+    logging.info(
+        f"Export {export_id}: {len(product_datasets)} datasets written to {cube_path}"
+    )
+    return export_id, cube_path
+
+
+def layer_export(export_id, data):
+    """
+    Export a product dataset over every feature of a boundary layer (or of
+    the layers with a tag, optionally within a parent feature) as a ZIP of
+    COGs on local disk, in one pass over the datasets. Queued by
+    ImageExportViewSet, uploaded by the upload_export hook.
+    :param export_id: id of the ImageExport instance
+    :param data: validated LayerExportBodySerializer data
+    :return: (export_id, path of the ZIP), None if the export was cancelled
+    """
+    if not start_export_job(export_id):
+        return None
+
+    product_ds, anomaly_ds, mask_ds = export_datasets(data)
+    features = layer_features(data)
+
+    export_dir = tempfile.mkdtemp(prefix=f"export-{export_id}-")
+    zip_path = os.path.join(export_dir, export_name(data, "zip"))
+    progress = ExportProgress(export_id, zip_path)
+
+    gdal_options = {**settings.GDAL_CONFIG_OPTIONS, "GDAL_CACHEMAX": EXPORT_CACHE_MB}
+    try:
+        with rasterio.Env(**gdal_options), ExitStack() as stack:
+            product_src, mask_src, anomaly_src = open_datasets(
+                stack, product_ds, mask_ds, anomaly_ds
+            )
+            # packed until their first block to bound memory use
+            feature_masks = {}
+            for feature in features:
+                feature_mask = get_feature_mask(product_src, feature)
+                if not feature_mask.is_empty:
+                    name = f"{feature.boundary_layer.layer_id}/{feature.feature_id}.tif"
+                    feature_masks[name] = feature_mask.to_cache()
+            if not feature_masks:
+                raise ValueError("No export features overlap the product dataset")
+
+            with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as archive:
+                for name, path in write_layer_exports(
+                    export_dir,
+                    feature_masks,
+                    product_src,
+                    anomaly_src,
+                    mask_src,
+                    progress,
+                ):
+                    archive.write(path, name)
+                    os.remove(path)
+            progress.report(force=True)
+    except ExportCancelled:
+        shutil.rmtree(export_dir, ignore_errors=True)
+        cancel_export_job(export_id)
+        return None
+    except Exception:
+        shutil.rmtree(export_dir, ignore_errors=True)
+        raise
+
+    logging.info(
+        f"Export {export_id}: {len(feature_masks)} features written to {zip_path}"
+    )
+    return export_id, zip_path
+
+
+def upload_export(task):
+    """
+    django-q hook of image_export, cube_export and layer_export: upload the
+    exported file to the ImageExport's file_object (a multipart transfer on
+    S3 storage) and set completed. Cancelled exports have no result.
+    """
+    if not task.success:
+        logging.error(f"Export {task.args[0]} failed: {task.result}")
+        # a new request for the same content starts a new export
+        ImageExport.objects.filter(id=task.args[0]).update(
+            status=ImageExport.FAILED, error=str(task.result), content_key=None
+        )
+        return
+    if task.result is None:
+        return
+
+    export_id, export_path = task.result
+    try:
+        export = ImageExport.objects.get(id=export_id)
+        export.status = ImageExport.UPLOADING
+        export.save(update_fields=["status"])
+        with open(export_path, "rb") as f:
+            export.file_object.save(
+                os.path.basename(export_path), File(f), save=False
+            )
+        export.status = ImageExport.COMPLETED
+        export.progress = 1
+        export.bytes_written = os.path.getsize(export_path)
+        export.completed = timezone.now()
+        export.save()
+    except Exception as e:
+        logging.error(f"Export {export_id} upload failed: {str(e)}")
+        ImageExport.objects.filter(id=export_id).update(
+            status=ImageExport.FAILED, error=str(e), content_key=None
+        )
+    finally:
+        shutil.rmtree(os.path.dirname(export_path), ignore_errors=True)
@@ -0,0 +1,149 @@
+"""
+Simplified boundary feature geometries
+
+Every boundary feature is simplified at ingest at each of the
+FEATURE_SIMPLIFY_TOLERANCES and stored as a SimplifiedFeatureGeometry.
+Rasterization and graphics then use the coarsest stored geometry whose
+tolerance is within a fraction of their pixel size (or graphic scale),
+falling back to the full geometry when none is fine enough.
+
+"""
+
+from django.conf import settings
+from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.db import transaction
+
+from .cache import METERS_PER_DEGREE
+from ..models import SimplifiedFeatureGeometry
+
+# Simplified boundaries stay within 1/SIMPLIFY_PIXEL_FRACTION of a pixel of
+# the full geometry, so only pixels whose centers lie that close to the
+# boundary can move in or out of a feature.
+SIMPLIFY_PIXEL_FRACTION = 4
+
+
+def simplify_geometry(geom, tolerance):
+    """
+    GEOS geometry simplified to `tolerance` (topology preserving) as a
+    MultiPolygon, or None if it collapses.
+    """
+    simplified = geom.simplify(tolerance, preserve_topology=True)
+    if simplified.empty:
+        return None
+    if simplified.geom_type == "Polygon":
+        simplified = MultiPolygon(simplified)
+    elif simplified.geom_type != "MultiPolygon":
+        return None
+    return simplified
+
+
+def save_simplified_geometries(boundary_features, tolerances=None):
+    """
+    Compute and store the simplified geometries of boundary features,
+    replacing any previously stored.
+    :param boundary_features: iterable of BoundaryFeature instances
+    :param tolerances: tolerances in degrees, FEATURE_SIMPLIFY_TOLERANCES
+        by default
+    :return: number of geometries saved
+    """
+    if tolerances is None:
+        tolerances = settings.FEATURE_SIMPLIFY_TOLERANCES
+
+    features = list(boundary_features)
+    geometries = []
+    for feature in features:
+        if feature.geom is None:
+            continue
+        for tolerance in tolerances:
+            simplified = simplify_geometry(feature.geom, tolerance)
+            if simplified is None:
+                continue
+            xmin, ymin, xmax, ymax = simplified.extent
+            geometries.append(
+                SimplifiedFeatureGeometry(
+                    boundary_feature=feature,
+                    tolerance=tolerance,
+                    geom=simplified,
+                    num_points=simplified.num_points,
+                    xmin=xmin,
+                    ymin=ymin,
+                    xmax=xmax,
+                    ymax=ymax,
+                    area=simplified.area,
+                )
+            )
+
+    with transaction.atomic():
+        SimplifiedFeatureGeometry.objects.filter(
+            boundary_feature__in=features
+        ).delete()
+        SimplifiedFeatureGeometry.objects.bulk_create(geometries, batch_size=1000)
+    return len(geometries)
+
+
+def raster_resolution(src) -> float:
+    """Pixel size in degrees of an open raster"""
+    resolution = min(abs(r) for r in src.res)
+    if src.crs and not src.crs.is_geographic:
+        resolution = resolution / METERS_PER_DEGREE
+    return resolution
+
+
+def simplified_geometry(feature, tolerance):
+    """
+    Geometry of a BoundaryFeature simplified to at most `tolerance` degrees:
+    the coarsest stored geometry within it, or the full geometry.
+    """
+    if tolerance:
+        simplified = (
+            SimplifiedFeatureGeometry.objects.filter(
+                boundary_feature=feature, tolerance__lte=tolerance
+            )
+            .order_by("-tolerance")
+            .only("geom")
+            .first()
+        )
+        if simplified is not None:
+            return simplified.geom
+    return feature.geom
+
+
+def pixel_geometry(feature, resolution):
+    """
+    Coarsest geometry of a BoundaryFeature whose boundary stays within
+    1/SIMPLIFY_PIXEL_FRACTION of a pixel of `resolution` degrees of the full
+    geometry, so that it covers the same pixels except for those whose
+    centers lie within that distance of the boundary.
+    """
+    return simplified_geometry(feature, resolution / SIMPLIFY_PIXEL_FRACTION)
+
+
+def simplified_geometries(queryset, tolerance):
+    """
+    Geometries of the BoundaryFeatures of a queryset simplified to
+    `tolerance` degrees, using the stored geometries where the tolerance
+    is one of FEATURE_SIMPLIFY_TOLERANCES and simplifying the rest the same
+    way (see simplify_geometry). Geometries that collapse are left out.
+    """
+    stored = {}
+    if tolerance in settings.FEATURE_SIMPLIFY_TOLERANCES:
+        stored = dict(
+            SimplifiedFeatureGeometry.objects.filter(
+                boundary_feature__in=queryset.values("pk"), tolerance=tolerance
+            ).values_list("boundary_feature_id", "geom")
+        )
+
+    missing = queryset.exclude(pk__in=list(stored)).only("pk", "geom")
+    simplified = [simplify_geometry(feature.geom, tolerance) for feature in missing]
+    return list(stored.values()) + [geom for geom in simplified if geom is not None]
+
+
+def extent_envelope(extent, buff=0):
+    """
+    Envelope polygon of an extent grown by `buff` degrees, the same as the
+    envelope of a geometry buffered by `buff` without buffering it.
+    """
+    xmin, ymin, xmax, ymax = extent
+    envelope = Polygon.from_bbox((xmin - buff, ymin - buff, xmax + buff, ymax + buff))
+    envelope.srid = 4326
+    return envelope
@@ -0,0 +1,225 @@
+"""
+Rasterized feature masks
+
+Boundary features are rasterized once per product grid and the resulting
+(window, boolean mask) pair is stored compressed in the cache backend.
+Zonal reads then only need an aligned windowed read of the raster.
+
+"""
+
+import json
+import math
+import zlib
+import hashlib
+import logging
+
+from dataclasses import dataclass
+
+import numpy as np
+
+from rasterio import features, windows
+from rasterio.enums import Resampling
+from rasterio.warp import transform_geom
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .cache import versioned_key
+from .geometries import pixel_geometry, raster_resolution
+from ..models import BoundaryFeature
+
+FEATURE_CRS = "EPSG:4326"
+
+MASK_CACHE_TIMEOUT = 60 * 60 * 24 * 365  # 1 year
+
+
+@dataclass
+class FeatureMask:
+    """
+    Boolean mask of a feature aligned to a raster grid.
+
+    `window` is the feature's bounding window on the grid identified by
+    `signature`, `mask` is True for pixels inside the feature.
+    """
+
+    window: windows.Window
+    mask: np.ndarray
+    signature: str
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    @property
+    def is_empty(self):
+        return self.mask.size == 0 or not self.mask.any()
+
+    def matches(self, src):
+        """Is the mask aligned with the grid of `src`?"""
+        return grid_signature(src) == self.signature
+
+    def to_cache(self):
+        packed = np.packbits(self.mask, axis=None)
+        return {
+            "window": (
+                int(self.window.col_off),
+                int(self.window.row_off),
+                int(self.window.width),
+                int(self.window.height),
+            ),
+            "mask": zlib.compress(packed.tobytes()),
+            "signature": self.signature,
+        }
+
+    @classmethod
+    def from_cache(cls, cached):
+        col_off, row_off, width, height = cached["window"]
+        packed = np.frombuffer(zlib.decompress(cached["mask"]), dtype=np.uint8)
+        mask = np.unpackbits(packed, count=width * height).astype(bool)
+        return cls(
+            window=windows.Window(col_off, row_off, width, height),
+            mask=mask.reshape((height, width)),
+            signature=cached["signature"],
+        )
+
+
+def grid_signature(src):
+    """
+    Short hash identifying the pixel grid (crs, transform and size) of a dataset.
+    Datasets sharing a grid (e.g. all rasters of a product) share masks.
+    """
+    crs = src.crs.to_string() if src.crs else ""
+    transform = tuple(round(v, 12) for v in tuple(src.transform)[:6])
+    grid = f"{crs}|{transform}|{src.width}|{src.height}"
+    return hashlib.sha1(grid.encode()).hexdigest()[:16]
+
+
+def feature_window(src, bounds):
+    """
+    Pixel window on `src` covering `bounds`, snapped outward to whole pixels
+    and clipped to the dataset extent.
+    """
+    minx, miny, maxx, maxy = bounds
+    inverse = ~src.transform
+    cols, rows = zip(
+        *[inverse * (x, y) for x, y in ((minx, maxy), (maxx, miny))]
+    )
+    col_start = max(0, math.floor(min(cols)))
+    col_stop = min(src.width, math.ceil(max(cols)))
+    row_start = max(0, math.floor(min(rows)))
+    row_stop = min(src.height, math.ceil(max(rows)))
+
+    return windows.Window(
+        col_start,
+        row_start,
+        max(0, col_stop - col_start),
+        max(0, row_stop - row_start),
+    )
+
+
+def rasterize_feature(src, geom, crs=FEATURE_CRS):
+    """
+    Rasterize a GeoJSON geometry (or Feature) onto the grid of `src`.
+    Features too small to contain any pixel center fall back to every
+    pixel they touch.
+    """
+    if geom.get("type") == "Feature":
+        geom = geom["geometry"]
+
+    if src.crs and src.crs.to_string() != crs:
+        geom = transform_geom(crs, src.crs, geom)
+
+    window = feature_window(src, features.bounds(geom))
+    signature = grid_signature(src)
+    shape = (int(window.height), int(window.width))
+
+    if 0 in shape:
+        return FeatureMask(window, np.zeros(shape, dtype=bool), signature)
+
+    transform = windows.transform(window, src.transform)
+    mask = features.geometry_mask(
+        [geom], out_shape=shape, transform=transform, invert=True
+    )
+    if not mask.any():
+        mask = features.geometry_mask(
+            [geom], out_shape=shape, transform=transform, invert=True, all_touched=True
+        )
+
+    return FeatureMask(window, mask, signature)
+
+
+def get_feature_mask(src, feature):
+    """
+    Return the FeatureMask of `feature` on the grid of `src`.
+
+    `feature` is either a BoundaryFeature, whose mask is cached per product
+    grid and feature version (bumped when the feature is saved), or a
+    GeoJSON geometry which is rasterized on every call.
+    """
+    if not isinstance(feature, BoundaryFeature):
+        return rasterize_feature(src, feature)
+
+    cache_key = versioned_key(
+        f"feature-mask-{feature.pk}-{grid_signature(src)}", feature
+    )
+
+    if settings.USE_CACHING:
+        cached = cache.get(cache_key)
+        if cached:
+            logging.debug(f"cache hit: {cache_key}")
+            return FeatureMask.from_cache(cached)
+        logging.debug(f"cache miss: {cache_key}")
+
+    geom = pixel_geometry(feature, raster_resolution(src))
+    feature_mask = rasterize_feature(src, json.loads(geom.geojson))
+
+    if settings.USE_CACHING:
+        cache.set(cache_key, feature_mask.to_cache(), timeout=MASK_CACHE_TIMEOUT)
+
+    return feature_mask
+
+
+def preview_shape(feature_mask, max_size):
+    """
+    Output shape with the longest side limited to `max_size`.
+    Features smaller than `max_size` are never upsampled.
+    """
+    height, width = feature_mask.shape
+    if not max_size or max(height, width) <= max_size:
+        return (height, width)
+    ratio = max_size / max(height, width)
+    return (max(1, round(height * ratio)), max(1, round(width * ratio)))
+
+
+def decimate_mask(mask, out_shape):
+    """Nearest-neighbour resample of a boolean mask to `out_shape`."""
+    height, width = mask.shape
+    if (height, width) == tuple(out_shape):
+        return mask
+    rows = ((np.arange(out_shape[0]) + 0.5) * height / out_shape[0]).astype(int)
+    cols = ((np.arange(out_shape[1]) + 0.5) * width / out_shape[1]).astype(int)
+    return mask[np.ix_(rows, cols)]
+
+
+def read_feature(src, feature_mask, max_size=None, band=1):
+    """
+    Aligned windowed read of `src` over a FeatureMask.
+
+    Returns a masked array where pixels outside the feature or equal to the
+    dataset's nodata value are masked.
+    """
+    out_shape = preview_shape(feature_mask, max_size)
+
+    if feature_mask.is_empty:
+        return np.ma.masked_all(out_shape, dtype=src.dtypes[band - 1])
+
+    data = src.read(
+        band,
+        window=feature_mask.window,
+        out_shape=out_shape,
+        masked=True,
+        resampling=Resampling.nearest,
+    )
+    outside = ~decimate_mask(feature_mask.mask, out_shape)
+
+    return np.ma.masked_array(data, mask=np.ma.getmaskarray(data) | outside)
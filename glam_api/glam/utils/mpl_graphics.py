@@ -0,0 +1,196 @@
+"""
+Matplotlib graphic rendering
+
+The high quality ("matplotlib") graphic renderer. Matplotlib is only
+imported in the processes of a small dedicated pool (GRAPHIC_PROCESSES per
+API worker, started on the first matplotlib graphic) preloaded with the Agg
+backend, so API workers never import it and rendering does not hold their
+GIL. Views send arrays and metadata and get PNG bytes back.
+
+"""
+
+import io
+import logging
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import shapely
+
+from django.conf import settings
+
+from .compositor import GRAY, LAND, iter_polygons
+
+_render_pool = None
+
+
+def init_renderer():
+    """Import matplotlib with the Agg backend (pool process initializer)"""
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+    import matplotlib.pyplot  # noqa: F401
+    from mpl_toolkits.axes_grid1 import inset_locator  # noqa: F401
+
+
+def get_render_pool():
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = ProcessPoolExecutor(
+            max_workers=settings.GRAPHIC_PROCESSES,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_renderer,
+        )
+    return _render_pool
+
+
+def render_matplotlib_graphic(**graphic) -> bytes:
+    """
+    PNG of a graphic (see draw_matplotlib_graphic) rendered in the render
+    pool, or in this process if GRAPHIC_PROCESSES is 0.
+    """
+    global _render_pool
+
+    if settings.GRAPHIC_PROCESSES < 1:
+        init_renderer()
+        return draw_matplotlib_graphic(**graphic)
+
+    try:
+        return get_render_pool().submit(draw_matplotlib_graphic, **graphic).result()
+    except BrokenProcessPool:
+        # a render process died, start a new pool for the next graphic
+        logging.warning("graphic render pool broken, restarting")
+        _render_pool = None
+        raise
+
+
+def polygon_patches(geometry, **kwargs):
+    """Matplotlib PathPatches (with holes) of a shapely (Multi)Polygon"""
+    from matplotlib.patches import PathPatch
+    from matplotlib.path import Path
+
+    patches = []
+    for polygon in iter_polygons(geometry):
+        path = Path.make_compound_path(
+            *[
+                Path(np.asarray(ring.coords)[:, :2], closed=True)
+                for ring in [polygon.exterior, *polygon.interiors]
+            ]
+        )
+        patches.append(PathPatch(path, **kwargs))
+    return patches
+
+
+def mpl_colormap(colormap):
+    """Matplotlib colormap of a colormap name or tuple of colors"""
+    from matplotlib.colors import LinearSegmentedColormap
+
+    if isinstance(colormap, tuple):
+        return LinearSegmentedColormap.from_list("ndvi", list(colormap), 256)
+    return colormap
+
+
+def draw_matplotlib_graphic(
+    figsize,
+    bounds,
+    backdrop,
+    feature,
+    data,
+    data_bounds,
+    colormap,
+    stretch,
+    label=None,
+    legend=None,
+    scale=1,
+    logo=None,
+) -> bytes:
+    """
+    PNG of a boundary feature graphic drawn as a matplotlib figure of
+    `figsize` inches over `bounds`: `backdrop` and `feature` geometries as
+    WKB, the 2D (masked) `data` array covering `data_bounds` colored with
+    `colormap` over `stretch`, the `label` text, the `legend` colorbar label
+    with ticks in product units (values * `scale`) and a `logo` RGBA array.
+    """
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as tkr
+    from matplotlib.offsetbox import AnchoredText
+    from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+
+    fig = plt.figure(figsize=figsize)
+    try:
+        ax = fig.add_subplot(1, 1, 1, frameon=False)
+
+        for wkb in backdrop:
+            for patch in polygon_patches(
+                shapely.from_wkb(wkb),
+                fc=LAND,
+                ec="black",
+                linestyle=":",
+                alpha=1,
+                zorder=0,
+            ):
+                ax.add_patch(patch)
+
+        feature = shapely.from_wkb(feature)
+        for patch in polygon_patches(
+            feature, fc=GRAY, linewidth=0, alpha=0.5, zorder=0.5
+        ):
+            ax.add_patch(patch)
+        for patch in polygon_patches(
+            feature, color="black", linewidth=1.5, fill=False, alpha=1, zorder=2
+        ):
+            ax.add_patch(patch)
+
+        x1, y1, x2, y2 = bounds
+        ax.set_xlim([x1, x2])
+        ax.set_ylim([y1, y2])
+
+        # remove ticks
+        ax.axes.xaxis.set_visible(False)
+        ax.axes.yaxis.set_visible(False)
+
+        image = ax.imshow(
+            data,
+            extent=[data_bounds[0], data_bounds[2], data_bounds[1], data_bounds[3]],
+            cmap=mpl_colormap(colormap),
+            vmin=stretch[0],
+            vmax=stretch[1],
+            zorder=1,
+        )
+
+        if label:
+            text = AnchoredText(
+                label, loc="lower right", prop={"size": 8}, frameon=True
+            )
+            ax.add_artist(text)
+
+        if legend:
+            cbaxes = inset_axes(ax, "33%", "3%", loc="upper right", borderpad=1)
+            cbaxes.tick_params(labelsize=8)
+            cb = fig.colorbar(
+                image,
+                cax=cbaxes,
+                orientation="horizontal",
+                format=tkr.FuncFormatter(lambda x, pos: "{:g}".format(x * scale)),
+            )
+            cb.set_label(label=legend, fontsize=8)
+
+        if logo is not None:
+            logo_ax = inset_axes(ax, width="15%", height="10%", loc="lower left")
+            logo_ax.imshow(logo, alpha=0.75, origin="upper")
+            logo_ax.axis("off")
+
+        output = io.BytesIO()
+        fig.savefig(
+            output,
+            format="png",
+            transparent=True,
+            bbox_inches="tight",
+            pad_inches=0,
+        )
+        return output.getvalue()
+    finally:
+        plt.close(fig)
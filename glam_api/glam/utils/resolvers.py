@@ -0,0 +1,338 @@
+"""
+Dataset resolvers and read plans
+
+Resolve the ProductRaster, CropmaskRaster and AnomalyBaselineRaster records
+a request reads, shared by the views and their `?explain=true` mode, which
+reports the raster read plan without reading any pixels.
+
+"""
+
+import datetime
+import math
+
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio
+
+from rasterio.features import bounds as geojson_bounds
+from rasterio.warp import transform_bounds
+
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+
+from config.utils import closest_in_index, date_index
+
+from . import get_raster_path
+from .cache import product_dates_key
+from .masks import FEATURE_CRS, feature_window
+from .zonal import bounds_shape, decimation_factor, plan_resolution
+from ..models import (
+    AnomalyBaselineRaster,
+    BoundaryFeature,
+    CropMask,
+    CropmaskRaster,
+    ProductRaster,
+)
+
+# Products whose baselines are stored by month and day (e.g. 121 for 01-21)
+MONTH_DAY_BASELINE_PRODUCTS = ["chirps-precip", "copernicus-swi"]
+
+EXPLAIN_VALUES = ["true", "1", "yes"]
+
+
+def wants_explain(request) -> bool:
+    """Was `?explain=true` passed with the request?"""
+    return str(request.query_params.get("explain", "")).lower() in EXPLAIN_VALUES
+
+
+def explain_response(request, plan) -> Response:
+    """
+    Response with a read plan, rendered as JSON whatever renderers the view
+    uses for its data (PNG, pandas, ...).
+    """
+    request.accepted_renderer = JSONRenderer()
+    request.accepted_media_type = JSONRenderer.media_type
+    return Response(plan)
+
+
+def baseline_day_of_year(product_id: str, date) -> int:
+    """
+    Day of year key of the AnomalyBaselineRaster matching a date.
+    Matches the encoding used by AnomalyBaselineRaster.save.
+    """
+    if product_id in MONTH_DAY_BASELINE_PRODUCTS:
+        return int(f"{date.month}{date.day:02d}")
+    return date.timetuple().tm_yday
+
+
+def product_date_index(product_id: str):
+    """
+    Sorted (date, pk) index of a product's datasets, preferring final over
+    preliminary datasets of the same date. Cached until one of the product's
+    datasets is saved or deleted (see glam.signals).
+    """
+    cache_key = product_dates_key(product_id)
+    if settings.USE_CACHING:
+        index = cache.get(cache_key)
+        if index is not None:
+            return index
+
+    index = date_index(ProductRaster.objects.filter(product__product_id=product_id))
+
+    if settings.USE_CACHING:
+        cache.set(cache_key, index, timeout=None)
+    return index
+
+
+def get_product_datasets(product_id: str, dates, exact=False):
+    """
+    ProductRaster closest to (or on, if `exact`) each of `dates`, in order,
+    with None where there is no match. Resolved against the product's date
+    index with a single query for the matching records.
+    """
+    pks = closest_in_index(product_date_index(product_id), dates, exact=exact)
+    datasets = ProductRaster.objects.select_related("product__variable").in_bulk(
+        [pk for pk in pks if pk is not None]
+    )
+    return [datasets.get(pk) for pk in pks]
+
+
+def get_product_datasets_between(product_id: str, start, end):
+    """ProductRasters of a product dated from `start` to `end`, by date"""
+    pks = [
+        pk for date, pk in product_date_index(product_id) if start <= date <= end
+    ]
+    datasets = ProductRaster.objects.select_related("product__variable").in_bulk(pks)
+    return [datasets[pk] for pk in pks if pk in datasets]
+
+
+def get_product_dataset(product_id: str, date):
+    """ProductRaster of a product on a date (final preferred), or 404"""
+    if isinstance(date, str):
+        try:
+            date = datetime.date.fromisoformat(date)
+        except ValueError:
+            raise Http404("Invalid dataset date")
+    elif isinstance(date, datetime.datetime):
+        date = date.date()
+
+    product_dataset = get_product_datasets(product_id, [date], exact=True)[0]
+    if product_dataset is None:
+        raise Http404("No ProductRaster matches the given query.")
+    return product_dataset
+
+
+def get_mask_dataset(product_id: str, cropmask_id: str = None):
+    """CropmaskRaster of a crop mask on a product's grid (None for no mask)"""
+    if not cropmask_id or cropmask_id == "no-mask":
+        return None
+    mask_queryset = CropmaskRaster.objects.all()
+    return get_object_or_404(
+        mask_queryset,
+        product__product_id=product_id,
+        crop_mask__cropmask_id=cropmask_id,
+    )
+
+
+def diff_year_date(date, diff_year: int):
+    """The same day in `diff_year` (28 February for 29 February)"""
+    try:
+        return date.replace(year=diff_year)
+    except ValueError:
+        return date.replace(year=diff_year, day=28)
+
+
+def get_baseline_dataset(product_dataset, baseline, baseline_type, diff_year=None):
+    """
+    Return the dataset that a product dataset is compared against:
+    an AnomalyBaselineRaster, or for "diff" the closest ProductRaster
+    from `diff_year`.
+    """
+    product_id = product_dataset.product.product_id
+
+    if baseline_type == "diff":
+        if diff_year is None:
+            raise APIException("diff_year is required for 'diff' anomalies")
+        return get_product_datasets(
+            product_id, [diff_year_date(product_dataset.date, diff_year)]
+        )[0]
+
+    baseline_queryset = AnomalyBaselineRaster.objects.all()
+    return get_object_or_404(
+        baseline_queryset,
+        product__product_id=product_id,
+        day_of_year=baseline_day_of_year(product_id, product_dataset.date),
+        baseline_length=baseline,
+        baseline_type=baseline_type,
+    )
+
+
+def get_baseline_datasets(
+    product_datasets, baseline, baseline_type, diff_year=None
+):
+    """
+    Bulk get_baseline_dataset for datasets of one product: "diff" datasets
+    are resolved together against the product's date index, and baselines
+    shared by several datasets are fetched once.
+    """
+    if not product_datasets:
+        return []
+
+    if baseline_type == "diff":
+        if diff_year is None:
+            raise APIException("diff_year is required for 'diff' anomalies")
+        return get_product_datasets(
+            product_datasets[0].product.product_id,
+            [diff_year_date(dataset.date, diff_year) for dataset in product_datasets],
+        )
+
+    baselines = {}
+    for dataset in product_datasets:
+        day_of_year = baseline_day_of_year(dataset.product.product_id, dataset.date)
+        if day_of_year not in baselines:
+            baselines[day_of_year] = get_baseline_dataset(
+                dataset, baseline, baseline_type
+            )
+    return [
+        baselines[baseline_day_of_year(dataset.product.product_id, dataset.date)]
+        for dataset in product_datasets
+    ]
+
+
+def feature_bounds(feature):
+    """Bounds in FEATURE_CRS of a BoundaryFeature or GeoJSON geometry/Feature"""
+    if isinstance(feature, BoundaryFeature):
+        return feature.geom.extent
+    if feature.get("type") == "Feature":
+        feature = feature["geometry"]
+    return geojson_bounds(feature)
+
+
+def dataset_read_plan(role, dataset, bounds, max_size=None, crs=FEATURE_CRS):
+    """
+    Read plan of one dataset over `bounds` (in `crs`): file, window, overview
+    level, output shape, and an estimate of bytes and range requests from the
+    number of internal blocks the read touches. Only the header is read.
+    """
+    # tiles read a crop mask's map raster rather than a CropmaskRaster
+    if isinstance(dataset, CropMask):
+        path = get_raster_path(dataset.map_raster)
+    else:
+        path = get_raster_path(dataset.file_object)
+
+    with rasterio.open(path) as src:
+        src_bounds = bounds
+        if src.crs and src.crs.to_string() != crs:
+            src_bounds = transform_bounds(crs, src.crs, *bounds)
+        window = feature_window(src, src_bounds)
+        height, width = int(window.height), int(window.width)
+
+        decimation = 1
+        if max_size and max(height, width) > max_size:
+            decimation = max(height, width) / max_size
+        out_shape = (
+            max(1, round(height / decimation)) if height else 0,
+            max(1, round(width / decimation)) if width else 0,
+        )
+
+        # GDAL reads from the coarsest overview that is not coarser than needed
+        overviews = src.overviews(1)
+        overview = max([f for f in overviews if f <= decimation], default=None)
+        level = overview or 1
+
+        # internal blocks touched by the window at that overview level
+        block_height, block_width = src.block_shapes[0]
+        blocks = 0
+        if height and width:
+            row_start = int(window.row_off // level) // block_height
+            row_stop = math.ceil((window.row_off + height) / level) - 1
+            col_start = int(window.col_off // level) // block_width
+            col_stop = math.ceil((window.col_off + width) / level) - 1
+            blocks = (row_stop // block_height - row_start + 1) * (
+                col_stop // block_width - col_start + 1
+            )
+        block_bytes = block_height * block_width * np.dtype(src.dtypes[0]).itemsize
+
+        return {
+            "role": role,
+            "model": dataset._meta.object_name,
+            "id": dataset.pk,
+            "name": str(dataset),
+            "date": str(getattr(dataset, "date", "")) or None,
+            "path": path,
+            "crs": src.crs.to_string() if src.crs else None,
+            "dtype": src.dtypes[0],
+            "size": [src.height, src.width],
+            "block_shape": [block_height, block_width],
+            "overviews": overviews,
+            "window": {
+                "col_off": int(window.col_off),
+                "row_off": int(window.row_off),
+                "width": width,
+                "height": height,
+            },
+            "overview_level": overview,
+            "decimation": round(decimation, 3),
+            "out_shape": list(out_shape),
+            "blocks": blocks,
+            "estimated_bytes": blocks * block_bytes,
+            # tiled COGs are fetched one block per (possibly merged) request
+            "range_requests": blocks if path.startswith("s3://") else 0,
+        }
+
+
+def read_plan(route, datasets, bounds, max_size=None, resolution=None, **extra):
+    """
+    Read plan of a request: `datasets` is a list of (role, dataset) pairs,
+    None datasets are skipped. Totals are summed over datasets.
+    """
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS):
+        plans = [
+            dataset_read_plan(role, dataset, bounds, max_size=max_size)
+            for role, dataset in datasets
+            if dataset is not None
+        ]
+    return {
+        "explain": True,
+        "route": route,
+        "bounds": list(bounds),
+        "resolution": resolution,
+        "max_size": max_size,
+        **extra,
+        "datasets": plans,
+        "estimated_bytes": sum(p["estimated_bytes"] for p in plans),
+        "range_requests": sum(p["range_requests"] for p in plans),
+    }
+
+
+def feature_read_plan(
+    route, datasets, feature, resolution="full", time_budget=None, **extra
+):
+    """
+    Read plan of a zonal request over a feature, choosing the resolution
+    with the same time budget planning as the zonal statistics engine.
+    The first dataset in `datasets` must be the product.
+    """
+    bounds = feature_bounds(feature)
+
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS), ExitStack() as stack:
+        sources = [
+            stack.enter_context(rasterio.open(get_raster_path(dataset.file_object)))
+            for role, dataset in datasets
+            if dataset is not None
+        ]
+        shape = bounds_shape(sources[0], bounds)
+        max_size, resolution_used = plan_resolution(
+            shape, sources, resolution, time_budget
+        )
+        if resolution == "full":
+            extra["queued"] = decimation_factor(shape, sources, time_budget) > 1
+
+    return read_plan(route, datasets, bounds, max_size, resolution_used, **extra)
@@ -0,0 +1,73 @@
+"""
+Histogram sketches
+
+A sketch is a fine fixed-bin histogram (HISTOGRAM_SKETCH_BINS bins over a
+fixed value range per product) of a product dataset over a feature. Sketches
+of a product share their bin edges. Coarser histograms are derived from
+them by interpolating the cumulative counts, assuming values are uniform
+within each fine bin; histograms whose bin edges are all sketch edges are
+exact.
+
+"""
+
+import numpy as np
+
+
+def sketch_range(product):
+    """
+    Value range (unscaled) of a product's sketches: the product's
+    meta["valid_range"]. None if it is not set (sketches are not computed).
+    """
+    meta = product.meta or {}
+    if meta.get("valid_range"):
+        low, high = meta["valid_range"]
+        return (float(low), float(high))
+    return None
+
+
+def sketch_edges(counts, value_range):
+    return np.linspace(value_range[0], value_range[1], len(counts) + 1)
+
+
+def sketch_matches(counts, value_range, bins=10, range=None):
+    """
+    Are the edges of a histogram with `bins` bins over `range` all edges of
+    a sketch, so that the histogram derived from it is exact?
+    """
+    if range is None:
+        return False
+    edges = np.histogram_bin_edges([], bins=bins, range=range)
+    fine_edges = sketch_edges(counts, value_range)
+    return bool(np.isclose(edges[:, None], fine_edges[None, :]).any(axis=1).all())
+
+
+def sketch_value_range(counts, value_range):
+    """(min, max) bounds of the values in a sketch, None if it is empty"""
+    filled = np.flatnonzero(counts)
+    if not filled.size:
+        return None
+    edges = sketch_edges(counts, value_range)
+    return (float(edges[filled[0]]), float(edges[filled[-1] + 1]))
+
+
+def sketch_histogram(counts, value_range, bins=10, range=None, density=False):
+    """
+    Histogram with `bins` bins over `range` derived from a sketch, matching
+    the output of zonal.feature_histogram. Returns (hist list, edges list).
+    """
+    counts = np.asarray(counts, dtype="float64")
+    if range is None:
+        range = sketch_value_range(counts, value_range) or (0.0, 1.0)
+
+    cumulative = np.concatenate([[0.0], np.cumsum(counts)])
+    bin_edges = np.histogram_bin_edges([], bins=bins, range=range)
+    hist = np.diff(np.interp(bin_edges, sketch_edges(counts, value_range), cumulative))
+
+    if density:
+        total = hist.sum()
+        hist = hist / (total * np.diff(bin_edges)) if total else hist
+    elif np.allclose(hist, np.round(hist)):
+        hist = np.round(hist).astype("int64")
+
+    return hist.tolist(), bin_edges.tolist()
+
@@ -0,0 +1,540 @@
+"""
+Zonal statistics
+
+Exact statistics over a feature are accumulated by streaming the raster's
+internal blocks that intersect the feature window, so memory use depends on
+the block size rather than on the size of the feature. Product, cropmask and
+baseline are read together and reduced in a single pass.
+
+"""
+
+import math
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+
+import numpy as np
+
+import rasterio
+
+from rasterio import windows
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+
+from django.conf import settings
+
+from . import get_raster_path
+from .masks import (
+    FEATURE_CRS,
+    feature_window,
+    get_feature_mask,
+    read_feature,
+)
+
+
+class RunningStats:
+    """
+    Streaming weighted count, sum, sum of squares, min and max of a series
+    of arrays. Values are accumulated in float64, shifted by the first value
+    seen to keep the variance numerically stable.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.weight = 0.0
+        self.shift = None
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values, weights=None):
+        if np.ma.isMaskedArray(values):
+            if weights is not None:
+                weights = np.asarray(weights)[~np.ma.getmaskarray(values)]
+            values = values.compressed()
+        values = np.asarray(values, dtype="float64").ravel()
+        if values.size == 0:
+            return
+
+        if self.shift is None:
+            self.shift = float(values[0])
+        shifted = values - self.shift
+
+        self.count += values.size
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        if weights is None:
+            self.weight += values.size
+            self.total += float(shifted.sum())
+            self.total_sq += float(np.dot(shifted, shifted))
+        else:
+            weights = np.asarray(weights, dtype="float64").ravel()
+            weighted = weights * shifted
+            self.weight += float(weights.sum())
+            self.total += float(weighted.sum())
+            self.total_sq += float(np.dot(weighted, shifted))
+
+    @property
+    def mean(self):
+        if not self.weight:
+            return None
+        return self.shift + self.total / self.weight
+
+    @property
+    def std(self):
+        if not self.weight:
+            return None
+        mean = self.total / self.weight
+        return math.sqrt(max(0.0, self.total_sq / self.weight - mean * mean))
+
+
+def chunk_shape(src):
+    """
+    Shape of the chunks to stream from `src`: a multiple of its internal
+    block size, or DEFAULT_BLOCK_SIZE for striped datasets.
+    """
+    block_height, block_width = src.block_shapes[0]
+    if block_height == 1 or block_width == src.width:
+        block_height = block_width = settings.DEFAULT_BLOCK_SIZE
+    return (
+        block_height * settings.BLOCK_SCALE_FACTOR,
+        block_width * settings.BLOCK_SCALE_FACTOR,
+    )
+
+
+def feature_blocks(src, feature_mask):
+    """
+    Yield (window, inside) pairs for every chunk of `src` that intersects the
+    feature, where `inside` is the slice of the feature mask for that window.
+    Chunks are aligned to the dataset's internal tiling and chunks entirely
+    outside the feature are skipped.
+    """
+    chunk_height, chunk_width = chunk_shape(src)
+    window = feature_mask.window
+    row_start, col_start = int(window.row_off), int(window.col_off)
+    row_stop = row_start + int(window.height)
+    col_stop = col_start + int(window.width)
+
+    for row in range(row_start - row_start % chunk_height, row_stop, chunk_height):
+        for col in range(col_start - col_start % chunk_width, col_stop, chunk_width):
+            r0, r1 = max(row, row_start), min(row + chunk_height, row_stop)
+            c0, c1 = max(col, col_start), min(col + chunk_width, col_stop)
+            inside = feature_mask.mask[
+                r0 - row_start : r1 - row_start, c0 - col_start : c1 - col_start
+            ]
+            if inside.any():
+                yield windows.Window(c0, r0, c1 - c0, r1 - r0), inside
+
+
+def align_source(src, reference):
+    """
+    Return `src`, or a WarpedVRT of it on the grid of `reference` if the two
+    datasets do not share a pixel grid.
+    """
+    if src is None or (
+        src.crs == reference.crs
+        and src.transform.almost_equals(reference.transform)
+        and src.shape == reference.shape
+    ):
+        return src
+    return WarpedVRT(
+        src,
+        crs=reference.crs,
+        transform=reference.transform,
+        width=reference.width,
+        height=reference.height,
+        resampling=Resampling.nearest,
+    )
+
+
+def decimation_factor(shape, sources, time_budget=None):
+    """
+    Overview level (a power of 2) at which reading a window of `shape` from
+    every dataset in `sources` is estimated to fit within `time_budget`
+    seconds. 1 means the native resolution fits.
+    """
+    if time_budget is None:
+        time_budget = settings.QUERY_TIME_BUDGET
+
+    height, width = shape
+    n_bytes = sum(
+        height * width * np.dtype(src.dtypes[0]).itemsize
+        for src in sources
+        if src is not None
+    )
+    budget_bytes = max(time_budget, 0) * settings.ZONAL_READ_BYTES_PER_SECOND
+
+    factor = 1
+    while n_bytes / (factor * factor) > budget_bytes and factor < max(shape):
+        factor *= 2
+    return factor
+
+
+def plan_resolution(shape, sources, resolution="auto", time_budget=None):
+    """
+    Pick the read resolution of a feature window of `shape`.
+
+    Returns (max_size, label): `max_size` to pass to the readers (None for
+    native resolution) and a label of the resolution used, "full" or the
+    decimation as a fraction (e.g. "1/4").
+    """
+    longest = max(shape) if shape else 0
+
+    if resolution == "full" or not longest:
+        return None, "full"
+
+    if resolution == "preview":
+        max_size = settings.PREVIEW_MAX_SIZE
+    else:
+        factor = decimation_factor(shape, sources, time_budget)
+        if factor == 1:
+            return None, "full"
+        max_size = max(1, math.ceil(longest / factor))
+
+    if longest <= max_size:
+        return None, "full"
+    return max_size, f"1/{math.ceil(longest / max_size)}"
+
+
+def bounds_shape(src, bounds, crs=FEATURE_CRS):
+    """Shape of the pixel window of `src` covering `bounds` given in `crs`"""
+    if src.crs and src.crs.to_string() != crs:
+        bounds = transform_bounds(crs, src.crs, *bounds)
+    window = feature_window(src, bounds)
+    return (int(window.height), int(window.width))
+
+
+def open_datasets(stack, product_dataset, *datasets):
+    """
+    Open the rasters of a product dataset and any other datasets (cropmask,
+    baseline) on `stack` (a contextlib.ExitStack), aligning the others to the
+    product grid. Returns the list of readers; None datasets stay None.
+    """
+    product_src = stack.enter_context(
+        rasterio.open(get_raster_path(product_dataset.file_object))
+    )
+    sources = [product_src]
+    for dataset in datasets:
+        if dataset is None:
+            sources.append(None)
+            continue
+        src = stack.enter_context(rasterio.open(get_raster_path(dataset.file_object)))
+        aligned = align_source(src, product_src)
+        if aligned is not src:
+            stack.enter_context(aligned)
+        sources.append(aligned)
+    return sources
+
+
+def iter_feature_arrays(feature_mask, sources, max_size=None):
+    """
+    Yield a tuple of masked arrays, one per dataset in `sources`, for each
+    chunk of the feature. `sources` must share the grid of the FeatureMask;
+    None entries yield None.
+
+    If `max_size` is given the whole feature is read once as a preview
+    with its longest side limited to `max_size` pixels.
+    """
+    if feature_mask.is_empty:
+        return
+
+    if max_size:
+        yield tuple(
+            read_feature(src, feature_mask, max_size=max_size) if src else None
+            for src in sources
+        )
+        return
+
+    reference = next(src for src in sources if src is not None)
+    for window, inside in feature_blocks(reference, feature_mask):
+        arrays = []
+        for src in sources:
+            if src is None:
+                arrays.append(None)
+                continue
+            data = src.read(1, window=window, masked=True)
+            arrays.append(
+                np.ma.masked_array(data, mask=np.ma.getmaskarray(data) | ~inside)
+            )
+        yield tuple(arrays)
+
+
+def iter_feature_values(
+    feature_mask, product_src, mask_src=None, baseline_src=None, max_size=None
+):
+    """
+    Yield (values, weights, baseline) float64 arrays of the valid pixels in
+    each chunk of the feature, reading product, cropmask and baseline together.
+
+    Pixels are valid where the product (and baseline) have data and the
+    cropmask is greater than zero. The cropmask value is the pixel weight, so
+    binary masks select cropland and percent masks weight by crop fraction.
+    `weights` and `baseline` are None when no cropmask or baseline is given.
+    """
+    sources = [product_src, mask_src, baseline_src]
+    for data, mask_data, baseline_data in iter_feature_arrays(
+        feature_mask, sources, max_size=max_size
+    ):
+        valid = ~np.ma.getmaskarray(data)
+        if mask_data is not None:
+            valid &= ~np.ma.getmaskarray(mask_data)
+            valid &= np.ma.getdata(mask_data) > 0
+        if baseline_data is not None:
+            valid &= ~np.ma.getmaskarray(baseline_data)
+        if not valid.any():
+            continue
+
+        values = np.ma.getdata(data)[valid].astype("float64")
+        weights = None
+        if mask_data is not None:
+            weights = np.ma.getdata(mask_data)[valid].astype("float64")
+        baseline = None
+        if baseline_data is not None:
+            baseline = np.ma.getdata(baseline_data)[valid].astype("float64")
+
+        yield values, weights, baseline
+
+
+def zonal_stats(
+    feature_mask, product_src, mask_src=None, baseline_src=None, max_size=None
+):
+    """
+    Single pass statistics of a product, and optionally a baseline, over a
+    feature. Returns a (product, baseline) pair of RunningStats in raw
+    (unscaled) product units; baseline stats are empty without a baseline.
+    """
+    product_stats = RunningStats()
+    baseline_stats = RunningStats()
+
+    for values, weights, baseline in iter_feature_values(
+        feature_mask, product_src, mask_src, baseline_src, max_size=max_size
+    ):
+        product_stats.update(values, weights)
+        if baseline is not None:
+            baseline_stats.update(baseline, weights)
+
+    return product_stats, baseline_stats
+
+
+def iter_histogram_values(
+    feature_mask, product_src, mask_src=None, baseline_src=None, max_size=None
+):
+    """
+    Yield (values, weights) of each chunk of the feature, values being the
+    difference from the baseline if one is given.
+    """
+    for values, weights, baseline in iter_feature_values(
+        feature_mask, product_src, mask_src, baseline_src, max_size=max_size
+    ):
+        if baseline is not None:
+            values = values - baseline
+        yield values, weights
+
+
+def feature_value_range(
+    feature_mask, product_src, mask_src=None, baseline_src=None, max_size=None
+):
+    """(min, max) of the histogram values over a feature, None if it has none"""
+    stats = RunningStats()
+    for values, weights in iter_histogram_values(
+        feature_mask, product_src, mask_src, baseline_src, max_size=max_size
+    ):
+        stats.update(values)
+    return (stats.min, stats.max) if stats.count else None
+
+
+def feature_histogram(
+    feature_mask,
+    product_src,
+    mask_src=None,
+    baseline_src=None,
+    bins=10,
+    range=None,
+    density=False,
+    max_size=None,
+):
+    """
+    Histogram of a product (minus the baseline, if given) over a feature,
+    computed chunk by chunk with fixed bin edges and weighted by the cropmask.
+    If `range` is not given a first pass finds the minimum and maximum.
+    """
+    if range is None:
+        range = feature_value_range(
+            feature_mask, product_src, mask_src, baseline_src, max_size=max_size
+        )
+        range = range or (0.0, 1.0)
+
+    bin_edges = np.histogram_bin_edges([], bins=bins, range=range)
+    hist = np.zeros(len(bin_edges) - 1, dtype="float64")
+
+    for values, weights in iter_histogram_values(
+        feature_mask, product_src, mask_src, baseline_src, max_size=max_size
+    ):
+        hist += np.histogram(values, bins=bin_edges, weights=weights)[0]
+
+    if density:
+        total = hist.sum()
+        hist = hist / (total * np.diff(bin_edges)) if total else hist
+    elif np.all(hist == np.round(hist)):
+        hist = hist.astype("int64")
+
+    return hist.tolist(), bin_edges.tolist()
+
+
+def feature_coverage(feature_mask, mask_src=None):
+    """
+    Return (arable_pixels, total_pixels, crop_weight) of a feature: the number
+    of pixels in the feature, how many of them have a cropmask value above
+    zero and the sum of those cropmask values.
+    """
+    total = int(feature_mask.mask.sum())
+    if mask_src is None:
+        return total, total, float(total)
+
+    arable = 0
+    weight = 0.0
+    for (mask_data,) in iter_feature_arrays(feature_mask, [mask_src]):
+        crop = mask_data[mask_data > 0].compressed()
+        arable += int(crop.size)
+        weight += float(crop.sum(dtype="float64"))
+    return arable, total, weight
+
+
+def _dataset_stats(feature_mask, feature, product_dataset, mask_dataset, max_size):
+    """
+    Thread pool worker: product RunningStats of one product dataset. The
+    shared FeatureMask is only replaced if the dataset is on another grid.
+    """
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env, ExitStack() as stack:
+        product_src, mask_src = open_datasets(stack, product_dataset, mask_dataset)
+        if not feature_mask.matches(product_src):
+            feature_mask = get_feature_mask(product_src, feature)
+        product_stats, _ = zonal_stats(
+            feature_mask, product_src, mask_src, max_size=max_size
+        )
+    return product_stats
+
+
+def map_feature_stats(
+    feature_mask, feature, product_datasets, mask_dataset=None, max_size=None
+):
+    """
+    Zonal statistics of a feature (BoundaryFeature or GeoJSON) for many
+    product datasets, read concurrently by N_THREADS threads sharing one
+    FeatureMask. Returns a list of RunningStats in the order of
+    `product_datasets`.
+    """
+    if len(product_datasets) <= 1:
+        return [
+            _dataset_stats(feature_mask, feature, dataset, mask_dataset, max_size)
+            for dataset in product_datasets
+        ]
+
+    with ThreadPoolExecutor(max_workers=settings.N_THREADS) as executor:
+        return list(
+            executor.map(
+                lambda dataset: _dataset_stats(
+                    feature_mask, feature, dataset, mask_dataset, max_size
+                ),
+                product_datasets,
+            )
+        )
+
+
+def feature_decimates(feature, product_dataset, mask_dataset=None, time_budget=None):
+    """
+    Whether reading a feature from a product dataset (and cropmask) at "auto"
+    resolution would fall back to a reduced resolution to fit `time_budget`.
+    """
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env, ExitStack() as stack:
+        sources = open_datasets(stack, product_dataset, mask_dataset)
+        feature_mask = get_feature_mask(sources[0], feature)
+        return decimation_factor(feature_mask.shape, sources, time_budget) > 1
+
+
+def _read_feature_datasets(
+    func, feature_mask, feature, datasets, resolution, time_budget, **kwargs
+):
+    """
+    Thread pool worker: open a (product, mask, baseline) dataset triple, pick
+    the read resolution and call `func(feature_mask, *sources, max_size=...)`.
+    Returns (result, resolution label).
+    """
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env, ExitStack() as stack:
+        sources = open_datasets(stack, *datasets)
+        if not feature_mask.matches(sources[0]):
+            feature_mask = get_feature_mask(sources[0], feature)
+        max_size, resolution_used = plan_resolution(
+            feature_mask.shape, sources, resolution, time_budget
+        )
+        result = func(feature_mask, *sources, max_size=max_size, **kwargs)
+    return result, resolution_used
+
+
+def map_feature_histograms(
+    feature,
+    dataset_pairs,
+    mask_dataset=None,
+    bins=10,
+    range=None,
+    density=False,
+    resolution="full",
+    time_budget=None,
+):
+    """
+    Histograms of a feature (BoundaryFeature or GeoJSON) for many
+    (product dataset, baseline dataset or None) pairs, read concurrently by
+    N_THREADS threads sharing one FeatureMask.
+
+    All histograms share bin edges: without `range` a first concurrent pass
+    finds the range of values over every pair. Yields
+    (index, hist, bin_edges, resolution) as each histogram finishes; bin
+    edges are in raw (unscaled) product units.
+    """
+    if not dataset_pairs:
+        return
+
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env, ExitStack() as stack:
+        product_src = stack.enter_context(
+            rasterio.open(get_raster_path(dataset_pairs[0][0].file_object))
+        )
+        feature_mask = get_feature_mask(product_src, feature)
+
+    def submit(executor, func, **kwargs):
+        return {
+            executor.submit(
+                _read_feature_datasets,
+                func,
+                feature_mask,
+                feature,
+                (product_dataset, mask_dataset, baseline_dataset),
+                resolution,
+                time_budget,
+                **kwargs,
+            ): index
+            for index, (product_dataset, baseline_dataset) in enumerate(
+                dataset_pairs
+            )
+        }
+
+    with ThreadPoolExecutor(max_workers=settings.N_THREADS) as executor:
+        if range is None:
+            ranges = [
+                future.result()[0]
+                for future in submit(executor, feature_value_range)
+            ]
+            ranges = [r for r in ranges if r is not None]
+            range = (
+                (min(r[0] for r in ranges), max(r[1] for r in ranges))
+                if ranges
+                else (0.0, 1.0)
+            )
+
+        futures = submit(
+            executor, feature_histogram, bins=bins, range=range, density=density
+        )
+        for future in as_completed(futures):
+            (hist, bin_edges), resolution_used = future.result()
+            yield futures[future], hist, bin_edges, resolution_used
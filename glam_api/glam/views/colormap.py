@@ -2,7 +2,6 @@ import numpy as np
 from typing import List, Tuple, TypeVar, Dict, Any
 
 import numpy
-import matplotlib
 
 from rest_framework import viewsets, views
 from rest_framework.response import Response
@@ -17,6 +16,7 @@ from django.utils.decorators import method_decorator
 from rio_tiler.colormap import cmap
 
 from ..utils import to_uint8
+from ..utils.compositor import NDVI_COLORS, colormap_lut
 from ..serializers import ColormapSerializer, GetColormapSerializer
 
 
@@ -118,34 +118,9 @@ class GenerateColormap(viewsets.ViewSet):
         target_coords = np.linspace(stretch_min, stretch_max, num_values)
 
         if colormap == "ndvi":
-            ndvi = matplotlib.colors.LinearSegmentedColormap.from_list(
-                "ndvi",
-                [
-                    "#fffee1",
-                    "#ffe1c8",
-                    "#f5c98c",
-                    "#ffdd55",
-                    "#ebbe37",
-                    "#faffb4",
-                    "#e6fa9b",
-                    "#cdff69",
-                    "#aff05a",
-                    "#a0f5a5",
-                    "#82e187",
-                    "#78c878",
-                    "#9ec66c",
-                    "#8caf46",
-                    "#46b928",
-                    "#329614",
-                    "#147850",
-                    "#1e5000",
-                    "#003200",
-                ],
-                256,
-            )
+            ndvi = colormap_lut(tuple(NDVI_COLORS))
             x = numpy.linspace(0, 1, num_values)
-            cmap_vals = ndvi(x)[:, :]
-            colors = (cmap_vals * 255).astype("uint8")
+            colors = ndvi[numpy.minimum((x * 256).astype("int64"), 255)]
         else:
             if colormap is not None:
                 cm_list = list(cmap.get(colormap).values())
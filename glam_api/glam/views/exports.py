@@ -1,4 +1,5 @@
 import json
+import datetime
 from decimal import Decimal
 
 import numpy as np
@@ -9,18 +10,23 @@ import rasterio
 from rasterio import features
 
 from rest_framework import viewsets
+from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, NotFound
 
 from django_q.tasks import async_task
 
-from drf_yasg.utils import swagger_auto_schema
+from drf_yasg.utils import no_body, swagger_auto_schema
 from drf_yasg import openapi
 
 from django.shortcuts import get_object_or_404
 from django.conf import settings
+from django.db.models import Q
+from django.http import Http404
+from django.utils import timezone
 
 from ..models import (
+    AtlasExport,
     Product,
     ProductRaster,
     CropMask,
@@ -32,11 +38,29 @@ from ..models import (
     ImageExport,
 )
 from ..serializers import (
+    AtlasBodySerializer,
+    AtlasExportSerializer,
     ExportBodySerializer,
     ExportSerializer,
     ExportBoundaryFeatureSerializer,
+    LayerExportBodySerializer,
 )
+from ..utils.cache import export_key
+from ..utils.resolvers import (
+    explain_response,
+    get_baseline_dataset,
+    get_baseline_datasets,
+    get_mask_dataset,
+    get_product_dataset,
+    get_product_datasets_between,
+    feature_bounds,
+    read_plan,
+    wants_explain,
+)
+
 
+# Unfinished exports started longer ago are assumed to have failed
+EXPORT_RUNNING_TIMEOUT = datetime.timedelta(hours=6)
 
 AVAILABLE_PRODUCTS = list()
 AVAILABLE_CROPMASKS = list()
@@ -75,6 +99,110 @@ except:
     pass
 
 
+def export_read_plan(data, feature):
+    """
+    Read plan of an export: the datasets an export job reads at full
+    resolution over a feature (BoundaryFeature or GeoJSON).
+    """
+    product_id = data.get("product_id")
+    product_dataset = get_product_dataset(product_id, data.get("date"))
+
+    anomaly_dataset = None
+    if data.get("anomaly_type"):
+        anomaly_dataset = get_baseline_dataset(
+            product_dataset,
+            data.get("anomaly"),
+            data.get("anomaly_type"),
+            data.get("diff_year"),
+        )
+
+    return read_plan(
+        "export",
+        [
+            ("product", product_dataset),
+            ("cropmask", get_mask_dataset(product_id, data.get("cropmask_id"))),
+            ("baseline", anomaly_dataset),
+        ],
+        feature_bounds(feature),
+        resolution="full",
+    )
+
+
+def export_task(data):
+    """
+    Export job of a single date, of a date range if end_date is given, or of
+    every feature of a layer if neither a geometry nor a feature is given
+    """
+    if data.get("end_date"):
+        return "glam.utils.export.cube_export"
+    if not data.get("geom") and data.get("feature_id") is None:
+        return "glam.utils.export.layer_export"
+    return "glam.utils.export.image_export"
+
+
+def export_content_key(data):
+    """
+    Content key (see utils.cache.export_key) of an export request, versioned
+    by its product, crop mask and anomaly baseline datasets. Raises NotFound
+    if an anomaly is requested for a dataset without a baseline.
+    """
+    product_id = data["product_id"]
+    if data.get("end_date"):
+        product_datasets = get_product_datasets_between(
+            product_id, data["date"], data["end_date"]
+        )
+        if not product_datasets:
+            raise Http404("No ProductRaster between the given dates.")
+    else:
+        product_datasets = [get_product_dataset(product_id, data["date"])]
+    baseline_datasets = []
+    if data.get("anomaly_type"):
+        baseline_datasets = get_baseline_datasets(
+            product_datasets,
+            data.get("anomaly"),
+            data.get("anomaly_type"),
+            data.get("diff_year"),
+        )
+        if any(dataset is None for dataset in baseline_datasets):
+            raise NotFound(f"No {data['anomaly_type']} baseline for the given dates.")
+    mask_dataset = get_mask_dataset(product_id, data.get("cropmask_id"))
+    return export_key(data, product_datasets, mask_dataset, *baseline_datasets)
+
+
+def start_export(data):
+    """
+    Id of the export of a request: a completed export of the same content,
+    one still queued or running, or a new export job.
+    """
+    content_key = export_content_key(data)
+    running_since = timezone.now() - EXPORT_RUNNING_TIMEOUT
+    export = (
+        ImageExport.objects.filter(content_key=content_key)
+        .filter(
+            Q(status=ImageExport.COMPLETED)
+            | Q(
+                status__in=ImageExport.ACTIVE_STATUSES,
+                cancel_requested=False,
+                started__gte=running_since,
+            )
+        )
+        .order_by("-started")
+        .first()
+    )
+    if export is not None:
+        return str(export.id)
+
+    export = ImageExport.objects.create(content_key=content_key)
+    export_id = str(export.id)
+    async_task(
+        export_task(data),
+        export_id,
+        data,
+        hook="glam.utils.export.upload_export",
+    )
+    return export_id
+
+
 class ImageExportViewSet(viewsets.ViewSet):
     product_param = openapi.Parameter(
         "product_id",
@@ -113,8 +241,18 @@ class ImageExportViewSet(viewsets.ViewSet):
         type=openapi.TYPE_INTEGER,
     )
 
+    explain_param = openapi.Parameter(
+        "explain",
+        openapi.IN_QUERY,
+        description="Return the raster read plan (datasets, windows, overview "
+        "levels, estimated bytes and range requests) without starting an export",
+        type=openapi.TYPE_BOOLEAN,
+    )
+
     @swagger_auto_schema(
-        operation_id="export_custom_feature", request_body=ExportBodySerializer
+        operation_id="export_custom_feature",
+        manual_parameters=[explain_param],
+        request_body=ExportBodySerializer,
     )
     def custom_feature_export(self, request):
         """
@@ -133,18 +271,11 @@ class ImageExportViewSet(viewsets.ViewSet):
                 geom["geometry"]["type"] == "Polygon"
                 or geom["geometry"]["type"] == "MultiPolygon"
             ):
-                new_export = ImageExport()
-                new_export.save()
-                export_id = str(new_export.id)
-                result = {"export_id": export_id}
-                print(data)
-                task = async_task(
-                    "glam.utils.export.image_export",
-                    export_id,
-                    data,
-                    hook="glam.utils.export.upload_export",
-                )
-                return Response(result)
+                if wants_explain(request):
+                    return explain_response(request, export_read_plan(data, geom))
+
+                data["geom"] = geom
+                return Response({"export_id": start_export(data)})
 
             else:
                 raise APIException(
@@ -158,6 +289,7 @@ class ImageExportViewSet(viewsets.ViewSet):
             date_param,
             boundary_layer_param,
             boundary_feature_param,
+            explain_param,
         ],
     )
     def boundary_feature_export(
@@ -183,20 +315,92 @@ class ImageExportViewSet(viewsets.ViewSet):
         data["layer_id"] = layer_id
         data["feature_id"] = feature_id
 
-        new_export = ImageExport()
-        new_export.save()
-        export_id = str(new_export.id)
-        result = {"export_id": export_id}
-        print(data)
-        task = async_task(
-            "glam.utils.export.image_export",
-            export_id,
-            data,
-            hook="glam.utils.export.upload_export",
-        )
-        return Response(result)
+        if wants_explain(request):
+            boundary_feature = get_object_or_404(
+                BoundaryFeature,
+                boundary_layer__layer_id=layer_id,
+                feature_id=feature_id,
+            )
+            return explain_response(request, export_read_plan(data, boundary_feature))
+
+        return Response({"export_id": start_export(data)})
+
+    @swagger_auto_schema(
+        operation_id="export_layer",
+        request_body=LayerExportBodySerializer,
+    )
+    def layer_export(self, request):
+        """
+        Export imagery clipped to every feature of a boundary layer (or of the
+        layers with a tag, optionally within a parent feature) as a ZIP of
+        COGs, read in a single pass.
+        """
+        params = LayerExportBodySerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        data = params.validated_data
+
+        if data.get("parent_layer_id"):
+            get_object_or_404(
+                BoundaryFeature,
+                boundary_layer__layer_id=data["parent_layer_id"],
+                feature_id=data["parent_feature_id"],
+            )
+
+        return Response({"export_id": start_export(data)})
 
 
 class GetExportViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = ImageExport.objects.all()
     serializer_class = ExportSerializer
+
+    @swagger_auto_schema(operation_id="cancel_export", request_body=no_body)
+    @action(detail=True, methods=["post"])
+    def cancel(self, request, pk=None):
+        """
+        Cancel a queued or running export. The export job stops at its next
+        block and its status becomes cancelled.
+        """
+        export = self.get_object()
+        ImageExport.objects.filter(
+            pk=export.pk, status__in=[ImageExport.QUEUED, ImageExport.RUNNING]
+        ).update(cancel_requested=True, content_key=None)
+        export.refresh_from_db()
+        return Response(self.get_serializer(export).data)
+
+
+class AtlasExportViewSet(viewsets.ViewSet):
+    @swagger_auto_schema(
+        operation_id="export_atlas",
+        request_body=AtlasBodySerializer,
+    )
+    def atlas_export(self, request):
+        """
+        Export the graphics of every feature of a boundary layer (or of the
+        layers with a tag) as a ZIP.
+        """
+        params = AtlasBodySerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        data = params.validated_data
+
+        # fail now rather than render unadjusted graphics
+        product_dataset = get_product_dataset(data["product_id"], data["date"])
+        if data.get("anomaly_type"):
+            anomaly_dataset = get_baseline_dataset(
+                product_dataset,
+                data.get("anomaly"),
+                data.get("anomaly_type"),
+                data.get("diff_year"),
+            )
+            if anomaly_dataset is None:
+                raise NotFound("No dataset of the diff year to compare to.")
+
+        new_atlas = AtlasExport()
+        new_atlas.save()
+        atlas_id = str(new_atlas.id)
+        async_task("glam.atlas.atlas_export", atlas_id, data)
+        return Response({"atlas_id": atlas_id})
+
+
+class GetAtlasViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = AtlasExport.objects.all()
+    serializer_class = AtlasExportSerializer
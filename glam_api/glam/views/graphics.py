@@ -1,4 +1,6 @@
 import json
+import math
+
 from rest_framework import viewsets
 from rest_framework.filters import SearchFilter
 from rest_framework.pagination import PageNumberPagination
@@ -19,31 +21,51 @@ from django.shortcuts import get_object_or_404
 from django.http import HttpResponse
 from django.contrib.gis.geos import GEOSGeometry
 
-import numpy as np
-import matplotlib
-from matplotlib.colors import ListedColormap
-
 import rasterio
 from rio_tiler.io import COGReader
 
-import matplotlib.pyplot as plt
-import matplotlib.image as mimage
-from matplotlib.offsetbox import AnchoredText
-from mpl_toolkits.axes_grid1.inset_locator import inset_axes
-import matplotlib.ticker as tkr
-
 import shapely
 from shapely import wkb, wkt
 from shapely.geometry import Polygon, MultiPolygon, shape
-from descartes import PolygonPatch
-
-from rasterio.plot import show
+from PIL import Image
 
 from ..renderers import PNGRenderer
 from ..serializers import GraphicSerializer, GraphicBodySerializer
 from ..mixins import ListViewSet
+from ..utils.cache import (
+    custom_geometry_hash,
+    get_cached_backdrop,
+    get_cached_graphic,
+    set_cached_backdrop,
+    set_cached_graphic,
+    versioned_key,
+)
+from ..utils import get_raster_path
+from ..utils.assets import admin_layer_ids, graphic_assets, layer_admin_level
+from ..utils.compositor import (
+    NDVI_COLORS,
+    backdrop_layer,
+    canvas_size,
+    decode_layer,
+    encode_layer,
+    render_graphic,
+)
+from ..utils.mpl_graphics import render_matplotlib_graphic
+from ..utils.geometries import (
+    extent_envelope,
+    simplified_geometries,
+    simplified_geometry,
+)
+from ..utils.resolvers import (
+    explain_response,
+    get_baseline_dataset,
+    get_mask_dataset,
+    get_product_dataset,
+    read_plan,
+    wants_explain,
+)
+from ..utils.zonal import bounds_shape, decimation_factor
 from ..models import (
-    Tag,
     Product,
     ProductRaster,
     CropMask,
@@ -51,9 +73,7 @@ from ..models import (
     BoundaryLayer,
     BoundaryFeature,
     AnomalyBaselineRaster,
-    DataSource,
 )
-from config.utils import get_closest_to_date
 
 
 def scale_from_extent(extent):
@@ -79,6 +99,16 @@ def scale_from_extent(extent):
     return scale
 
 
+def graphic_scale_factor(extent):
+    """Simplification tolerance in degrees of the geometries in a graphic"""
+    scale = scale_from_extent(extent)
+    if scale == "f":
+        return 0
+    if scale == "c":
+        return 0.1
+    return 0.01
+
+
 AVAILABLE_PRODUCTS = list()
 AVAILABLE_CROPMASKS = list()
 AVAILABLE_BOUNDARY_LAYERS = list()
@@ -86,6 +116,50 @@ ANOMALY_LENGTH_CHOICES = list()
 ANOMALY_TYPE_CHOICES = list()
 BOOL_CHOICES = [True, False]
 SIZE_CHOICES = ["tiny", "small", "regular", "large", "xlarge"]
+RENDERER_CHOICES = ["fast", "matplotlib"]
+
+
+# Longest side in pixels of graphic raster reads
+GRAPHIC_MAX_SIZE = 1024
+
+
+def graphic_max_size(src, bounds, n_sources, time_budget=None):
+    """
+    Longest side of the raster reads for a graphic of `bounds`:
+    GRAPHIC_MAX_SIZE, or less if reading `n_sources` rasters at that size
+    would not fit the time budget. Returns (max_size, resolution label).
+    """
+    shape = bounds_shape(src, bounds)
+    longest = max(shape)
+    max_size = GRAPHIC_MAX_SIZE
+    if longest > max_size:
+        shape = (
+            max(1, round(shape[0] * max_size / longest)),
+            max(1, round(shape[1] * max_size / longest)),
+        )
+    factor = decimation_factor(shape, [src] * n_sources, time_budget)
+    max_size = max(1, math.ceil(min(longest, max_size) / factor))
+
+    if longest <= max_size:
+        return max_size, "full"
+    return max_size, f"1/{math.ceil(longest / max_size)}"
+
+
+def graphic_read_plan(datasets, bounds, time_budget=None):
+    """
+    Read plan of a graphic, at the read size chosen by graphic_max_size.
+    The first dataset in `datasets` must be the product.
+    """
+    product_ds = datasets[0][1]
+    n_sources = len([dataset for role, dataset in datasets if dataset is not None])
+
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS):
+        with rasterio.open(get_raster_path(product_ds.file_object)) as src:
+            max_size, resolution_used = graphic_max_size(
+                src, bounds, n_sources, time_budget
+            )
+
+    return read_plan("graphic", datasets, bounds, max_size, resolution_used)
 
 
 def get_fig_size(size):
@@ -101,6 +175,167 @@ def get_fig_size(size):
         return (12, 12)
 
 
+def graphic_colormap(product, anomaly=None):
+    """
+    Colormap of a product graphic: a colormap name, or a tuple of colors
+    for the NDVI ramp.
+    """
+    if product.variable.variable_id == "modis-ndvi" and not anomaly:
+        return tuple(NDVI_COLORS)
+    return (
+        product.meta["graphic_anomaly"] if anomaly else product.meta["graphic_colormap"]
+    )
+
+
+def graphic_stretch(product, anomaly=None, anomaly_type=None):
+    return (
+        product.meta["anomaly_stretch"]
+        if (anomaly or anomaly_type == "diff")
+        else product.meta["default_stretch"]
+    )
+
+
+def graphic_label(
+    feature_name,
+    date,
+    product,
+    mask_ds=None,
+    anomaly=None,
+    anomaly_type=None,
+    diff_year=None,
+):
+    """Label text of a graphic"""
+    feature_label = f"Region: {str(feature_name)}"
+    date_label = f"\nDate: {str(date)}"
+    product_label = f"\nProduct: {str(product.display_name)}"
+    cropmask_label = (
+        f"\nCrop Mask: {str(mask_ds.crop_mask.display_name)}" if mask_ds else ""
+    )
+
+    if anomaly_type == "diff":
+        anomaly_label = f"\nAnomaly: Difference Image vs. {diff_year}"
+    elif anomaly_type:
+        anomaly_label = f"\nAnomaly: {str(anomaly_type).capitalize()}"
+    else:
+        anomaly_label = ""
+
+    anomaly_duration = f" - {anomaly}" if anomaly else ""
+
+    return (
+        feature_label
+        + date_label
+        + product_label
+        + anomaly_label
+        + anomaly_duration
+        + cropmask_label
+    )
+
+
+def backdrop_geometries(querysets, scale_factor):
+    """Simplified shapely geometries of the backdrop features of a graphic"""
+    return [
+        shapely.from_wkb(bytes(geometry.wkb))
+        for queryset in querysets
+        for geometry in simplified_geometries(queryset, scale_factor)
+    ]
+
+
+def graphic_logo():
+    """GLAM logo as an RGBA array, None if it can not be loaded"""
+    return graphic_assets()["logo"]
+
+
+def fast_graphic(
+    figsize,
+    bounds,
+    backdrop_key,
+    backdrop_querysets,
+    scale_factor,
+    feature_geom,
+    data,
+    data_bounds,
+    colormap,
+    stretch,
+    label=None,
+    legend=None,
+    scale=1,
+):
+    """
+    PNG of a graphic rendered with the numpy/PIL compositor. The backdrop
+    (land, neighbouring features and feature fill) is rendered once per
+    `backdrop_key` and canvas size and cached, so that the backdrop
+    features are only queried and simplified on a cache miss.
+    """
+    size = canvas_size(figsize, bounds)
+    logo = graphic_logo()
+    feature = shapely.from_wkb(bytes(feature_geom.wkb))
+    if not feature.is_valid:
+        feature = feature.buffer(0)
+
+    backdrop_key = f"{backdrop_key}-{size[0]}x{size[1]}"
+    backdrop_png = get_cached_backdrop(backdrop_key)
+    if backdrop_png is not None:
+        backdrop_image = decode_layer(backdrop_png)
+    else:
+        backdrop_image = backdrop_layer(
+            backdrop_geometries(backdrop_querysets, scale_factor),
+            feature,
+            bounds,
+            size,
+        )
+        set_cached_backdrop(backdrop_key, encode_layer(backdrop_image))
+
+    return render_graphic(
+        size,
+        bounds,
+        feature=feature,
+        data=data,
+        data_bounds=data_bounds,
+        colormap=colormap,
+        stretch=stretch,
+        label=label,
+        legend=legend,
+        scale=scale,
+        logo=Image.fromarray(logo) if logo is not None else None,
+        backdrop_image=backdrop_image,
+    )
+
+
+def matplotlib_graphic(
+    figsize,
+    bounds,
+    backdrop_querysets,
+    scale_factor,
+    feature_geom,
+    data,
+    data_bounds,
+    colormap,
+    stretch,
+    label=None,
+    legend=None,
+    scale=1,
+):
+    """PNG of a graphic rendered as a matplotlib figure in the render pool"""
+    return render_matplotlib_graphic(
+        figsize=figsize,
+        bounds=bounds,
+        backdrop=[
+            bytes(geometry.wkb)
+            for queryset in backdrop_querysets
+            for geometry in simplified_geometries(queryset, scale_factor)
+        ],
+        feature=bytes(feature_geom.wkb),
+        data=data,
+        data_bounds=data_bounds,
+        colormap=colormap,
+        stretch=stretch,
+        label=label,
+        legend=legend,
+        scale=scale,
+        logo=graphic_logo(),
+    )
+
+
 try:
     products = Product.objects.all()
     for p in products:
@@ -232,6 +467,33 @@ class GraphicsViewSet(viewsets.ViewSet):
         default=SIZE_CHOICES[2],
     )
 
+    time_budget_param = openapi.Parameter(
+        "time_budget",
+        openapi.IN_QUERY,
+        description="Time budget in seconds used to pick the read resolution "
+        "(default: server setting). The resolution used is reported in the "
+        "X-Resolution header.",
+        type=openapi.TYPE_NUMBER,
+    )
+
+    explain_param = openapi.Parameter(
+        "explain",
+        openapi.IN_QUERY,
+        description="Return the raster read plan (datasets, windows, overview "
+        "levels, estimated bytes and range requests) without reading pixels",
+        type=openapi.TYPE_BOOLEAN,
+    )
+
+    renderer_param = openapi.Parameter(
+        "renderer",
+        openapi.IN_QUERY,
+        description="'fast' renders with numpy/PIL, 'matplotlib' renders a "
+        "higher quality matplotlib figure",
+        type=openapi.TYPE_STRING,
+        enum=RENDERER_CHOICES,
+        default=RENDERER_CHOICES[0],
+    )
+
     @swagger_auto_schema(
         operation_id="graphic",
         manual_parameters=[
@@ -246,6 +508,9 @@ class GraphicsViewSet(viewsets.ViewSet):
             label_param,
             legend_param,
             size_param,
+            renderer_param,
+            time_budget_param,
+            explain_param,
         ],
     )
     def boundary_feature_graphic(
@@ -260,9 +525,6 @@ class GraphicsViewSet(viewsets.ViewSet):
         """
         Generate static image for given boundary feature.
         """
-        BLUE = "#97b6e1"
-        GRAY = "#999999"
-        land = "#efefdb"
 
         # import time
         # start = time.time()
@@ -277,22 +539,18 @@ class GraphicsViewSet(viewsets.ViewSet):
         legend = data.get("legend", None)
         size = data.get("size", None)
         figsize = get_fig_size(size)
+        renderer = data.get("renderer", "fast")
+        time_budget = data.get("time_budget", None)
+        n_sources = 1 + bool(anomaly_type) + (cropmask_id != "no-mask")
 
         product = Product.objects.get(product_id=product_id)
-        product_datasets = ProductRaster.objects.filter(product=product)
-        product_ds = get_object_or_404(product_datasets, date=date)
+        product_ds = get_product_dataset(product_id, date)
         product_scale = product.variable.scale
         if anomaly_type:
             product_variable = product.variable.display_name + " Anomaly"
         else:
             product_variable = product.variable.display_name
 
-        def tick_formatter(x, pos):
-            t = "{:g}".format(x * product_scale)
-            return t
-
-        formatter = tkr.FuncFormatter(tick_formatter)
-
         boundary_layer = BoundaryLayer.objects.get(layer_id=layer_id)
         boundary_features = BoundaryFeature.objects.filter(
             boundary_layer=boundary_layer
@@ -307,405 +565,156 @@ class GraphicsViewSet(viewsets.ViewSet):
             boundary_feature.geom.extent[1],
             boundary_feature.geom.extent[3],
         ]
-        scale = scale_from_extent(extent)
+        scale_factor = graphic_scale_factor(extent)
 
-        if scale == "f":
-            scale_factor = 0
-        elif scale == "c":
-            scale_factor = 0.1
-        else:
-            scale_factor = 0.01
+        boundary_feature_geom = simplified_geometry(boundary_feature, scale_factor)
 
-        boundary_feature_geom = boundary_feature.geom.simplify(scale_factor)
+        anomaly_ds = None
+        if anomaly_type:
+            anomaly_ds = get_baseline_dataset(
+                product_ds, anomaly, anomaly_type, diff_year
+            )
+        mask_ds = get_mask_dataset(product_id, cropmask_id)
+
+        if wants_explain(request):
+            return explain_response(
+                request,
+                graphic_read_plan(
+                    [
+                        ("product", product_ds),
+                        ("baseline", anomaly_ds),
+                        ("cropmask", mask_ds),
+                    ],
+                    boundary_feature_geom.extent,
+                    time_budget,
+                ),
+            )
+
+        cache_key = versioned_key(
+            f"boundary-graphic-{product_id}-{date}-{cropmask_id}-{layer_id}-{feature_id}-{anomaly}-{anomaly_type}-{diff_year}-{label}-{legend}-{size}-{renderer}-{time_budget}",
+            product_ds,
+            anomaly_ds,
+            mask_ds,
+        )
+        cached = get_cached_graphic(cache_key)
+        if cached:
+            png, resolution_used = cached
+            return Response(
+                HttpResponse(png, content_type="image/png"),
+                headers={"X-Resolution": resolution_used},
+            )
 
         with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env:
             with COGReader(
                 f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{product_ds.file_object.name}"
             ) as image:
+                max_size, resolution_used = graphic_max_size(
+                    image.dataset, boundary_feature_geom.extent, n_sources, time_budget
+                )
                 feat = image.feature(
-                    json.loads(boundary_feature_geom.geojson), max_size=1024
+                    json.loads(boundary_feature_geom.geojson), max_size=max_size
                 )
 
             image = feat.as_masked()
 
             if anomaly_type:
-                anom_type = anomaly_type if anomaly_type else "mean"
-
-                if anom_type == "diff":
-                    new_year = diff_year
-                    new_date = product_ds.date.replace(year=new_year)
-                    anomaly_queryset = ProductRaster.objects.filter(
-                        product__product_id=product_id
-                    )
-                    closest = get_closest_to_date(anomaly_queryset, new_date)
-                    try:
-                        anomaly_ds = get_object_or_404(anomaly_queryset, date=new_date)
-                    except:
-                        anomaly_ds = closest
-
-                else:
-                    doy = product_ds.date.timetuple().tm_yday
-                    if product_id == "swi":
-                        swi_baselines = np.arange(1, 366, 5)
-                        idx = (np.abs(swi_baselines - doy)).argmin()
-                        doy = swi_baselines[idx]
-                    if product_id == "chirps":
-                        doy = int(str(date.month) + f"{date.day:02d}")
-                    anomaly_queryset = AnomalyBaselineRaster.objects.all()
-                    anomaly_ds = get_object_or_404(
-                        anomaly_queryset,
-                        product=product,
-                        day_of_year=doy,
-                        baseline_length=anomaly,
-                        baseline_type=anom_type,
-                    )
-
                 with COGReader(
                     f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{anomaly_ds.file_object.name}"
                 ) as anom_img:
                     anom_feat = anom_img.feature(
-                        json.loads(boundary_feature_geom.geojson), max_size=1024
+                        json.loads(boundary_feature_geom.geojson), max_size=max_size
                     )
 
                 image = image - anom_feat.as_masked()
 
-            if cropmask_id != "no-mask":
-                mask = CropMask.objects.get(cropmask_id=cropmask_id)
-                mask_queryset = CropmaskRaster.objects.all()
-                mask_ds = get_object_or_404(
-                    mask_queryset, product__product_id=product_id, crop_mask=mask
-                )
-
+            if mask_ds:
                 with COGReader(
                     f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{mask_ds.file_object.name}"
                 ) as mask_img:
                     mask_feat = mask_img.feature(
-                        json.loads(boundary_feature_geom.geojson), max_size=1024
+                        json.loads(boundary_feature_geom.geojson), max_size=max_size
                     )
 
                 image = image * mask_feat.as_masked()
 
-            admin_0 = Tag.objects.get(name="ADM0")
-            admin_1 = Tag.objects.get(name="ADM1")
-
-            admin_level = None
-
-            if admin_1 in boundary_layer.tags.all():
-                admin_level = admin_1
-                buff = 1
-            elif admin_0 in boundary_layer.tags.all():
-                admin_level = admin_0
-                buff = 2
-            else:
-                admin_level = None
-                buff = 1
-
-            fig = plt.figure(figsize=figsize)
-            ax = fig.add_subplot(1, 1, 1, frameon=False)
-
-            # boundary_feature_buffer = wkt.loads(boundary_feature_geom.buffer(buff).wkt)
-
-            try:
-                from shapely import wkt as shapely_wkt
-                from shapely.geometry import shape, mapping
-                import numpy as np
-
-                # Debug the GEOS geometry
-                print(
-                    f"Original geometry class: {boundary_feature_geom.__class__.__name__}"
-                )
-                print(f"Original geometry: {boundary_feature_geom}")
-
-                # Convert to Shapely geometry via WKT
-                shapely_geom = shapely_wkt.loads(boundary_feature_geom.wkt)
-
-                # Ensure geometry is valid
-                if not shapely_geom.is_valid:
-                    shapely_geom = shapely_geom.buffer(0)
-
-                print(f"Shapely geometry class: {shapely_geom.__class__.__name__}")
-                print(f"Shapely geometry valid: {shapely_geom.is_valid}")
-
-                # Handle both Polygon and MultiPolygon geometries
-                if isinstance(shapely_geom, MultiPolygon):
-                    print(f"MultiPolygon with {len(shapely_geom.geoms)} parts")
-                    for poly in shapely_geom.geoms:
-                        # Create polygon patches for each part
-                        feature_fill = PolygonPatch(
-                            poly.__geo_interface__,
-                            fc=GRAY,
-                            linewidth=0,
-                            alpha=0.5,
-                            zorder=0.5,
-                        )
-                        feature_border = PolygonPatch(
-                            poly.__geo_interface__,
-                            color="black",
-                            linewidth=1.5,
-                            fill=False,
-                            alpha=1,
-                            zorder=2,
-                        )
-                        # Add patches to plot
-                        ax.add_patch(feature_border)
-                        ax.add_patch(feature_fill)
-                else:
-                    # Single Polygon
-                    print(
-                        f"Shapely geometry coords: {list(shapely_geom.exterior.coords)}"
-                    )
-                    # Create polygon patches
-                    feature_fill = PolygonPatch(
-                        shapely_geom.__geo_interface__,
-                        fc=GRAY,
-                        linewidth=0,
-                        alpha=0.5,
-                        zorder=0.5,
-                    )
-                    feature_border = PolygonPatch(
-                        shapely_geom.__geo_interface__,
-                        color="black",
-                        linewidth=1.5,
-                        fill=False,
-                        alpha=1,
-                        zorder=2,
-                    )
-
-                    # Add patches to plot
-                    ax.add_patch(feature_border)
-                    ax.add_patch(feature_fill)
-
-            except Exception as e:
-                print(f"Error creating polygon patches: {str(e)}")
-                # Try alternative approach using direct coordinates
-                try:
-                    if isinstance(shapely_geom, MultiPolygon):
-                        for poly in shapely_geom.geoms:
-                            coords = np.array(list(poly.exterior.coords))
-                            feature_fill = plt.Polygon(
-                                coords, fc=GRAY, alpha=0.5, zorder=0.5
-                            )
-                            feature_border = plt.Polygon(
-                                coords,
-                                ec="black",
-                                fc="none",
-                                linewidth=1.5,
-                                alpha=1,
-                                zorder=2,
-                            )
-                            ax.add_patch(feature_fill)
-                            ax.add_patch(feature_border)
-                    else:
-                        coords = np.array(list(shapely_geom.exterior.coords))
-                        feature_fill = plt.Polygon(
-                            coords, fc=GRAY, alpha=0.5, zorder=0.5
-                        )
-                        feature_border = plt.Polygon(
-                            coords,
-                            ec="black",
-                            fc="none",
-                            linewidth=1.5,
-                            alpha=1,
-                            zorder=2,
-                        )
-                        ax.add_patch(feature_fill)
-                        ax.add_patch(feature_border)
-                except Exception as e:
-                    print(f"Failed alternative approach: {str(e)}")
-                    raise APIException(
-                        f"Could not create boundary visualization: {str(e)}"
-                    )
-
-            # Set wider extent using buffer
-            boundary_feature_buffer = boundary_feature_geom.buffer(buff)
-            x1, y1, x2, y2 = boundary_feature_buffer.extent
-            ax.set_xlim([x1, x2])
-            ax.set_ylim([y1, y2])
-
-            # remove ticks
-            ax.axes.xaxis.set_visible(False)
-            ax.axes.yaxis.set_visible(False)
-
-            extent = [
-                boundary_feature_geom.extent[0],
-                boundary_feature_geom.extent[2],
-                boundary_feature_geom.extent[1],
-                boundary_feature_geom.extent[3],
-            ]
-
-            colormap = (
-                product.meta["graphic_anomaly"]
-                if anomaly
-                else product.meta["graphic_colormap"]
-            )
-            if product.variable.variable_id == "modis-ndvi" and not anomaly:
-                ndvi = matplotlib.colors.LinearSegmentedColormap.from_list(
-                    "ndvi",
-                    [
-                        "#fffee1",
-                        "#ffe1c8",
-                        "#f5c98c",
-                        "#ffdd55",
-                        "#ebbe37",
-                        "#faffb4",
-                        "#e6fa9b",
-                        "#cdff69",
-                        "#aff05a",
-                        "#a0f5a5",
-                        "#82e187",
-                        "#78c878",
-                        "#9ec66c",
-                        "#8caf46",
-                        "#46b928",
-                        "#329614",
-                        "#147850",
-                        "#1e5000",
-                        "#003200",
-                    ],
-                    256,
-                )
-                x = np.linspace(0, 1, 256)
-                cmap_vals = ndvi(x)[:, :]
-                ndvi_cm = ListedColormap(cmap_vals)
-                colormap = ndvi_cm
-
-            stretch = (
-                product.meta["anomaly_stretch"]
-                if (anomaly or anomaly_type == "diff")
-                else product.meta["default_stretch"]
-            )
-
-            image = ax.imshow(
-                image[0],
-                extent=extent,
-                cmap=colormap,
-                vmin=stretch[0],
-                vmax=stretch[1],
-                zorder=1,
-            )
-
-            ax.set_facecolor(BLUE)
+            admin_level = layer_admin_level(boundary_layer)
+            buff = 2 if admin_level == "ADM0" else 1
 
+            backdrop_envelope = extent_envelope(boundary_feature.geom.extent, buff)
             if admin_level:
-                feature_intersects = BoundaryFeature.objects.filter(
-                    boundary_layer__tags=admin_level,
-                    geom__intersects=boundary_feature.geom.buffer(buff).envelope,
-                )
-            else:
-                feature_intersects = BoundaryFeature.objects.filter(
-                    boundary_layer=boundary_layer,
-                    geom__intersects=boundary_feature.geom.buffer(buff).envelope,
-                )
-                countries = BoundaryFeature.objects.filter(
-                    boundary_layer__tags=admin_0,
-                    geom__intersects=boundary_feature.geom.buffer(buff).envelope,
-                )
-                for feature in countries:
-                    wktgeom = wkt.loads(feature.geom.simplify(scale_factor).wkt)
-                    try:
-                        patch = PolygonPatch(
-                            wktgeom,
-                            fc=land,
-                            ec="black",
-                            linestyle=":",
-                            alpha=1,
-                            zorder=0,
-                        )
-                        ax.add_patch(patch)
-                    except:
-                        pass
-
-            for feature in feature_intersects:
-                wktgeom = wkt.loads(feature.geom.simplify(scale_factor).wkt)
-                try:
-                    patch = PolygonPatch(
-                        wktgeom,
-                        fc=land,
-                        ec="black",
-                        linestyle=":",
-                        alpha=1,
-                        zorder=0,
+                backdrop_querysets = [
+                    BoundaryFeature.objects.filter(
+                        boundary_layer__in=admin_layer_ids(admin_level),
+                        geom__intersects=backdrop_envelope,
                     )
-                    ax.add_patch(patch)
-                except:
-                    pass
+                ]
+            else:
+                backdrop_querysets = [
+                    BoundaryFeature.objects.filter(
+                        boundary_layer__in=admin_layer_ids("ADM0"),
+                        geom__intersects=backdrop_envelope,
+                    ),
+                    BoundaryFeature.objects.filter(
+                        boundary_layer=boundary_layer,
+                        geom__intersects=backdrop_envelope,
+                    ),
+                ]
+
+            colormap = graphic_colormap(product, anomaly)
+            stretch = graphic_stretch(product, anomaly, anomaly_type)
 
             if label:
-                feature_label = f"Region: {str(boundary_feature_name)}"
-                date_label = f"\nDate: {str(date)}"
-                product_label = f"\nProduct: {str(product.display_name)}"
-                cropmask_label = (
-                    f"\nCrop Mask: {str(mask.display_name)}"
-                    if cropmask_id != "no-mask"
-                    else ""
+                label = graphic_label(
+                    boundary_feature_name,
+                    date,
+                    product,
+                    mask_ds,
+                    anomaly,
+                    anomaly_type,
+                    diff_year,
                 )
 
-                if anomaly_type == "diff":
-                    anomaly_label = f"\nAnomaly: Difference Image vs. {diff_year}"
-                elif anomaly_type:
-                    anomaly_label = f"\nAnomaly: {str(anom_type).capitalize()}"
-                else:
-                    anomaly_label = ""
-
-                anomaly_duration = f" - {anomaly}" if anomaly else ""
-
-                label = (
-                    feature_label
-                    + date_label
-                    + product_label
-                    + anomaly_label
-                    + anomaly_duration
-                    + cropmask_label
+            if renderer == "matplotlib":
+                png = matplotlib_graphic(
+                    figsize,
+                    extent_envelope(boundary_feature_geom.extent, buff).extent,
+                    backdrop_querysets,
+                    scale_factor,
+                    boundary_feature_geom,
+                    image[0],
+                    boundary_feature_geom.extent,
+                    colormap,
+                    stretch,
+                    label=label,
+                    legend=product_variable if legend else None,
+                    scale=product_scale,
                 )
-
-                text = AnchoredText(
-                    label, loc="lower right", prop={"size": 8}, frameon=True
+            else:
+                png = fast_graphic(
+                    figsize,
+                    extent_envelope(boundary_feature_geom.extent, buff).extent,
+                    f"boundary-backdrop-{layer_id}-{feature_id}",
+                    backdrop_querysets,
+                    scale_factor,
+                    boundary_feature_geom,
+                    image[0],
+                    boundary_feature_geom.extent,
+                    colormap,
+                    stretch,
+                    label=label,
+                    legend=product_variable if legend else None,
+                    scale=product_scale,
                 )
-                ax.add_artist(text)
+            set_cached_graphic(cache_key, png, resolution_used)
 
-            if legend:
-                cbaxes = inset_axes(ax, "33%", "3%", loc="upper right", borderpad=1)
-                cbaxes.tick_params(labelsize=8)
-                cb = fig.colorbar(
-                    image, cax=cbaxes, orientation="horizontal", format=formatter
-                )
-                cb.set_label(label=product_variable, fontsize=8)
-
-            # Handle logo image from URL
-            try:
-                from urllib.request import urlopen
-                from PIL import Image
-                import io
-
-                glam_logo = DataSource.objects.get(source_id="glam").logo.url
-                with urlopen(glam_logo) as url:
-                    logo_data = url.read()
-                logo = Image.open(io.BytesIO(logo_data))
-                logo = np.array(logo)
-
-                logo_ax = inset_axes(ax, width="15%", height="10%", loc="lower left")
-                logo_ax.imshow(logo, alpha=0.75, origin="upper")
-                logo_ax.axis("off")
-            except Exception as e:
-                print(f"Failed to load logo: {str(e)}")
-                # Continue without logo if it fails
-                pass
-
-            response = HttpResponse(content_type="image/png")
-
-            fig.savefig(
-                response,
-                transparent=True,
-                # facecolor=BLUE,
-                bbox_inches="tight",
-                pad_inches=0,
+            return Response(
+                HttpResponse(png, content_type="image/png"),
+                headers={"X-Resolution": resolution_used},
             )
 
-            return Response(response)
-
     @swagger_auto_schema(
         operation_id="custom graphic",
-        manual_parameters=[],
+        manual_parameters=[explain_param],
         request_body=GraphicBodySerializer,
         # responses={200: resp_200}
     )
@@ -714,9 +723,6 @@ class GraphicsViewSet(viewsets.ViewSet):
         Generate static image for custom geometry.
         """
         if request.method == "POST":
-            BLUE = "#97b6e1"
-            GRAY = "#999999"
-            land = "#efefdb"
             # import time
             # start = time.time()
             params = GraphicBodySerializer(data=request.data)
@@ -735,26 +741,26 @@ class GraphicsViewSet(viewsets.ViewSet):
             legend = data.get("legend", True)
             size = data.get("size", "regular")
             figsize = get_fig_size(size)
+            renderer = data.get("renderer", "fast")
+            time_budget = data.get("time_budget", None)
+            n_sources = 1 + bool(anomaly_type) + (cropmask_id != "no-mask")
 
             product = Product.objects.get(product_id=product_id)
-            product_datasets = ProductRaster.objects.filter(product=product)
-            product_ds = get_object_or_404(product_datasets, date=date)
+            product_ds = get_product_dataset(product_id, date)
             product_scale = product.variable.scale
             if anomaly_type:
                 product_variable = product.variable.display_name + " Anomaly"
             else:
                 product_variable = product.variable.display_name
 
-            def tick_formatter(x, pos):
-                t = "{:g}".format(x * product_scale)
-                return t
-
-            formatter = tkr.FuncFormatter(tick_formatter)
-
             if (
                 geom["geometry"]["type"] == "Polygon"
                 or geom["geometry"]["type"] == "MultiPolygon"
             ):
+                geom_hash = custom_geometry_hash(product_ds, geom)
+                cache_key = f"custom-graphic-{product_id}-{date}-{cropmask_id}-{geom_hash}-{anomaly}-{anomaly_type}-{diff_year}-{label}-{legend}-{size}-{renderer}-{time_budget}"
+                explain = wants_explain(request)
+
                 boundary_feature_geom = GEOSGeometry(shape(geom["geometry"]).wkt)
 
                 extent = [
@@ -766,266 +772,143 @@ class GraphicsViewSet(viewsets.ViewSet):
 
                 scale = scale_from_extent(extent)
 
-                admin_0 = Tag.objects.get(name="ADM0")
-                admin_1 = Tag.objects.get(name="ADM1")
-
                 if scale == "f":
                     scale_factor = 0
                     buff = 1
-                    admin_level = admin_1
+                    admin_level = "ADM1"
                 elif scale == "c":
                     scale_factor = 0.1
                     buff = 2
-                    admin_level = admin_0
+                    admin_level = "ADM0"
                 else:
                     scale_factor = 0.01
                     buff = 1
-                    admin_level = admin_1
+                    admin_level = "ADM1"
+
+                anomaly_ds = None
+                if anomaly_type:
+                    anomaly_ds = get_baseline_dataset(
+                        product_ds, anomaly, anomaly_type, diff_year
+                    )
+                mask_ds = get_mask_dataset(product_id, cropmask_id)
+
+                if explain:
+                    return explain_response(
+                        request,
+                        graphic_read_plan(
+                            [
+                                ("product", product_ds),
+                                ("baseline", anomaly_ds),
+                                ("cropmask", mask_ds),
+                            ],
+                            boundary_feature_geom.extent,
+                            time_budget,
+                        ),
+                    )
+
+                cache_key = versioned_key(cache_key, product_ds, anomaly_ds, mask_ds)
+                cached = get_cached_graphic(cache_key)
+                if cached:
+                    png, resolution_used = cached
+                    return Response(
+                        HttpResponse(png, content_type="image/png"),
+                        headers={"X-Resolution": resolution_used},
+                    )
 
                 with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env:
 
                     with COGReader(
                         f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{product_ds.file_object.name}"
                     ) as image:
+                        max_size, resolution_used = graphic_max_size(
+                            image.dataset,
+                            boundary_feature_geom.extent,
+                            n_sources,
+                            time_budget,
+                        )
                         feat = image.feature(
-                            json.loads(boundary_feature_geom.geojson), max_size=1024
+                            json.loads(boundary_feature_geom.geojson),
+                            max_size=max_size,
                         )
 
                     image = feat.as_masked()
 
                     if anomaly_type:
-                        anom_type = anomaly_type if anomaly_type else "mean"
-
-                        if anom_type == "diff":
-                            new_year = diff_year
-                            new_date = product_ds.date.replace(year=new_year)
-                            anomaly_queryset = ProductRaster.objects.filter(
-                                product__product_id=product_id
-                            )
-                            closest = get_closest_to_date(anomaly_queryset, new_date)
-
-                            try:
-                                anomaly_ds = get_object_or_404(
-                                    anomaly_queryset, date=new_date
-                                )
-                            except:
-                                anomaly_ds = closest
-
-                        else:
-                            doy = product_ds.date.timetuple().tm_yday
-                            if product_id == "swi":
-                                swi_baselines = np.arange(1, 366, 5)
-                                idx = (np.abs(swi_baselines - doy)).argmin()
-                                doy = swi_baselines[idx]
-                            if product_id == "chirps":
-                                doy = int(str(date.month) + f"{date.day:02d}")
-                            anomaly_queryset = AnomalyBaselineRaster.objects.all()
-                            anomaly_ds = get_object_or_404(
-                                anomaly_queryset,
-                                product=product,
-                                day_of_year=doy,
-                                baseline_length=anomaly,
-                                baseline_type=anom_type,
-                            )
-
                         with COGReader(
                             f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{anomaly_ds.file_object.name}"
                         ) as anom_img:
-                            anom_feat = anom_img.feature(geom, max_size=1024)
+                            anom_feat = anom_img.feature(geom, max_size=max_size)
 
                         image = image - anom_feat.as_masked()
 
-                    if cropmask_id != "no-mask":
-                        mask = CropMask.objects.get(cropmask_id=cropmask_id)
-                        mask_queryset = CropmaskRaster.objects.all()
-                        mask_ds = get_object_or_404(
-                            mask_queryset,
-                            product__product_id=product_id,
-                            crop_mask=mask,
-                        )
-
+                    if mask_ds:
                         with COGReader(
                             f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{mask_ds.file_object.name}"
                         ) as mask_img:
-                            mask_feat = mask_img.feature(geom, max_size=1024)
+                            mask_feat = mask_img.feature(geom, max_size=max_size)
 
                         image = image * mask_feat.as_masked()
 
-                    boundary_feature_buffer = wkt.loads(
-                        boundary_feature_geom.buffer(buff).wkt
-                    )
-
-                    fig = plt.figure(figsize=figsize)
-                    ax = fig.add_subplot(1, 1, 1, frameon=False)
-
-                    # set wider extent
-                    x1, y1, x2, y2 = boundary_feature_buffer.bounds
-                    ax.set_xlim([x1, x2])
-                    ax.set_ylim([y1, y2])
-
-                    # remove ticks
-                    ax.axes.xaxis.set_visible(False)
-                    ax.axes.yaxis.set_visible(False)
-
-                    colormap = (
-                        product.meta["graphic_anomaly"]
-                        if anomaly
-                        else product.meta["graphic_colormap"]
-                    )
-                    if product.variable.variable_id == "modis-ndvi" and not anomaly:
-                        ndvi = matplotlib.colors.LinearSegmentedColormap.from_list(
-                            "ndvi",
-                            [
-                                "#fffee1",
-                                "#ffe1c8",
-                                "#f5c98c",
-                                "#ffdd55",
-                                "#ebbe37",
-                                "#faffb4",
-                                "#e6fa9b",
-                                "#cdff69",
-                                "#aff05a",
-                                "#a0f5a5",
-                                "#82e187",
-                                "#78c878",
-                                "#9ec66c",
-                                "#8caf46",
-                                "#46b928",
-                                "#329614",
-                                "#147850",
-                                "#1e5000",
-                                "#003200",
-                            ],
-                            256,
+                    backdrop_querysets = [
+                        BoundaryFeature.objects.filter(
+                            boundary_layer__in=admin_layer_ids(admin_level),
+                            geom__intersects=extent_envelope(
+                                boundary_feature_geom.extent, buff
+                            ),
                         )
-                        x = np.linspace(0, 1, 256)
-                        cmap_vals = ndvi(x)[:, :]
-                        ndvi_cm = ListedColormap(cmap_vals)
-                        colormap = ndvi_cm
-
-                    stretch = (
-                        product.meta["anomaly_stretch"]
-                        if (anomaly or anomaly_type == "diff")
-                        else product.meta["default_stretch"]
-                    )
-
-                    image = ax.imshow(
-                        image[0],
-                        extent=extent,
-                        cmap=colormap,
-                        vmin=stretch[0],
-                        vmax=stretch[1],
-                        zorder=1,
-                    )
+                    ]
 
-                    feature_intersects = BoundaryFeature.objects.filter(
-                        boundary_layer__tags=admin_level,
-                        geom__intersects=boundary_feature_geom.buffer(buff).envelope,
-                    )
-                    for feature in feature_intersects:
-                        wktgeom = wkt.loads(feature.geom.simplify(scale_factor).wkt)
-                        try:
-                            patch = PolygonPatch(
-                                wktgeom,
-                                fc=land,
-                                ec="black",
-                                linestyle=":",
-                                alpha=1,
-                                zorder=0,
-                            )
-                        except:
-                            pass
-                        ax.add_patch(patch)
-
-                    feature_fill = PolygonPatch(
-                        boundary_feature_geom,
-                        fc=GRAY,
-                        linewidth=0,
-                        alpha=0.5,
-                        zorder=0.5,
-                    )
-                    feature_border = PolygonPatch(
-                        boundary_feature_geom,
-                        color="black",
-                        linewidth=1.5,
-                        fill=False,
-                        alpha=1,
-                        zorder=2,
-                    )
-                    ax.add_patch(feature_border)
-                    ax.add_patch(feature_fill)
+                    colormap = graphic_colormap(product, anomaly)
+                    stretch = graphic_stretch(product, anomaly, anomaly_type)
 
                     if label:
-                        feature_label = f"Region: Custom Geometry"
-                        date_label = f"\nDate: {str(date)}"
-                        product_label = f"\nProduct: {str(product.display_name)}"
-                        cropmask_label = (
-                            f"\nCrop Mask: {str(mask.display_name)}"
-                            if cropmask_id != "no-mask"
-                            else ""
-                        )
-
-                        if anomaly_type == "diff":
-                            anomaly_label = (
-                                f"\nAnomaly: Difference Image vs. {diff_year}"
-                            )
-                        elif anomaly_type:
-                            anomaly_label = f"\nAnomaly: {str(anom_type).capitalize()}"
-                        else:
-                            anomaly_label = ""
-
-                        anomaly_duration = f" - {anomaly}" if anomaly else ""
-                        # anomaly_diff = f'{}'
-
-                        label = (
-                            feature_label
-                            + date_label
-                            + product_label
-                            + anomaly_label
-                            + anomaly_duration
-                            + cropmask_label
-                        )
-
-                        text = AnchoredText(
-                            label, loc="lower right", prop={"size": 8}, frameon=True
+                        label = graphic_label(
+                            "Custom Geometry",
+                            date,
+                            product,
+                            mask_ds,
+                            anomaly,
+                            anomaly_type,
+                            diff_year,
                         )
-                        ax.add_artist(text)
 
-                    if legend:
-                        cbaxes = inset_axes(
-                            ax, "33%", "3%", loc="upper right", borderpad=1
+                    if renderer == "matplotlib":
+                        png = matplotlib_graphic(
+                            figsize,
+                            extent_envelope(boundary_feature_geom.extent, buff).extent,
+                            backdrop_querysets,
+                            scale_factor,
+                            boundary_feature_geom,
+                            image[0],
+                            boundary_feature_geom.extent,
+                            colormap,
+                            stretch,
+                            label=label,
+                            legend=product_variable if legend else None,
+                            scale=product_scale,
                         )
-                        cbaxes.tick_params(labelsize=8)
-
-                        # fig.colorbar(image, cax=cbaxes)
-                        cb = fig.colorbar(
-                            image,
-                            cax=cbaxes,
-                            orientation="horizontal",
-                            format=formatter,
+                    else:
+                        png = fast_graphic(
+                            figsize,
+                            extent_envelope(boundary_feature_geom.extent, buff).extent,
+                            f"custom-backdrop-{geom_hash}",
+                            backdrop_querysets,
+                            scale_factor,
+                            boundary_feature_geom,
+                            image[0],
+                            boundary_feature_geom.extent,
+                            colormap,
+                            stretch,
+                            label=label,
+                            legend=product_variable if legend else None,
+                            scale=product_scale,
                         )
-                        # cb.ax.xaxis.set_tick_params(color="white")
-                        cb.set_label(label=product_variable, fontsize=8)
+                    set_cached_graphic(cache_key, png, resolution_used)
 
-                    glam_logo = DataSource.objects.get(source_id="glam").logo.url
-                    logo = plt.imread(glam_logo)
-                    logo_ax = inset_axes(
-                        ax, width="15%", height="10%", loc="lower left"
+                    return Response(
+                        HttpResponse(png, content_type="image/png"),
+                        headers={"X-Resolution": resolution_used},
                     )
-                    logo_ax.imshow(logo, alpha=0.75, origin="upper")
-                    logo_ax.axis("off")
-
-                    response = HttpResponse(content_type="image/png")
-
-                    fig.savefig(
-                        response,
-                        transparent=True,
-                        facecolor=BLUE,
-                        bbox_inches="tight",
-                        pad_inches=0,
-                    )
-
-                    return Response(response)
 
             else:
                 raise APIException(
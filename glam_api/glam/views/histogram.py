@@ -1,18 +1,15 @@
 import json
-from decimal import Decimal
-from attr import dataclass
+from contextlib import ExitStack
 import numpy as np
 import pandas as pd
 import datetime
 
 import rasterio
-from rio_tiler.io import COGReader
-from rio_tiler.utils import get_array_statistics
 
 from rest_framework import viewsets
 from rest_framework.decorators import renderer_classes
 from rest_framework.response import Response
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, NotFound
 from rest_framework.renderers import BrowsableAPIRenderer
 
 
@@ -31,6 +28,7 @@ from drf_yasg import openapi
 
 from django.shortcuts import get_object_or_404, render
 from django.conf import settings
+from django.http import StreamingHttpResponse
 
 from ..models import (
     ProductRaster,
@@ -40,6 +38,7 @@ from ..models import (
     CropMask,
     BoundaryLayer,
     BoundaryFeature,
+    FeatureHistogramSketch,
 )
 from ..serializers import (
     HistogramBodySerializer,
@@ -47,13 +46,29 @@ from ..serializers import (
     HistogramResponseSerializer,
 )
 from ..renderers import OldGLAMHistRenderer
-from config.utils import get_closest_to_date
+from ..utils.cache import (
+    custom_geometry_hash,
+    get_cached,
+    set_cached,
+    versioned_key,
+)
+from ..utils.sketches import sketch_histogram, sketch_matches, sketch_value_range
+from ..utils.zonal import feature_decimates, map_feature_histograms
+from ..utils.resolvers import (
+    explain_response,
+    feature_read_plan,
+    get_baseline_datasets,
+    get_mask_dataset,
+    get_product_datasets,
+    wants_explain,
+)
 
 AVAILABLE_PRODUCTS = list()
 AVAILABLE_CROPMASKS = list()
 AVAILABLE_BOUNDARY_LAYERS = list()
 ANOMALY_LENGTH_CHOICES = list()
 ANOMALY_TYPE_CHOICES = list()
+RESOLUTION_CHOICES = ["auto", "full", "preview"]
 
 try:
     products = Product.objects.all()
@@ -173,7 +188,8 @@ range_param = openapi.Parameter(
 weights_param = openapi.Parameter(
     "weights",
     openapi.IN_QUERY,
-    description="comma separed weights values",
+    description="comma separed weights values (ignored, histograms are "
+    "computed block by block over the feature)",
     type=openapi.TYPE_STRING,
     format=openapi.TYPE_ARRAY,
 )
@@ -206,6 +222,219 @@ add_years_param = openapi.Parameter(
     format=openapi.TYPE_ARRAY,
 )
 
+resolution_param = openapi.Parameter(
+    "resolution",
+    openapi.IN_QUERY,
+    description="'auto' (default) for native resolution if it fits the time "
+    "budget and a reduced resolution otherwise, 'full' for an exact histogram "
+    "at native resolution, 'preview' for a fast approximation at reduced "
+    "resolution. The resolution used is reported in the X-Resolution header.",
+    type=openapi.TYPE_STRING,
+    enum=RESOLUTION_CHOICES,
+    default=RESOLUTION_CHOICES[0],
+)
+
+time_budget_param = openapi.Parameter(
+    "time_budget",
+    openapi.IN_QUERY,
+    description="Time budget in seconds used to pick the read resolution "
+    "(default: server setting)",
+    type=openapi.TYPE_NUMBER,
+)
+
+stream_param = openapi.Parameter(
+    "stream",
+    openapi.IN_QUERY,
+    description="Stream the histograms as newline delimited JSON, "
+    "one line per year as soon as it is computed",
+    type=openapi.TYPE_BOOLEAN,
+)
+
+explain_param = openapi.Parameter(
+    "explain",
+    openapi.IN_QUERY,
+    description="Return the raster read plan (datasets, windows, overview "
+    "levels, estimated bytes and range requests) without reading pixels",
+    type=openapi.TYPE_BOOLEAN,
+)
+
+
+def year_dataset_pairs(
+    product, years, month, day, anomaly=None, anomaly_type=None, diff_year=None
+):
+    """
+    (product dataset, anomaly dataset or None) pairs closest to the same day
+    of each year, with the product dates resolved in bulk.
+    """
+    dates = [datetime.date(int(year), month, day) for year in years]
+    product_datasets = [
+        dataset
+        for dataset in get_product_datasets(product.product_id, dates)
+        if dataset is not None
+    ]
+
+    anomaly_datasets = [None] * len(product_datasets)
+    if anomaly_type:
+        anomaly_datasets = get_baseline_datasets(
+            product_datasets, anomaly, anomaly_type, diff_year
+        )
+    return list(zip(product_datasets, anomaly_datasets))
+
+
+def iter_histogram_rows(
+    feature,
+    dataset_pairs,
+    mask_dataset=None,
+    resolution="full",
+    time_budget=None,
+    **hist_options,
+):
+    """
+    Yield (index, row) of the histogram of each dataset pair over a feature
+    as soon as it finishes, with bin edges in product units.
+    All rows share the same bin edges.
+    """
+    if not dataset_pairs:
+        return
+    scale = dataset_pairs[0][0].product.variable.scale
+
+    for index, hist, bin_edges, resolution_used in map_feature_histograms(
+        feature,
+        dataset_pairs,
+        mask_dataset=mask_dataset,
+        resolution=resolution,
+        time_budget=time_budget,
+        **hist_options,
+    ):
+        yield index, {
+            "date": dataset_pairs[index][0].date.strftime("%Y-%d-%m"),
+            "hist": hist,
+            "bin_edges": [x * scale for x in bin_edges],
+            "resolution": resolution_used,
+        }
+
+
+def sketch_histogram_rows(
+    feature,
+    dataset_pairs,
+    mask_dataset=None,
+    resolution=None,
+    time_budget=None,
+    bins=10,
+    range=None,
+    density=False,
+):
+    """
+    (index, row) histogram rows derived from the precomputed sketches of a
+    boundary feature, without reading rasters. Returns None unless every
+    dataset has a sketch; anomaly histograms are never sketched. Sketches
+    approximate a "preview"; an "auto" histogram only uses them when native
+    resolution would not fit `time_budget`, and a "full" histogram only when
+    the sketch bin edges include the requested edges, so that it is exact.
+    """
+    if any(anomaly_dataset is not None for _, anomaly_dataset in dataset_pairs):
+        return None
+
+    product_datasets = [product_dataset for product_dataset, _ in dataset_pairs]
+    sketches = {
+        sketch.product_raster_id: sketch
+        for sketch in FeatureHistogramSketch.objects.filter(
+            product_raster__in=product_datasets,
+            boundary_feature=feature,
+            cropmask_raster=mask_dataset,
+        )
+    }
+    if any(dataset.pk not in sketches for dataset in product_datasets):
+        return None
+    if resolution == "full" and not all(
+        sketch_matches(sketch.histogram, sketch.value_range, bins, range)
+        for sketch in sketches.values()
+    ):
+        return None
+    if resolution not in ("full", "preview") and not feature_decimates(
+        feature, product_datasets[0], mask_dataset, time_budget
+    ):
+        return None
+
+    if range is None:
+        ranges = [
+            sketch_value_range(sketch.histogram, sketch.value_range)
+            for sketch in sketches.values()
+        ]
+        ranges = [r for r in ranges if r is not None]
+        range = (
+            (min(r[0] for r in ranges), max(r[1] for r in ranges))
+            if ranges
+            else (0.0, 1.0)
+        )
+
+    rows = []
+    for index, product_dataset in enumerate(product_datasets):
+        sketch = sketches[product_dataset.pk]
+        hist, bin_edges = sketch_histogram(
+            sketch.histogram, sketch.value_range, bins=bins, range=range, density=density
+        )
+        scale = product_dataset.product.variable.scale
+        rows.append(
+            (
+                index,
+                {
+                    "date": product_dataset.date.strftime("%Y-%d-%m"),
+                    "hist": hist,
+                    "bin_edges": [x * scale for x in bin_edges],
+                    "resolution": "sketch",
+                },
+            )
+        )
+    return rows
+
+
+def histogram_response(rows, stream=False, cache_key=None):
+    """
+    Response of (index, row) histogram rows: streamed as newline delimited
+    JSON as each row finishes, or a DataFrame in request order.
+    Complete results are cached under `cache_key`.
+    """
+    results = []
+
+    def collect():
+        for index, row in rows:
+            results.append((index, row))
+            yield row
+        if cache_key:
+            set_cached(cache_key, sorted(results, key=lambda result: result[0]))
+
+    if stream:
+        return StreamingHttpResponse(
+            (json.dumps(row) + "\n" for row in collect()),
+            content_type="application/x-ndjson",
+        )
+
+    for row in collect():
+        pass
+    results.sort(key=lambda result: result[0])
+    resolutions = sorted(set(row["resolution"] for index, row in results))
+
+    output = pd.DataFrame(
+        [
+            {key: value for key, value in row.items() if key != "resolution"}
+            for index, row in results
+        ]
+    )
+    output.set_index("date")
+    return Response(output, headers={"X-Resolution": ",".join(resolutions)})
+
+
+def histogram_read_plan(plans):
+    """Read plan of a (multi-year) histogram: one plan per requested year"""
+    return {
+        "explain": True,
+        "route": "histogram",
+        "years": plans,
+        "estimated_bytes": sum(p["estimated_bytes"] for p in plans),
+        "range_requests": sum(p["range_requests"] for p in plans),
+    }
+
 
 class Histogram(PandasViewSet):
 
@@ -250,7 +479,7 @@ class Histogram(PandasViewSet):
     )
 
     @swagger_auto_schema(
-        manual_parameters=[],
+        manual_parameters=[explain_param],
         operation_id="custom histogram",
         request_body=HistogramBodySerializer,
         responses={200: resp_200},
@@ -290,137 +519,81 @@ class Histogram(PandasViewSet):
                 hist_range = [
                     float(float(r) / product.variable.scale) for r in hist_range
                 ]
-            hist_weights = data.get("weights", None)
             hist_density = data.get("density", None)
 
             hist_options = {
                 "bins": hist_bins,
                 "range": hist_range,
-                "weights": hist_weights,
                 "density": hist_density,
             }
 
+            resolution = data.get("resolution", None)
+            time_budget = data.get("time_budget", None)
+
             years = data.get("add_years", None)
             if years:
                 years.append(date.year)
             else:
                 years = [date.year]
 
-            month = date.month
-            day = date.day
-
-            product_queryset = ProductRaster.objects.filter(product=product)
-
-            resp_list = []
-
-            for year in years:
-                new_date = datetime.date(int(year), month, day)
-                product_dataset = get_closest_to_date(product_queryset, new_date)
-
-                if not settings.USE_S3:
-                    path = product_dataset.file_object.path
-                if settings.USE_S3:
-                    path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{product_dataset.file_object.name}"
-
-                if geom["type"] == "Polygon" or geom["type"] == "MultiPolygon":
-                    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env:
-                        with COGReader(path) as product_src:
-                            feat = product_src.feature(geom, max_size=1024)
-                            data = feat.as_masked()
-
-                        if cropmask:
-                            mask_queryset = CropmaskRaster.objects.all()
-                            mask_dataset = get_object_or_404(
-                                mask_queryset,
-                                product__product_id=product_id,
-                                crop_mask__cropmask_id=cropmask,
+            stream = data.get("stream", False)
+
+            if geom["type"] != "Polygon" and geom["type"] != "MultiPolygon":
+                raise APIException(
+                    "Geometry must be of type 'Polygon' or 'MultiPolygon"
+                )
+
+            mask_dataset = get_mask_dataset(product_id, cropmask)
+            dataset_pairs = year_dataset_pairs(
+                product, years, date.month, date.day, anomaly, anomaly_type, diff_year
+            )
+            if not dataset_pairs:
+                raise NotFound("No datasets available for the requested years")
+
+            # the time budget is shared by all requested years
+            year_budget = (time_budget or settings.QUERY_TIME_BUDGET) / len(years)
+
+            if wants_explain(request):
+                return explain_response(
+                    request,
+                    histogram_read_plan(
+                        [
+                            feature_read_plan(
+                                "histogram",
+                                [
+                                    ("product", product_dataset),
+                                    ("cropmask", mask_dataset),
+                                    ("baseline", anomaly_dataset),
+                                ],
+                                geom,
+                                resolution=resolution,
+                                time_budget=year_budget,
                             )
-
-                            if not settings.USE_S3:
-                                mask_path = mask_dataset.file_object.path
-                            if settings.USE_S3:
-                                mask_path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{mask_dataset.file_object.name}"
-
-                            with COGReader(mask_path) as mask_src:
-                                mask_feat = mask_src.feature(geom, max_size=1024)
-                                mask_data = mask_feat.as_masked()
-
-                                data = data * mask_data
-
-                        if anomaly_type:
-                            anom_type = anomaly_type if anomaly_type else "mean"
-
-                            if anom_type == "diff":
-                                new_year = diff_year
-                                new_date = product_dataset.date.replace(year=new_year)
-                                anomaly_queryset = ProductRaster.objects.filter(
-                                    product__product_id=product_id
-                                )
-                                closest = get_closest_to_date(
-                                    anomaly_queryset, new_date
-                                )
-                                try:
-                                    anomaly_dataset = get_object_or_404(
-                                        product_queryset, date=new_date
-                                    )
-                                except:
-                                    anomaly_dataset = closest
-                            else:
-                                doy = product_dataset.date.timetuple().tm_yday
-                                if product_id == "swi":
-                                    swi_baselines = np.arange(1, 366, 5)
-                                    idx = (np.abs(swi_baselines - doy)).argmin()
-                                    doy = swi_baselines[idx]
-                                if product_id == "chirps":
-                                    doy = int(str(date.month) + f"{date.day:02d}")
-                                anomaly_queryset = AnomalyBaselineRaster.objects.all()
-                                anomaly_dataset = get_object_or_404(
-                                    anomaly_queryset,
-                                    product__product_id=product_id,
-                                    day_of_year=doy,
-                                    baseline_length=anomaly,
-                                    baseline_type=anom_type,
-                                )
-
-                            if not settings.USE_S3:
-                                baseline_path = anomaly_dataset.file_object.path
-                            if settings.USE_S3:
-                                baseline_path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{anomaly_dataset.file_object.name}"
-
-                            with COGReader(baseline_path) as baseline_src:
-                                baseline_feat = baseline_src.feature(
-                                    geom, max_size=1024
-                                )
-                                baseline_data = baseline_feat.as_masked()
-
-                            if cropmask:
-                                # mask baseline data
-                                baseline_data = baseline_data * mask_data
-
-                            data = data - baseline_data
-
-                        stats = get_array_statistics(data, **hist_options)
-                        hist = stats[0]["histogram"][0]
-                        bin_edges = stats[0]["histogram"][1]
-                        new_bins = [
-                            x * product_dataset.product.variable.scale
-                            for x in bin_edges
+                            for product_dataset, anomaly_dataset in dataset_pairs
                         ]
-
-                        result = {
-                            "date": product_dataset.date.strftime("%Y-%d-%m"),
-                            "hist": hist,
-                            "bin_edges": new_bins,
-                        }
-                        resp_list.append(result)
-                else:
-                    raise APIException(
-                        "Geometry must be of type 'Polygon' or 'MultiPolygon"
-                    )
-
-            output = pd.DataFrame(resp_list)
-            output.set_index("date")
-            return Response(output)
+                    ),
+                )
+
+            geom_hash = custom_geometry_hash(dataset_pairs[0][0], geom)
+            dates = "-".join(str(pair[0].date) for pair in dataset_pairs)
+            cache_key = versioned_key(
+                f"custom-histogram-{product_id}-{dates}-{cropmask}-{geom_hash}-{anomaly}-{anomaly_type}-{diff_year}-{hist_bins}-{hist_range}-{hist_density}-{resolution}-{time_budget}",
+                mask_dataset,
+                *[dataset for pair in dataset_pairs for dataset in pair],
+            )
+            cached = get_cached(cache_key)
+            if cached:
+                return histogram_response(cached, stream=stream)
+
+            rows = iter_histogram_rows(
+                geom,
+                dataset_pairs,
+                mask_dataset=mask_dataset,
+                resolution=resolution,
+                time_budget=year_budget,
+                **hist_options,
+            )
+            return histogram_response(rows, stream=stream, cache_key=cache_key)
 
     @swagger_auto_schema(
         operation_id="boundary feature histogram",
@@ -439,6 +612,10 @@ class Histogram(PandasViewSet):
             density_param,
             add_years_param,
             diff_year_param,
+            resolution_param,
+            time_budget_param,
+            stream_param,
+            explain_param,
         ],
     )
     def boundary_feature_histogram(
@@ -477,16 +654,17 @@ class Histogram(PandasViewSet):
                 hist_range = [
                     float(float(r) / product.variable.scale) for r in hist_range
                 ]
-            hist_weights = data.get("weights", None)
             hist_density = data.get("density", None)
 
             hist_options = {
                 "bins": hist_bins,
                 "range": hist_range,
-                "weights": hist_weights,
                 "density": hist_density,
             }
 
+            resolution = data.get("resolution", None)
+            time_budget = data.get("time_budget", None)
+
             years = data.get("add_years", None)
             if years:
                 years = years.split(",")
@@ -494,116 +672,72 @@ class Histogram(PandasViewSet):
             else:
                 years = [date.year]
 
-            month = date.month
-            day = date.day
-
-            product_queryset = ProductRaster.objects.filter(product=product)
-
-            resp_list = []
-
-            with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env:
-
-                for year in years:
-                    new_date = datetime.date(int(year), month, day)
-                    product_dataset = get_closest_to_date(product_queryset, new_date)
-
-                    boundary_layer = BoundaryLayer.objects.get(layer_id=layer_id)
-                    boundary_feature = BoundaryFeature.objects.get(
-                        boundary_layer=boundary_layer, feature_id=feature_id
-                    )
-
-                    if not settings.USE_S3:
-                        path = product_dataset.file_object.path
-                    if settings.USE_S3:
-                        path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{product_dataset.file_object.name}"
-
-                    geom = json.loads(boundary_feature.geom.geojson)
-
-                    with COGReader(path) as product_src:
-                        feat = product_src.feature(geom, max_size=1024)
-                        data = feat.as_masked()
-
-                    if cropmask:
-                        mask_queryset = CropmaskRaster.objects.all()
-                        mask_dataset = get_object_or_404(
-                            mask_queryset,
-                            product__product_id=product_id,
-                            crop_mask__cropmask_id=cropmask,
-                        )
-
-                        if not settings.USE_S3:
-                            mask_path = mask_dataset.file_object.path
-                        if settings.USE_S3:
-                            mask_path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{mask_dataset.file_object.name}"
-
-                        with COGReader(mask_path) as mask_src:
-                            mask_feat = mask_src.feature(geom, max_size=1024)
-                            mask_data = mask_feat.as_masked()
-
-                            data = data * mask_data
-
-                    if anomaly_type:
-                        anom_type = anomaly_type if anomaly_type else "mean"
-
-                        if anom_type == "diff":
-                            new_year = diff_year
-                            new_date = product_dataset.date.replace(year=new_year)
-                            anomaly_queryset = ProductRaster.objects.filter(
-                                product__product_id=product_id
+            stream = data.get("stream", False)
+
+            boundary_layer = get_object_or_404(BoundaryLayer, layer_id=layer_id)
+            boundary_feature = get_object_or_404(
+                BoundaryFeature, boundary_layer=boundary_layer, feature_id=feature_id
+            )
+
+            mask_dataset = get_mask_dataset(product_id, cropmask)
+            dataset_pairs = year_dataset_pairs(
+                product, years, date.month, date.day, anomaly, anomaly_type, diff_year
+            )
+            if not dataset_pairs:
+                raise NotFound("No datasets available for the requested years")
+
+            # the time budget is shared by all requested years
+            year_budget = (time_budget or settings.QUERY_TIME_BUDGET) / len(years)
+
+            if wants_explain(request):
+                return explain_response(
+                    request,
+                    histogram_read_plan(
+                        [
+                            feature_read_plan(
+                                "histogram",
+                                [
+                                    ("product", product_dataset),
+                                    ("cropmask", mask_dataset),
+                                    ("baseline", anomaly_dataset),
+                                ],
+                                boundary_feature,
+                                resolution=resolution,
+                                time_budget=year_budget,
                             )
-                            closest = get_closest_to_date(anomaly_queryset, new_date)
-                            try:
-                                anomaly_dataset = get_object_or_404(
-                                    product_queryset, date=new_date
-                                )
-                            except:
-                                anomaly_dataset = closest
-                        else:
-                            doy = product_dataset.date.timetuple().tm_yday
-                            if product_id == "swi":
-                                swi_baselines = np.arange(1, 366, 5)
-                                idx = (np.abs(swi_baselines - doy)).argmin()
-                                doy = swi_baselines[idx]
-                            if product_id == "chirps":
-                                doy = int(str(date.month) + f"{date.day:02d}")
-                            anomaly_queryset = AnomalyBaselineRaster.objects.all()
-                            anomaly_dataset = get_object_or_404(
-                                anomaly_queryset,
-                                product__product_id=product_id,
-                                day_of_year=doy,
-                                baseline_length=anomaly,
-                                baseline_type=anom_type,
-                            )
-
-                        if not settings.USE_S3:
-                            baseline_path = anomaly_dataset.file_object.path
-                        if settings.USE_S3:
-                            baseline_path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{anomaly_dataset.file_object.name}"
-
-                        with COGReader(baseline_path) as baseline_src:
-                            baseline_feat = baseline_src.feature(geom, max_size=1024)
-                            baseline_data = baseline_feat.as_masked()
-
-                        if cropmask:
-                            # mask baseline data
-                            baseline_data = baseline_data * mask_data
-
-                        data = data - baseline_data
-
-                    stats = get_array_statistics(data, **hist_options)
-                    hist = stats[0]["histogram"][0]
-                    bin_edges = stats[0]["histogram"][1]
-                    new_bins = [
-                        x * product_dataset.product.variable.scale for x in bin_edges
-                    ]
-
-                    result = {
-                        "date": product_dataset.date.strftime("%Y-%d-%m"),
-                        "hist": hist,
-                        "bin_edges": new_bins,
-                    }
-                    resp_list.append(result)
-
-            output = pd.DataFrame(resp_list)
-            output.set_index("date")
-            return Response(output)
+                            for product_dataset, anomaly_dataset in dataset_pairs
+                        ]
+                    ),
+                )
+
+            dates = "-".join(str(pair[0].date) for pair in dataset_pairs)
+            cache_key = versioned_key(
+                f"boundary-histogram-{product_id}-{dates}-{cropmask}-{layer_id}-{feature_id}-{anomaly}-{anomaly_type}-{diff_year}-{hist_bins}-{hist_range}-{hist_density}-{resolution}-{time_budget}",
+                mask_dataset,
+                *[dataset for pair in dataset_pairs for dataset in pair],
+            )
+            cached = get_cached(cache_key)
+            if cached:
+                return histogram_response(cached, stream=stream)
+
+            # features of sketched layers need no raster reads
+            rows = sketch_histogram_rows(
+                boundary_feature,
+                dataset_pairs,
+                mask_dataset,
+                resolution=resolution,
+                time_budget=year_budget,
+                **hist_options,
+            )
+            if rows is not None:
+                return histogram_response(rows, stream=stream)
+
+            rows = iter_histogram_rows(
+                boundary_feature,
+                dataset_pairs,
+                mask_dataset=mask_dataset,
+                resolution=resolution,
+                time_budget=year_budget,
+                **hist_options,
+            )
+            return histogram_response(rows, stream=stream, cache_key=cache_key)
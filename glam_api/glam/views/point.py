@@ -7,11 +7,11 @@ from rio_tiler.io import COGReader
 
 from rest_framework import viewsets
 from rest_framework.response import Response
+from rest_framework.exceptions import NotFound
 
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
-from django.shortcuts import get_object_or_404
 from django.conf import settings
 
 from ..models import (
@@ -22,7 +22,15 @@ from ..models import (
     CropmaskRaster,
 )
 from ..serializers import PointValueSerializer, PointResponseSerializer
-from config.utils import get_closest_to_date
+from ..utils import get_raster_path
+from ..utils.resolvers import (
+    explain_response,
+    get_baseline_dataset,
+    get_mask_dataset,
+    get_product_dataset,
+    read_plan,
+    wants_explain,
+)
 
 
 class PointValue(viewsets.ViewSet):
@@ -123,6 +131,14 @@ class PointValue(viewsets.ViewSet):
         type=openapi.TYPE_INTEGER,
     )
 
+    explain_param = openapi.Parameter(
+        "explain",
+        openapi.IN_QUERY,
+        description="Return the raster read plan (datasets, windows, "
+        "estimated bytes and range requests) without reading pixels",
+        type=openapi.TYPE_BOOLEAN,
+    )
+
     resp_200 = openapi.Response(
         description="Point response",
         schema=PointResponseSerializer,
@@ -139,6 +155,7 @@ class PointValue(viewsets.ViewSet):
             anomaly_param,
             anomaly_type_param,
             diff_year_param,
+            explain_param,
         ],
         operation_id="get point value",
         responses={200: resp_200},
@@ -158,8 +175,7 @@ class PointValue(viewsets.ViewSet):
         Return pixel value for specified coordinates and dataset parameters.
         """
 
-        product_queryset = ProductRaster.objects.filter(product__product_id=product_id)
-        product_dataset = get_object_or_404(product_queryset, date=date)
+        product_dataset = get_product_dataset(product_id, date)
 
         params = PointValueSerializer(data=request.query_params)
         params.is_valid(raise_exception=True)
@@ -172,29 +188,39 @@ class PointValue(viewsets.ViewSet):
         if cropmask == "no-mask":
             cropmask = None
 
-        if not settings.USE_S3:
-            path = product_dataset.file_object.path
-        if settings.USE_S3:
-            path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{product_dataset.file_object.name}"
+        mask_dataset = get_mask_dataset(product_id, cropmask)
+
+        anomaly_dataset = None
+        if anomaly_type:
+            anomaly_dataset = get_baseline_dataset(
+                product_dataset, anomaly, anomaly_type, diff_year
+            )
+            if anomaly_dataset is None:
+                raise NotFound("No dataset of the diff year to compare to.")
+
+        if wants_explain(request):
+            return explain_response(
+                request,
+                read_plan(
+                    "point",
+                    [
+                        ("product", product_dataset),
+                        ("cropmask", mask_dataset),
+                        ("baseline", anomaly_dataset),
+                    ],
+                    (lon, lat, lon, lat),
+                    resolution="full",
+                ),
+            )
+
+        path = get_raster_path(product_dataset.file_object)
 
         dataset_value = None
 
         with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env:
 
             if cropmask:
-                mask_queryset = CropmaskRaster.objects.all()
-                mask_dataset = get_object_or_404(
-                    mask_queryset,
-                    product__product_id=product_id,
-                    crop_mask__cropmask_id=cropmask,
-                )
-
-                if not settings.USE_S3:
-                    mask_path = mask_dataset.file_object.path
-                if settings.USE_S3:
-                    mask_path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{mask_dataset.file_object.name}"
-
-                with COGReader(mask_path) as src:
+                with COGReader(get_raster_path(mask_dataset.file_object)) as src:
                     mask_data = src.point(lon, lat)
 
             with COGReader(path) as src:
@@ -222,42 +248,7 @@ class PointValue(viewsets.ViewSet):
                     dataset_value = data
 
             if anomaly_type:
-                anom_type = anomaly_type if anomaly_type else "mean"
-
-                if anom_type == "diff":
-                    new_year = diff_year
-                    new_date = product_dataset.date.replace(year=new_year)
-                    anomaly_queryset = ProductRaster.objects.filter(
-                        product__product_id=product_id
-                    )
-                    closest = get_closest_to_date(anomaly_queryset, new_date)
-                    try:
-                        anomaly_dataset = get_object_or_404(
-                            product_queryset, date=new_date
-                        )
-                    except:
-                        anomaly_dataset = closest
-                else:
-                    doy = product_dataset.date.timetuple().tm_yday
-                    if product_id == "swi":
-                        swi_baselines = np.arange(1, 366, 5)
-                        idx = (np.abs(swi_baselines - doy)).argmin()
-                        doy = swi_baselines[idx]
-                    if product_id == "chirps":
-                        doy = int(str(date.month) + f"{date.day:02d}")
-                    anomaly_queryset = AnomalyBaselineRaster.objects.all()
-                    anomaly_dataset = get_object_or_404(
-                        anomaly_queryset,
-                        product__product_id=product_id,
-                        day_of_year=doy,
-                        baseline_length=anomaly,
-                        baseline_type=anom_type,
-                    )
-
-                if not settings.USE_S3:
-                    baseline_path = anomaly_dataset.file_object.path
-                if settings.USE_S3:
-                    baseline_path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{anomaly_dataset.file_object.name}"
+                baseline_path = get_raster_path(anomaly_dataset.file_object)
 
                 with COGReader(baseline_path) as baseline_img:
                     baseline_data = baseline_img.point(lon, lat)
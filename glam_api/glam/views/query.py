@@ -1,15 +1,14 @@
-import json
-from decimal import Decimal, InvalidOperation
+from contextlib import ExitStack
 
 import numpy as np
 
-from rio_tiler.io import COGReader
-
 import rasterio
 
-from rest_framework import viewsets
+from rest_framework import status, viewsets
 from rest_framework.response import Response
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, NotFound
+
+from django_q.tasks import async_task, fetch
 
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
@@ -17,6 +16,7 @@ from drf_yasg import openapi
 from django.core.cache import cache
 from django.shortcuts import get_object_or_404
 from django.conf import settings
+from django.urls import reverse
 
 from ..models import (
     Product,
@@ -26,13 +26,34 @@ from ..models import (
     BoundaryFeature,
     BoundaryLayer,
     AnomalyBaselineRaster,
+    FeatureCropCoverage,
 )
 from ..serializers import (
     FeatureBodySerializer,
     FeatureResponseSerializer,
     QueryBoundaryFeatureSerializer,
 )
-from config.utils import get_closest_to_date
+from ..utils.cache import (
+    custom_geometry_hash,
+    get_cached,
+    set_cached,
+    versioned_key,
+)
+from ..utils.masks import get_feature_mask
+from ..utils.resolvers import (
+    explain_response,
+    feature_read_plan,
+    get_baseline_dataset,
+    get_mask_dataset,
+    get_product_dataset,
+    wants_explain,
+)
+from ..utils.zonal import (
+    decimation_factor,
+    open_datasets,
+    plan_resolution,
+    zonal_stats,
+)
 
 import logging
 
@@ -43,6 +64,13 @@ BASELINE_LENGTH_CHOICES = list()
 BASELINE_TYPE_CHOICES = list()
 ANOMALY_LENGTH_CHOICES = list()
 ANOMALY_TYPE_CHOICES = list()
+RESOLUTION_CHOICES = ["auto", "full", "preview"]
+
+# Seconds a queued full resolution query is shared by identical requests
+QUERY_TASK_TIMEOUT = 60 * 60
+
+# Task queued by queue_feature_query, the only one query_result returns
+QUERY_TASK_FUNC = "glam.views.query.run_feature_query"
 
 try:
     products = Product.objects.all()
@@ -77,6 +105,159 @@ except:
     pass
 
 
+def get_feature_coverage(boundary_feature, mask_dataset):
+    """
+    Return the precomputed FeatureCropCoverage of a boundary feature within
+    a cropmask dataset, or None if it has not been computed (yet).
+    """
+    if mask_dataset is None:
+        return None
+    return FeatureCropCoverage.objects.filter(
+        boundary_feature=boundary_feature, cropmask_raster=mask_dataset
+    ).first()
+
+
+def query_feature(
+    product_dataset,
+    feature,
+    mask_dataset=None,
+    baseline_dataset=None,
+    anomaly=False,
+    resolution="full",
+    time_budget=None,
+    defer_slow=False,
+):
+    """
+    Return min, max, mean and std of a product dataset over a feature
+    (BoundaryFeature or GeoJSON), optionally masked by a cropmask and
+    compared against a baseline dataset.
+
+    Rasters are streamed block by block over the feature window. With
+    resolution "auto" a decimated read is used if the native read is not
+    expected to fit in `time_budget`, "preview" always reads at reduced
+    resolution. The resolution used is returned under "resolution".
+    Cropmask values weight the pixels, pixels outside the cropmask are
+    excluded.
+
+    If `defer_slow` is set, a "full" resolution query that would exceed the
+    time budget returns None instead of being computed.
+    """
+    scale = product_dataset.product.variable.scale
+
+    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env, ExitStack() as stack:
+        sources = open_datasets(stack, product_dataset, mask_dataset, baseline_dataset)
+        product_src, mask_src, baseline_src = sources
+        feature_mask = get_feature_mask(product_src, feature)
+
+        if (
+            defer_slow
+            and resolution == "full"
+            and decimation_factor(feature_mask.shape, sources, time_budget) > 1
+        ):
+            return None
+
+        max_size, resolution_used = plan_resolution(
+            feature_mask.shape, sources, resolution, time_budget
+        )
+        product_stats, baseline_stats = zonal_stats(
+            feature_mask,
+            product_src,
+            mask_src,
+            baseline_src,
+            max_size=max_size,
+        )
+
+    if not product_stats.count:
+        return {"value": "No Data", "resolution": resolution_used}
+
+    if baseline_dataset is not None:
+        if anomaly:
+            # If Anomaly, Calculate difference between data and baseline
+            mean = product_stats.mean - baseline_stats.mean
+            _min = product_stats.min - baseline_stats.min
+            _max = product_stats.max - baseline_stats.max
+            stdev = product_stats.std - baseline_stats.std
+        else:
+            # If not Anomaly, just use baseline
+            mean = baseline_stats.mean
+            _min = baseline_stats.min
+            _max = baseline_stats.max
+            stdev = baseline_stats.std
+    else:
+        mean = product_stats.mean
+        _min = product_stats.min
+        _max = product_stats.max
+        stdev = product_stats.std
+
+    return {
+        "min": _min * scale,
+        "max": _max * scale,
+        "mean": mean * scale,
+        "std": stdev * scale,
+        "resolution": resolution_used,
+    }
+
+
+def run_feature_query(
+    product_dataset,
+    feature,
+    mask_dataset=None,
+    baseline_dataset=None,
+    anomaly=False,
+    cache_key=None,
+):
+    """
+    django-q task: full resolution query_feature without a time budget.
+    The result is stored under `cache_key` and returned as the task result.
+    """
+    result = query_feature(
+        product_dataset,
+        feature,
+        mask_dataset=mask_dataset,
+        baseline_dataset=baseline_dataset,
+        anomaly=anomaly,
+        resolution="full",
+    )
+    if cache_key:
+        set_cached(cache_key, result)
+    return result
+
+
+def queue_feature_query(request, *args, **kwargs):
+    """
+    Queue run_feature_query and return a 202 response pointing to its result.
+    Identical requests (same `cache_key`) share the query while it runs.
+    """
+    cache_key = kwargs.get("cache_key")
+    task_key = f"{cache_key}-task" if cache_key and settings.USE_CACHING else None
+
+    task_id = cache.get(task_key) if task_key else None
+    if task_id:
+        task = fetch(task_id)
+        if task is not None and not task.success:
+            # failed, queue it again
+            cache.delete(task_key)
+            task_id = None
+
+    if not task_id:
+        task_id = async_task(QUERY_TASK_FUNC, *args, **kwargs)
+        if task_key and not cache.add(task_key, task_id, timeout=QUERY_TASK_TIMEOUT):
+            # queued concurrently by an identical request
+            task_id = cache.get(task_key) or task_id
+
+    return Response(
+        {
+            "status": "queued",
+            "task_id": task_id,
+            "result": request.build_absolute_uri(
+                reverse("query-result", kwargs={"task_id": task_id})
+            ),
+        },
+        status=status.HTTP_202_ACCEPTED,
+        headers={"X-Resolution": "full"},
+    )
+
+
 class QueryRasterValue(viewsets.ViewSet):
     product_param = openapi.Parameter(
         "product_id",
@@ -163,6 +344,43 @@ class QueryRasterValue(viewsets.ViewSet):
         type=openapi.TYPE_INTEGER,
     )
 
+    resolution_param = openapi.Parameter(
+        "resolution",
+        openapi.IN_QUERY,
+        description="'auto' (default) for native resolution if it fits the time "
+        "budget and a reduced resolution otherwise, 'full' for exact statistics "
+        "at native resolution (queued as a job if it does not fit the time "
+        "budget), 'preview' for a fast approximation at reduced resolution. "
+        "The resolution used is reported in the X-Resolution header.",
+        type=openapi.TYPE_STRING,
+        enum=RESOLUTION_CHOICES,
+        default=RESOLUTION_CHOICES[0],
+    )
+
+    time_budget_param = openapi.Parameter(
+        "time_budget",
+        openapi.IN_QUERY,
+        description="Time budget in seconds used to pick the read resolution "
+        "(default: server setting)",
+        type=openapi.TYPE_NUMBER,
+    )
+
+    explain_param = openapi.Parameter(
+        "explain",
+        openapi.IN_QUERY,
+        description="Return the raster read plan (datasets, windows, overview "
+        "levels, estimated bytes and range requests) without reading pixels",
+        type=openapi.TYPE_BOOLEAN,
+    )
+
+    task_id_param = openapi.Parameter(
+        "task_id",
+        openapi.IN_PATH,
+        description="ID of a queued full resolution query.",
+        required=True,
+        type=openapi.TYPE_STRING,
+    )
+
     resp_200 = openapi.Response(
         description="Point response",
         schema=FeatureResponseSerializer,
@@ -172,12 +390,13 @@ class QueryRasterValue(viewsets.ViewSet):
                 "max": 221.01995849609375,
                 "mean": 94.43216405053599,
                 "std": 34.10421337679452,
+                "resolution": "full",
             }
         },
     )
 
     @swagger_auto_schema(
-        manual_parameters=[],
+        manual_parameters=[explain_param],
         operation_id="query custom feature",
         request_body=FeatureBodySerializer,
         responses={200: resp_200},
@@ -201,191 +420,83 @@ class QueryRasterValue(viewsets.ViewSet):
             anomaly_type = data.get("anomaly_type", None)
             diff_year = data.get("diff_year", None)
             cropmask_id = data.get("cropmask_id", None)
+            resolution = data.get("resolution", None)
+            time_budget = data.get("time_budget", None)
 
-            product_queryset = ProductRaster.objects.filter(
-                product__product_id=product_id
-            )
-            product_dataset = get_object_or_404(product_queryset, date=date)
-
-            if not settings.USE_S3:
-                path = product_dataset.file_object.path
-            if settings.USE_S3:
-                path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{product_dataset.file_object.name}"
+            product_dataset = get_product_dataset(product_id, date)
 
             if (
                 geom["geometry"]["type"] == "Polygon"
                 or geom["geometry"]["type"] == "MultiPolygon"
             ):
-                try:
-                    with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env:
-                        with COGReader(path) as product_src:
-                            feat = product_src.feature(geom, max_size=1024)
-                            data = feat.as_masked()
-
-                            mean = float(
-                                Decimal(str(data.mean()))
-                                * Decimal(str(product_dataset.product.variable.scale))
-                            )
-                            _min = float(
-                                Decimal(str(data.min()))
-                                * Decimal(str(product_dataset.product.variable.scale))
-                            )
-                            _max = float(
-                                Decimal(str(data.max()))
-                                * Decimal(str(product_dataset.product.variable.scale))
-                            )
-                            stdev = float(
-                                Decimal(str(data.std()))
-                                * Decimal(str(product_dataset.product.variable.scale))
-                            )
-
-                        if cropmask_id != "no-mask":
-                            mask_queryset = CropmaskRaster.objects.all()
-                            mask_dataset = get_object_or_404(
-                                mask_queryset,
-                                product__product_id=product_id,
-                                crop_mask__cropmask_id=cropmask_id,
-                            )
-
-                            if not settings.USE_S3:
-                                mask_path = mask_dataset.file_object.path
-                            if settings.USE_S3:
-                                mask_path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{mask_dataset.file_object.name}"
-
-                            with COGReader(mask_path) as mask_src:
-                                mask_feat = mask_src.feature(geom, max_size=1024)
-                                mask_data = mask_feat.as_masked()
-
-                                data = data * mask_data
-
-                                mean = float(
-                                    Decimal(str(data.mean()))
-                                    * Decimal(
-                                        str(product_dataset.product.variable.scale)
-                                    )
-                                )
-                                _min = float(
-                                    Decimal(str(data.min()))
-                                    * Decimal(
-                                        str(product_dataset.product.variable.scale)
-                                    )
-                                )
-                                _max = float(
-                                    Decimal(str(data.max()))
-                                    * Decimal(
-                                        str(product_dataset.product.variable.scale)
-                                    )
-                                )
-                                stdev = float(
-                                    Decimal(str(data.std()))
-                                    * Decimal(
-                                        str(product_dataset.product.variable.scale)
-                                    )
-                                )
-
-                        if baseline_type or anomaly_type:
-
-                            if anomaly_type:
-                                baseline_type = anomaly_type if anomaly_type else "mean"
-                                baseline = anomaly if anomaly else "5year"
-                            else:
-                                baseline_type = (
-                                    baseline_type if baseline_type else "mean"
-                                )
-                                baseline = baseline if baseline else "5year"
-
-                            doy = product_dataset.date.timetuple().tm_yday
-                            if product_id == "copernicus-swi":
-                                swi_baselines = np.arange(1, 366, 5)
-                                idx = (np.abs(swi_baselines - doy)).argmin()
-                                doy = swi_baselines[idx]
-                            if product_id == "chirps-precip":
-                                doy = int(str(date.month) + f"{date.day:02d}")
-                            baseline_queryset = AnomalyBaselineRaster.objects.all()
-                            baseline_dataset = get_object_or_404(
-                                baseline_queryset,
-                                product__product_id=product_id,
-                                day_of_year=doy,
-                                baseline_length=baseline,
-                                baseline_type=baseline_type,
-                            )
-
-                            if not settings.USE_S3:
-                                baseline_path = baseline_dataset.file_object.path
-                            if settings.USE_S3:
-                                baseline_path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{baseline_dataset.file_object.name}"
-
-                            with COGReader(baseline_path) as baseline_src:
-                                baseline_feat = baseline_src.feature(
-                                    geom, max_size=1024
-                                )
-                                baseline_data = baseline_feat.as_masked()
-
-                            if cropmask_id != "no-mask":
-                                # mask baseline data
-                                baseline_data = baseline_data * mask_data
-
-                            if anomaly_type:
-                                if baseline_type == "diff":
-                                    new_year = diff_year
-                                    new_date = product_dataset.date.replace(
-                                        year=new_year
-                                    )
-                                    baseline_queryset = ProductRaster.objects.filter(
-                                        product__product_id=product_id
-                                    )
-                                    closest = get_closest_to_date(
-                                        baseline_queryset, new_date
-                                    )
-                                    try:
-                                        baseline_dataset = get_object_or_404(
-                                            product_queryset, date=new_date
-                                        )
-                                    except:
-                                        baseline_dataset = closest
-                                # If Anomaly, Calculate difference between data and baseline
-                                mean = data.mean() - baseline_data.mean()
-                                _min = data.min() - baseline_data.min()
-                                _max = data.max() - baseline_data.max()
-                                stdev = data.std() - baseline_data.std()
-                            else:
-                                # If not Anomaly, just use baseline
-                                mean = baseline_data.mean()
-                                _min = baseline_data.min()
-                                _max = baseline_data.max()
-                                stdev = baseline_data.std()
-
-                            mean = float(
-                                Decimal(str(mean))
-                                * Decimal(str(product_dataset.product.variable.scale))
-                            )
-                            _min = float(
-                                Decimal(str(_min))
-                                * Decimal(str(product_dataset.product.variable.scale))
-                            )
-                            _max = float(
-                                Decimal(str(_max))
-                                * Decimal(str(product_dataset.product.variable.scale))
-                            )
-                            stdev = float(
-                                Decimal(str(stdev))
-                                * Decimal(str(product_dataset.product.variable.scale))
-                            )
-
-                        if type(mean) != np.ma.core.MaskedConstant:
-                            result = {
-                                "min": _min,
-                                "max": _max,
-                                "mean": mean,
-                                "std": stdev,
-                            }
-                        else:
-                            result = {"value": "No Data"}
-                            return Response(result)
-                except InvalidOperation:
-                    result = {"value": "No Data"}
-
-                return Response(result)
+                geom_hash = custom_geometry_hash(product_dataset, geom)
+                cache_key = f"custom-query-{product_id}-{date}-{cropmask_id}-{geom_hash}-{baseline}-{baseline_type}-{anomaly}-{anomaly_type}-{diff_year}-{resolution}-{time_budget}"
+                explain = wants_explain(request)
+
+                mask_dataset = get_mask_dataset(product_id, cropmask_id)
+
+                baseline_dataset = None
+                if baseline_type or anomaly_type:
+                    if anomaly_type:
+                        baseline_type = anomaly_type
+                        baseline = anomaly if anomaly else "5year"
+                    else:
+                        baseline_type = baseline_type if baseline_type else "mean"
+                        baseline = baseline if baseline else "5year"
+                    baseline_dataset = get_baseline_dataset(
+                        product_dataset, baseline, baseline_type, diff_year
+                    )
+
+                if explain:
+                    return explain_response(
+                        request,
+                        feature_read_plan(
+                            "query",
+                            [
+                                ("product", product_dataset),
+                                ("cropmask", mask_dataset),
+                                ("baseline", baseline_dataset),
+                            ],
+                            geom,
+                            resolution=resolution,
+                            time_budget=time_budget,
+                        ),
+                    )
+
+                cache_key = versioned_key(
+                    cache_key, product_dataset, mask_dataset, baseline_dataset
+                )
+                result = get_cached(cache_key)
+                if result:
+                    return Response(
+                        result, headers={"X-Resolution": result.get("resolution")}
+                    )
+
+                result = query_feature(
+                    product_dataset,
+                    geom,
+                    mask_dataset=mask_dataset,
+                    baseline_dataset=baseline_dataset,
+                    anomaly=bool(anomaly_type),
+                    resolution=resolution,
+                    time_budget=time_budget,
+                    defer_slow=True,
+                )
+
+                if result is None:
+                    return queue_feature_query(
+                        request,
+                        product_dataset,
+                        geom,
+                        mask_dataset=mask_dataset,
+                        baseline_dataset=baseline_dataset,
+                        anomaly=bool(anomaly_type),
+                        cache_key=cache_key,
+                    )
+
+                set_cached(cache_key, result)
+
+                return Response(result, headers={"X-Resolution": result["resolution"]})
 
             else:
                 raise APIException(
@@ -405,6 +516,9 @@ class QueryRasterValue(viewsets.ViewSet):
             anomaly_param,
             anomaly_type_param,
             diff_year_param,
+            resolution_param,
+            time_budget_param,
+            explain_param,
         ],
     )
     def query_boundary_feature(
@@ -429,19 +543,14 @@ class QueryRasterValue(viewsets.ViewSet):
         anomaly = data.get("anomaly", None)
         anomaly_type = data.get("anomaly_type", None)
         diff_year = data.get("diff_year", None)
+        resolution = data.get("resolution", None)
+        time_budget = data.get("time_budget", None)
 
-        if settings.USE_CACHING:
-            cache_key = f"boundary-query-{product_id}-{date}-{cropmask_id}-{layer_id}-{feature_id}-{baseline}-{baseline_type}-{anomaly}-{anomaly_type}-{diff_year}"
-
-            data = cache.get(cache_key)
-            if data:
-                logging.debug(f"cache hit: {cache_key}")
-                return Response(data)
-            logging.debug
+        cache_key = f"boundary-query-{product_id}-{date}-{cropmask_id}-{layer_id}-{feature_id}-{baseline}-{baseline_type}-{anomaly}-{anomaly_type}-{diff_year}-{resolution}-{time_budget}"
 
-        product_queryset = ProductRaster.objects.filter(product__product_id=product_id)
+        explain = wants_explain(request)
 
-        product_dataset = get_object_or_404(product_queryset, date=date)
+        product_dataset = get_product_dataset(product_id, date)
 
         boundary_layer = BoundaryLayer.objects.get(layer_id=layer_id)
         boundary_features = BoundaryFeature.objects.filter(
@@ -449,171 +558,97 @@ class QueryRasterValue(viewsets.ViewSet):
         )
         boundary_feature = get_object_or_404(boundary_features, feature_id=feature_id)
 
-        # TODO: fix numpy "operands could not be broadcast together" error with small geometries
-        # if boundary feature below certain size, max_size = None or smaller max_size
-
-        if not settings.USE_S3:
-            path = product_dataset.file_object.path
-        if settings.USE_S3:
-            path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{product_dataset.file_object.name}"
-
-        try:
-            with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env:
-                with COGReader(path) as product_src:
-                    feat = product_src.feature(
-                        json.loads(boundary_feature.geom.geojson), max_size=1024
-                    )
-                    data = feat.as_masked()
-
-                    if type(data.mean()) == np.ma.core.MaskedConstant:
-                        result = {"value": "No Data"}
-                        return Response(result)
-                    mean = float(
-                        Decimal(str(data.mean()))
-                        * Decimal(str(product_dataset.product.variable.scale))
-                    )
-                    _min = float(
-                        Decimal(str(data.min()))
-                        * Decimal(str(product_dataset.product.variable.scale))
-                    )
-                    _max = float(
-                        Decimal(str(data.max()))
-                        * Decimal(str(product_dataset.product.variable.scale))
-                    )
-                    stdev = float(
-                        Decimal(str(data.std()))
-                        * Decimal(str(product_dataset.product.variable.scale))
-                    )
+        mask_dataset = get_mask_dataset(product_id, cropmask_id)
 
-                if cropmask_id != "no-mask":
-                    mask_queryset = CropmaskRaster.objects.all()
-                    mask_dataset = get_object_or_404(
-                        mask_queryset,
-                        product__product_id=product_id,
-                        crop_mask__cropmask_id=cropmask_id,
-                    )
-
-                    if not settings.USE_S3:
-                        mask_path = mask_dataset.file_object.path
-                    if settings.USE_S3:
-                        mask_path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{mask_dataset.file_object.name}"
-
-                    with COGReader(mask_path) as mask_src:
-                        mask_feat = mask_src.feature(
-                            json.loads(boundary_feature.geom.geojson), max_size=1024
-                        )
-                        mask_data = mask_feat.as_masked()
-
-                        data = data * mask_data
-
-                        mean = float(
-                            Decimal(str(data.mean()))
-                            * Decimal(str(product_dataset.product.variable.scale))
-                        )
-                        _min = float(
-                            Decimal(str(data.min()))
-                            * Decimal(str(product_dataset.product.variable.scale))
-                        )
-                        _max = float(
-                            Decimal(str(data.max()))
-                            * Decimal(str(product_dataset.product.variable.scale))
-                        )
-                        stdev = float(
-                            Decimal(str(data.std()))
-                            * Decimal(str(product_dataset.product.variable.scale))
-                        )
-
-                if baseline_type or anomaly_type:
+        # features without cropland have no masked statistics
+        coverage = get_feature_coverage(boundary_feature, mask_dataset)
+        if coverage is not None and not coverage.arable_pixels and not explain:
+            return Response(
+                {"value": "No Data", "resolution": "full"},
+                headers={"X-Resolution": "full"},
+            )
 
-                    if anomaly_type:
-                        baseline_type = anomaly_type if anomaly_type else "mean"
-                        baseline = anomaly if anomaly else "5year"
-                    else:
-                        baseline_type = baseline_type if baseline_type else "mean"
-                        baseline = baseline if baseline else "5year"
+        baseline_dataset = None
+        if baseline_type or anomaly_type:
+            if anomaly_type:
+                baseline_type = anomaly_type
+                baseline = anomaly if anomaly else "5year"
+            else:
+                baseline_type = baseline_type if baseline_type else "mean"
+                baseline = baseline if baseline else "5year"
+            baseline_dataset = get_baseline_dataset(
+                product_dataset, baseline, baseline_type, diff_year
+            )
 
-                    doy = product_dataset.date.timetuple().tm_yday
-                    if product_id == "copernicus-swi":
-                        swi_baselines = np.arange(1, 366, 5)
-                        idx = (np.abs(swi_baselines - doy)).argmin()
-                        doy = swi_baselines[idx]
-                    if product_id == "chirps-precip":
-                        doy = int(str(date.month) + f"{date.day:02d}")
-                    baseline_queryset = AnomalyBaselineRaster.objects.all()
-                    baseline_dataset = get_object_or_404(
-                        baseline_queryset,
-                        product__product_id=product_id,
-                        day_of_year=doy,
-                        baseline_length=baseline,
-                        baseline_type=baseline_type,
-                    )
+        if explain:
+            return explain_response(
+                request,
+                feature_read_plan(
+                    "query",
+                    [
+                        ("product", product_dataset),
+                        ("cropmask", mask_dataset),
+                        ("baseline", baseline_dataset),
+                    ],
+                    boundary_feature,
+                    resolution=resolution,
+                    time_budget=time_budget,
+                ),
+            )
 
-                    if not settings.USE_S3:
-                        baseline_path = baseline_dataset.file_object.path
-                    if settings.USE_S3:
-                        baseline_path = f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{baseline_dataset.file_object.name}"
+        cache_key = versioned_key(
+            cache_key, product_dataset, mask_dataset, baseline_dataset
+        )
+        result = get_cached(cache_key)
+        if result:
+            return Response(result, headers={"X-Resolution": result.get("resolution")})
+
+        result = query_feature(
+            product_dataset,
+            boundary_feature,
+            mask_dataset=mask_dataset,
+            baseline_dataset=baseline_dataset,
+            anomaly=bool(anomaly_type),
+            resolution=resolution,
+            time_budget=time_budget,
+            defer_slow=True,
+        )
 
-                    with COGReader(baseline_path) as baseline_src:
-                        baseline_feat = baseline_src.feature(
-                            json.loads(boundary_feature.geom.geojson), max_size=1024
-                        )
-                        baseline_data = baseline_feat.as_masked()
+        if result is None:
+            return queue_feature_query(
+                request,
+                product_dataset,
+                boundary_feature,
+                mask_dataset=mask_dataset,
+                baseline_dataset=baseline_dataset,
+                anomaly=bool(anomaly_type),
+                cache_key=cache_key,
+            )
 
-                    if cropmask_id != "no-mask":
-                        # mask baseline data
-                        baseline_data = baseline_data * mask_data
+        set_cached(cache_key, result)
 
-                    if anomaly_type:
-                        if baseline_type == "diff":
-                            new_year = diff_year
-                            new_date = product_dataset.date.replace(year=new_year)
-                            baseline_queryset = ProductRaster.objects.filter(
-                                product__product_id=product_id
-                            )
-                            closest = get_closest_to_date(baseline_queryset, new_date)
-                            try:
-                                baseline_dataset = get_object_or_404(
-                                    product_queryset, date=new_date
-                                )
-                            except:
-                                baseline_dataset = closest
-                        # If Anomaly, Calculate difference between data and baseline
-                        mean = data.mean() - baseline_data.mean()
-                        _min = data.min() - baseline_data.min()
-                        _max = data.max() - baseline_data.max()
-                        stdev = data.std() - baseline_data.std()
-                    else:
-                        # If not Anomaly, just use baseline
-                        mean = baseline_data.mean()
-                        _min = baseline_data.min()
-                        _max = baseline_data.max()
-                        stdev = baseline_data.std()
-
-                    mean = float(
-                        Decimal(str(mean))
-                        * Decimal(str(product_dataset.product.variable.scale))
-                    )
-                    _min = float(
-                        Decimal(str(_min))
-                        * Decimal(str(product_dataset.product.variable.scale))
-                    )
-                    _max = float(
-                        Decimal(str(_max))
-                        * Decimal(str(product_dataset.product.variable.scale))
-                    )
-                    stdev = float(
-                        Decimal(str(stdev))
-                        * Decimal(str(product_dataset.product.variable.scale))
-                    )
+        return Response(result, headers={"X-Resolution": result["resolution"]})
 
-                if type(mean) != np.ma.core.MaskedConstant:
-                    result = {"min": _min, "max": _max, "mean": mean, "std": stdev}
-                else:
-                    result = {"value": "No Data"}
-        except InvalidOperation:
-            result = {"value": "No Data"}
+    @swagger_auto_schema(
+        operation_id="query result",
+        manual_parameters=[task_id_param],
+    )
+    def query_result(self, request, task_id: str = None):
+        """
+        Return the result of a queued full resolution query.
+        Responds with 202 while the query is still running. Results of
+        other tasks (exports, ingest) are not served.
+        """
+        task = fetch(task_id)
 
-        if settings.USE_CACHING:
-            cache.set(cache_key, result, timeout=(60 * 60 * 24 * 365))  # 1 year
+        if task is None:
+            return Response(
+                {"status": "queued", "task_id": task_id},
+                status=status.HTTP_202_ACCEPTED,
+            )
+        if task.func != QUERY_TASK_FUNC:
+            raise NotFound("No query with the given task id.")
+        if not task.success:
+            raise APIException(f"Query failed: {task.result}")
 
-        return Response(result)
+        return Response(task.result, headers={"X-Resolution": "full"})
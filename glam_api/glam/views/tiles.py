@@ -6,8 +6,8 @@ from typing import Mapping, Union, Tuple, TypeVar
 from typing import BinaryIO
 
 import numpy as np
-import matplotlib
 
+import morecantile
 import rasterio
 
 from rio_tiler.io import COGReader
@@ -18,18 +18,25 @@ from rio_tiler.models import ImageData
 
 from rest_framework import viewsets
 from rest_framework.response import Response
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import NotFound, ValidationError
 
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
 from django.conf import settings
-from django.shortcuts import get_object_or_404
 from django.utils.decorators import method_decorator
 from django.core.cache import cache
 
 from ..serializers import TilesSerializer
 from ..renderers import PNGRenderer
+from ..utils.compositor import NDVI_COLORS, colormap_lut
+from ..utils.resolvers import (
+    explain_response,
+    get_baseline_dataset,
+    get_product_dataset,
+    read_plan,
+    wants_explain,
+)
 
 from ..models import (
     Product,
@@ -39,7 +46,6 @@ from ..models import (
     AnomalyBaselineRaster,
 )
 
-from config.utils import get_closest_to_date
 
 logging.basicConfig(
     format="%(asctime)s - %(message)s", datefmt="%d-%b-%y %H:%M:%S", level=logging.DEBUG
@@ -200,6 +206,15 @@ class Tiles(viewsets.ViewSet):
         required=False,
     )
 
+    explain_param = openapi.Parameter(
+        "explain",
+        openapi.IN_QUERY,
+        description="Return the raster read plan (datasets, windows, overview "
+        "levels, estimated bytes and range requests) without reading pixels",
+        type=openapi.TYPE_BOOLEAN,
+        required=False,
+    )
+
     @swagger_auto_schema(
         manual_parameters=[
             product_param,
@@ -216,6 +231,7 @@ class Tiles(viewsets.ViewSet):
             stretch_min_param,
             stretch_max_param,
             tile_size_param,
+            explain_param,
         ],
         operation_id="retrieve tile",
     )
@@ -241,8 +257,7 @@ class Tiles(viewsets.ViewSet):
             for specified zoom and tile coordinates.
         """
 
-        product_queryset = ProductRaster.objects.filter(product__product_id=product_id)
-        product_dataset = get_object_or_404(product_queryset, date=date)
+        product_dataset = get_product_dataset(product_id, date)
 
         params = TilesSerializer(data=request.query_params)
         params.is_valid(raise_exception=True)
@@ -258,7 +273,9 @@ class Tiles(viewsets.ViewSet):
         stretch_max = data.get("stretch_max", None)
         tile_size = data.get("tile_size", None)
 
-        if settings.USE_CACHING:
+        explain = wants_explain(request)
+
+        if settings.USE_CACHING and not explain:
             cache_key = f"tile-{product_id}-{date}-{z}-{x}-{y}-{cropmask_id}-{cropmask_threshold}-{anomaly}-{anomaly_type}-{diff_year}-{colormap}-{stretch_min}-{stretch_max}-{tile_size}"
 
             data = cache.get(cache_key)
@@ -281,6 +298,37 @@ class Tiles(viewsets.ViewSet):
         if stretch_min is not None and stretch_max is not None:
             stretch_range = [stretch_min, stretch_max]
 
+        anomaly_dataset = None
+        if anomaly or anomaly_type == "diff":
+            anomaly_dataset = get_baseline_dataset(
+                product_dataset,
+                anomaly,
+                anomaly_type if anomaly_type else "mean",
+                diff_year,
+            )
+            if anomaly_dataset is None:
+                raise NotFound("No dataset of the diff year to compare to.")
+
+        cropmask = None
+        if cropmask_id:
+            cropmask = CropMask.objects.get(cropmask_id=cropmask_id)
+
+        if explain:
+            return explain_response(
+                request,
+                read_plan(
+                    "tiles",
+                    [
+                        ("product", product_dataset),
+                        ("baseline", anomaly_dataset),
+                        ("cropmask", cropmask),
+                    ],
+                    morecantile.tms.get("WebMercatorQuad").bounds(x, y, z),
+                    max_size=tile_size,
+                    tile={"z": z, "x": x, "y": y},
+                ),
+            )
+
         with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env:
             for key, value in env.options.items():
                 logging.debug(f"GDAL env option: {key}: {value}")
@@ -294,37 +342,6 @@ class Tiles(viewsets.ViewSet):
                         )
 
                     if anomaly or anomaly_type == "diff":
-                        anom_type = anomaly_type if anomaly_type else "mean"
-
-                        if anom_type == "diff":
-                            new_year = diff_year
-                            new_date = product_dataset.date.replace(year=new_year)
-                            anomaly_queryset = ProductRaster.objects.filter(
-                                product__product_id=product_id
-                            )
-                            closest = get_closest_to_date(anomaly_queryset, new_date)
-
-                            try:
-                                anomaly_dataset = get_object_or_404(
-                                    product_queryset, date=new_date
-                                )
-                            except:
-                                anomaly_dataset = closest
-
-                        else:
-                            doy = product_dataset.date.timetuple().tm_yday
-
-                            if product_id in ["chirps-precip", "copernicus-swi"]:
-                                doy = int(str(date.month) + str(date.day).zfill(2))
-                            anomaly_queryset = AnomalyBaselineRaster.objects.all()
-                            anomaly_dataset = get_object_or_404(
-                                anomaly_queryset,
-                                product__product_id=product_id,
-                                day_of_year=doy,
-                                baseline_length=anomaly,
-                                baseline_type=anom_type,
-                            )
-
                         # if stretch not specified, use standard deviation
                         if stretch_min is None and stretch_max is None:
                             try:
@@ -346,8 +363,6 @@ class Tiles(viewsets.ViewSet):
                         img = ImageData(diff)
 
                     if cropmask_id:
-                        cropmask = CropMask.objects.get(cropmask_id=cropmask_id)
-
                         with COGReader(
                             f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/{cropmask.map_raster.name}"
                         ) as cog:
@@ -382,32 +397,6 @@ class Tiles(viewsets.ViewSet):
                     out_range=((0, 255),),
                 )
 
-                ndvi = matplotlib.colors.LinearSegmentedColormap.from_list(
-                    "ndvi",
-                    [
-                        "#fffee1",
-                        "#ffe1c8",
-                        "#f5c98c",
-                        "#ffdd55",
-                        "#ebbe37",
-                        "#faffb4",
-                        "#e6fa9b",
-                        "#cdff69",
-                        "#aff05a",
-                        "#a0f5a5",
-                        "#82e187",
-                        "#78c878",
-                        "#9ec66c",
-                        "#8caf46",
-                        "#46b928",
-                        "#329614",
-                        "#147850",
-                        "#1e5000",
-                        "#003200",
-                    ],
-                    256,
-                )
-
                 if colormap is None:
                     # use product's default colormap
                     if anomaly or anomaly_type == "diff":
@@ -422,11 +411,9 @@ class Tiles(viewsets.ViewSet):
                             colormap = None
 
                 if colormap == "ndvi":
-                    x = np.linspace(0, 1, 256)
-                    cmap_vals = ndvi(x)[:, :]
-                    cmap_uint8 = (cmap_vals * 255).astype("uint8")
+                    ndvi_lut = colormap_lut(tuple(NDVI_COLORS))
                     ndvi_dict = {
-                        idx: tuple(value) for idx, value in enumerate(cmap_uint8)
+                        idx: tuple(value) for idx, value in enumerate(ndvi_lut)
                     }
                     new = cmap.register({"ndvi": ndvi_dict})
                     cm = new.get("ndvi")
@@ -458,6 +445,7 @@ class Tiles(viewsets.ViewSet):
             stretch_min_param,
             stretch_max_param,
             tile_size_param,
+            explain_param,
         ],
         operation_id="preview tiles",
     )
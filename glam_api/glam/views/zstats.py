@@ -0,0 +1,272 @@
+from contextlib import ExitStack
+
+import pandas as pd
+
+import rasterio
+
+from rest_framework.response import Response
+from rest_framework.exceptions import NotFound
+from rest_framework.renderers import BrowsableAPIRenderer
+
+from rest_pandas import PandasViewSet
+from rest_pandas.renderers import (
+    PandasCSVRenderer,
+    PandasExcelRenderer,
+    PandasJSONRenderer,
+    PandasTextRenderer,
+)
+
+from drf_yasg.utils import swagger_auto_schema
+from drf_yasg import openapi
+
+from django.shortcuts import get_object_or_404
+from django.conf import settings
+
+from ..models import (
+    ProductRaster,
+    CropmaskRaster,
+    Product,
+    CropMask,
+    BoundaryLayer,
+    BoundaryFeature,
+)
+from ..serializers import ZStatsSerializer, ZStatsResponseSerializer
+from ..renderers import OldGLAMZStatsRenderer
+from ..utils.cache import get_cached, set_cached, versioned_key
+from ..utils.masks import get_feature_mask
+from ..utils.zonal import (
+    RunningStats,
+    feature_coverage,
+    map_feature_stats,
+    open_datasets,
+)
+from .query import get_feature_coverage
+
+AVAILABLE_PRODUCTS = list()
+AVAILABLE_CROPMASKS = list()
+AVAILABLE_BOUNDARY_LAYERS = list()
+RESOLUTION_CHOICES = ["full", "preview"]
+
+try:
+    products = Product.objects.all()
+    for p in products:
+        AVAILABLE_PRODUCTS.append(p.product_id)
+except:
+    pass
+
+try:
+    cropmasks = CropMask.objects.all()
+    for c in cropmasks:
+        AVAILABLE_CROPMASKS.append(c.cropmask_id)
+except:
+    pass
+
+try:
+    boundary_layers = BoundaryLayer.objects.all()
+    for b in boundary_layers:
+        AVAILABLE_BOUNDARY_LAYERS.append(b.layer_id)
+except:
+    pass
+
+product_param = openapi.Parameter(
+    "product_id",
+    openapi.IN_PATH,
+    description="A unique integer value identifying a dataset.",
+    required=True,
+    type=openapi.TYPE_STRING,
+    format=openapi.FORMAT_SLUG,
+    enum=AVAILABLE_PRODUCTS if len(AVAILABLE_PRODUCTS) > 0 else None,
+)
+
+cropmask_param = openapi.Parameter(
+    "cropmask_id",
+    openapi.IN_PATH,
+    description="A unique character ID to identify Crop Mask records.",
+    required=True,
+    type=openapi.TYPE_STRING,
+    format=openapi.FORMAT_SLUG,
+    enum=AVAILABLE_CROPMASKS if len(AVAILABLE_CROPMASKS) > 0 else None,
+)
+
+boundary_layer_param = openapi.Parameter(
+    "layer_id",
+    openapi.IN_PATH,
+    description="A unique character ID to identify Boundary Layer records.",
+    required=True,
+    type=openapi.TYPE_STRING,
+    format=openapi.FORMAT_SLUG,
+    enum=AVAILABLE_BOUNDARY_LAYERS if len(AVAILABLE_BOUNDARY_LAYERS) > 0 else None,
+)
+
+boundary_feature_param = openapi.Parameter(
+    "feature_id",
+    openapi.IN_PATH,
+    description="Boundary Feature ID.",
+    type=openapi.TYPE_INTEGER,
+)
+
+start_year_param = openapi.Parameter(
+    "start_year",
+    openapi.IN_QUERY,
+    description="First year of the time series (default: first available year)",
+    type=openapi.TYPE_INTEGER,
+)
+
+end_year_param = openapi.Parameter(
+    "end_year",
+    openapi.IN_QUERY,
+    description="Last year of the time series (default: last available year)",
+    type=openapi.TYPE_INTEGER,
+)
+
+resolution_param = openapi.Parameter(
+    "resolution",
+    openapi.IN_QUERY,
+    description="'full' for exact statistics at native resolution (default), "
+    "'preview' for a faster approximation at reduced resolution.",
+    type=openapi.TYPE_STRING,
+    enum=RESOLUTION_CHOICES,
+    default=RESOLUTION_CHOICES[0],
+)
+
+format_param = openapi.Parameter(
+    "format",
+    openapi.IN_QUERY,
+    description="output format (json, csv, txt, xlsx or oldglam)",
+    type=openapi.TYPE_STRING,
+    format=openapi.TYPE_STRING,
+)
+
+
+class ZonalStats(PandasViewSet):
+
+    serializer_class = ZStatsResponseSerializer
+
+    renderer_classes = [
+        PandasJSONRenderer,
+        BrowsableAPIRenderer,
+        PandasCSVRenderer,
+        PandasTextRenderer,
+        PandasExcelRenderer,
+        OldGLAMZStatsRenderer,
+    ]
+
+    @swagger_auto_schema(
+        operation_id="boundary feature zonal statistics",
+        manual_parameters=[
+            product_param,
+            cropmask_param,
+            boundary_layer_param,
+            boundary_feature_param,
+            start_year_param,
+            end_year_param,
+            resolution_param,
+            format_param,
+        ],
+    )
+    def boundary_feature_zstats(
+        self,
+        request,
+        product_id: str = None,
+        cropmask_id: str = None,
+        layer_id: str = None,
+        feature_id: int = None,
+    ):
+        """
+        Seasonal time series of mean values for a boundary feature,
+        one row per product dataset over the requested year range.
+        """
+        params = ZStatsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        data = params.validated_data
+
+        start_year = data.get("start_year", None)
+        end_year = data.get("end_year", None)
+        resolution = data.get("resolution", None)
+
+        product = get_object_or_404(Product, product_id=product_id)
+        product_datasets = ProductRaster.objects.filter(product=product)
+        if start_year:
+            product_datasets = product_datasets.filter(date__year__gte=start_year)
+        if end_year:
+            product_datasets = product_datasets.filter(date__year__lte=end_year)
+        product_datasets = list(product_datasets.order_by("date"))
+
+        if not product_datasets:
+            raise NotFound("No datasets available for the requested years")
+
+        boundary_layer = get_object_or_404(BoundaryLayer, layer_id=layer_id)
+        boundary_feature = get_object_or_404(
+            BoundaryFeature, boundary_layer=boundary_layer, feature_id=feature_id
+        )
+
+        mask_dataset = None
+        if cropmask_id != "no-mask":
+            mask_queryset = CropmaskRaster.objects.all()
+            mask_dataset = get_object_or_404(
+                mask_queryset,
+                product__product_id=product_id,
+                crop_mask__cropmask_id=cropmask_id,
+            )
+
+        cache_key = versioned_key(
+            f"boundary-zstats-{product_id}-{cropmask_id}-{layer_id}-{feature_id}-{start_year}-{end_year}-{resolution}-{product_datasets[-1].date}-{len(product_datasets)}",
+            boundary_feature,
+            mask_dataset,
+            *product_datasets,
+        )
+        records = get_cached(cache_key)
+        if records:
+            return Response(pd.DataFrame(records))
+
+        # a single feature mask, rasterized on the product grid, is shared
+        # by every date
+        with rasterio.Env(**settings.GDAL_CONFIG_OPTIONS) as env, ExitStack() as stack:
+            product_src, mask_src = open_datasets(
+                stack, product_datasets[-1], mask_dataset
+            )
+            feature_mask = get_feature_mask(product_src, boundary_feature)
+            coverage = get_feature_coverage(boundary_feature, mask_dataset)
+            if coverage is not None:
+                arable_pixels = coverage.arable_pixels
+                total_pixels = coverage.total_pixels
+            else:
+                arable_pixels, total_pixels, _ = feature_coverage(
+                    feature_mask, mask_src
+                )
+
+        percent_arable = (
+            round(arable_pixels / total_pixels * 100, 2) if total_pixels else 0.0
+        )
+
+        if arable_pixels:
+            stats = map_feature_stats(
+                feature_mask,
+                boundary_feature,
+                product_datasets,
+                mask_dataset=mask_dataset,
+                max_size=(
+                    settings.PREVIEW_MAX_SIZE if resolution == "preview" else None
+                ),
+            )
+        else:
+            # no cropland within the feature, every date is empty
+            stats = [RunningStats() for dataset in product_datasets]
+
+        scale = product.variable.scale
+        records = []
+        for dataset, dataset_stats in zip(product_datasets, stats):
+            records.append(
+                {
+                    "date": dataset.date.strftime("%Y-%m-%d"),
+                    "mean_value": (
+                        dataset_stats.mean * scale if dataset_stats.count else None
+                    ),
+                    "percent_arable": percent_arable,
+                    "arable_pixels": arable_pixels,
+                }
+            )
+
+        set_cached(cache_key, records, timeout=(60 * 60 * 24 * 30))  # 30 days
+
+        return Response(pd.DataFrame(records))